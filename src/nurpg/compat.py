@@ -1,4 +1,8 @@
+import os
 import sys
+import errno
+import binascii
+import tempfile
 
 # Compatibility work for managing user input which has changed since python
 # 2.7.x to 3.x.x
@@ -7,3 +11,81 @@ user_input = input
 # Compatibility for expected input functionality with 3.x.x forward
 if sys.version_info[0] == 2:
     user_input = raw_input
+
+# In-memory text streams moved in 3.x.x
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+# Synchronized queues were renamed in 3.x.x
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+# xz compression only joined the standard library in 3.3
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+# Allocation tracing joined the standard library in 3.4
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# Resource usage is only available on unix-like platforms
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# Hashing and compression only accept bytes, which 3.x.x strings are not
+def to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+
+    return value.encode('utf-8')
+
+
+def to_str(value):
+    if isinstance(value, str):
+        return value
+
+    return value.decode('utf-8')
+
+
+# json hands back unicode on 2.7.x where everything else works with str
+def to_native(value):
+    if value is None or isinstance(value, str):
+        return value
+
+    return value.encode('utf-8')
+
+
+# Files written through a temp file and renamed into place should end up
+# with the mode a plain open() would give them. tempfile.mkstemp always
+# creates them private, and the umask can't be read without changing it
+# for the whole process, so the file is created with the usual mode and
+# the umask left to the kernel.
+def mkstemp(directory, prefix):
+    flags = (os.O_WRONLY | os.O_CREAT | os.O_EXCL |
+             getattr(os, 'O_NOFOLLOW', 0) | getattr(os, 'O_BINARY', 0))
+
+    for _ in range(tempfile.TMP_MAX):
+        path = os.path.join(directory, prefix + to_str(
+            binascii.hexlify(os.urandom(6))))
+
+        try:
+            return os.open(path, flags, 0o666), path
+        except OSError as ex:
+            if ex.errno != errno.EEXIST:
+                raise
+
+    raise OSError(errno.EEXIST, 'No usable temporary file name found')
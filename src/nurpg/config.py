@@ -1,15 +1,41 @@
 import os
 import json
-import uuid
-import shutil
+import stat
+import errno
+import tempfile
+import threading
 
 import nurpg.error as error
+import nurpg.stash as stash
+import nurpg.compat as compat
+
+try:
+    import fcntl
+except ImportError:
+    # No advisory file locking on this platform (e.g. Windows)
+    fcntl = None
 
 
 _NDS_DIR = '.nds'
 _NDS_CFG_FILE = '{}/config'.format(_NDS_DIR)
 _NDS_STASH_DIR = '{}/stash'.format(_NDS_DIR)
 
+# The config is replaced by rename on every write so locks are taken on a
+# separate file that never moves
+_NDS_LOCK_FILE = '{}/lock'.format(_NDS_DIR)
+
+# Edit sessions journal their changes here
+JOURNAL_FILE = '{}/journal'.format(_NDS_DIR)
+
+# Names defined by the other documents in the workspace
+SYMBOLS_FILE = '{}/symbols'.format(_NDS_DIR)
+
+# Names autocompletion offers, see ndm complete
+COMPLETIONS_FILE = '{}/completions'.format(_NDS_DIR)
+
+# Tokens of every file a document includes, by content hash
+TOKENS_DIR = '{}/tokens'.format(_NDS_DIR)
+
 
 class ConfigurationError(error.ErrorMessage):
     pass
@@ -55,14 +81,60 @@ class Configuration(object):
         return json.dumps(self.to_dict())
 
 
+# Advisory lock over the whole workspace. Readers share the lock and never
+# block each other; anything that modifies the workspace holds it
+# exclusively. Nested use within a thread reuses the lock already held.
+class WorkspaceLock(object):
+
+    _held = threading.local()
+
+    def __init__(self, exclusive=False):
+        self.exclusive = exclusive
+        self._lock_file = None
+
+    def __enter__(self):
+        held = WorkspaceLock._held
+
+        if getattr(held, 'depth', 0) > 0:
+            # Upgrading in place could deadlock against another upgrader
+            if self.exclusive and not held.exclusive:
+                raise ConfigurationError('A shared workspace lock can not be '
+                                         'upgraded to an exclusive one.')
+
+            held.depth += 1
+            return self
+
+        check_nds_dir()
+        self._lock_file = open(_NDS_LOCK_FILE, 'a')
+
+        if fcntl is not None:
+            try:
+                fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX
+                            if self.exclusive else fcntl.LOCK_SH)
+            except Exception:
+                self._lock_file.close()
+                raise
+
+        held.depth = 1
+        held.exclusive = self.exclusive
+        return self
+
+    def __exit__(self, type, value, traceback):
+        held = WorkspaceLock._held
+        held.depth -= 1
+
+        # Closing the file releases the lock
+        if held.depth == 0 and self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+
 def check_nds_dir():
-    if not os.path.isdir(_NDS_DIR):
-        os.makedirs(_NDS_DIR)
+    _make_dirs(_NDS_DIR)
 
 
 def check_stash_dir():
-    if not os.path.isdir(_NDS_STASH_DIR):
-        os.makedirs(_NDS_STASH_DIR)
+    _make_dirs(_NDS_STASH_DIR)
 
 
 def cfg_exists():
@@ -75,33 +147,127 @@ def cfg_exists():
 
 
 def init_config(document_file):
-    if cfg_exists():
-        raise ConfigurationError('Cowardly refusing to reinit over a '
-                                 'pre-existing NDS configuration')
+    with WorkspaceLock(exclusive=True):
+        if cfg_exists():
+            raise ConfigurationError('Cowardly refusing to reinit over a '
+                                     'pre-existing NDS configuration')
 
-    write_config(Configuration(document_file=document_file))
+        write_config(Configuration(document_file=document_file))
 
 
 def read_config():
-    if not cfg_exists():
-        raise ConfigurationError('A valid NDS configuration was not found. '
-                                 'Please run init first.')
+    with WorkspaceLock():
+        if not cfg_exists():
+            raise ConfigurationError('A valid NDS configuration was not '
+                                     'found. Please run init first.')
 
-    with open(_NDS_CFG_FILE, 'r') as fin:
-        return Configuration.from_json(fin.read())
+        with open(_NDS_CFG_FILE, 'r') as fin:
+            return Configuration.from_json(fin.read())
 
 
 def write_config(cfg):
-    with open(_NDS_CFG_FILE, 'w') as fout:
-        fout.write(cfg.to_json())
+    with WorkspaceLock(exclusive=True):
+        # Readers that don't take the lock still only ever see a whole
+        # configuration
+        fd, tmp_path = tempfile.mkstemp(dir=_NDS_DIR, prefix='.config-')
+
+        try:
+            with os.fdopen(fd, 'w') as fout:
+                fout.write(cfg.to_json())
+                fout.flush()
+                os.fsync(fout.fileno())
+
+            os.rename(tmp_path, _NDS_CFG_FILE)
+        except Exception:
+            os.remove(tmp_path)
+            raise
 
 
 def stash_push(document_file):
-    stash_id = str(uuid.uuid4())
+    with WorkspaceLock(exclusive=True):
+        return _stash_push(document_file)
+
+
+def stash_pop(document_file):
+    # The most recent entry is restored before it's dropped, all under one
+    # lock so gc can't collect it in between
+    with WorkspaceLock(exclusive=True):
+        cfg = read_config()
+
+        if len(cfg.stash_stack) == 0:
+            return None
+
+        stash_restore(cfg.stash_stack[-1], document_file)
+        stash_id = cfg.pop_from_stash()
+
+        # Write the updated configuration, the object itself is left for gc
+        write_config(cfg)
+
+        return stash_id
+
+
+def stash_restore(stash_id, document_file):
+    with WorkspaceLock():
+        content = _stash_content(read_config(), stash_id)
+
+    # Written next to the document and renamed over it, so a failed restore
+    # leaves the document as it was
+    doc_dir = os.path.dirname(os.path.abspath(document_file))
+    fd, tmp_path = compat.mkstemp(doc_dir, '.nd-')
+
+    try:
+        mode = stat.S_IMODE(os.stat(document_file).st_mode)
+    except OSError:
+        mode = None
+
+    try:
+        with os.fdopen(fd, 'wb') as fout:
+            fout.write(content)
+            fout.flush()
+            os.fsync(fout.fileno())
+
+        if mode is not None:
+            os.chmod(tmp_path, mode)
+
+        os.rename(tmp_path, document_file)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def stash_read(stash_id=None):
+    with WorkspaceLock():
+        cfg = read_config()
+
+        if stash_id is None:
+            # Default to the most recent stash entry
+            if len(cfg.stash_stack) == 0:
+                raise ConfigurationError('The stash is empty.')
+
+            stash_id = cfg.stash_stack[-1]
+        elif stash_id not in cfg.stash_stack:
+            raise ConfigurationError('Stash entry {} not found.'.format(
+                stash_id))
+
+        return compat.to_str(_stash_content(cfg, stash_id))
+
+
+def stash_gc():
+    with WorkspaceLock(exclusive=True):
+        return _stash_gc()
+
+
+def _stash_push(document_file):
     cfg = read_config()
+    store = stash.ObjectStore(cfg.stash_dir)
+
+    with open(document_file, 'rb') as fin:
+        content = fin.read()
 
-    # Copy the file, then push it onto our stash stack
-    shutil.copyfile(document_file, os.path.join(cfg.stash_dir, stash_id))
+    # Store the snapshot by content, as a delta against the base of the most
+    # recent entry when that is worthwhile
+    base_id = _stash_base(cfg, store)
+    stash_id = store.put(content, base_id)
     cfg.push_onto_stash(stash_id)
 
     # Write the updated configuration
@@ -111,15 +277,77 @@ def stash_push(document_file):
     return stash_id
 
 
-def stash_pop():
+def _stash_gc():
     cfg = read_config()
+    store = stash.ObjectStore(cfg.stash_dir)
 
-    path = None
-    stashed_file = cfg.pop_from_stash()
+    before = sum(store.size(object_id) for object_id in store.ids())
 
-    if stashed_file is not None:
-        # Write the updated configuration and return the stashed file
-        write_config(cfg)
-        path = os.path.join(_NDS_STASH_DIR, stashed_file)
+    # Move any entries from before content addressing into the object store
+    for idx, stash_id in enumerate(cfg.stash_stack):
+        legacy_path = os.path.join(cfg.stash_dir, stash_id)
+
+        if not store.contains(stash_id) and os.path.isfile(legacy_path):
+            with open(legacy_path, 'rb') as fin:
+                cfg.stash_stack[idx] = store.put(fin.read())
+
+            os.remove(legacy_path)
+
+    live = set(cfg.stash_stack)
+
+    # The most recent entry becomes the single full base and every other
+    # live entry is re-encoded as a delta against it
+    if len(cfg.stash_stack) > 0:
+        base_id = cfg.stash_stack[-1]
+
+        if store.base_of(base_id) != base_id:
+            store.rebase(base_id)
+
+        for stash_id in live:
+            if stash_id != base_id:
+                store.rebase(stash_id, base_id)
+
+    removed = 0
+
+    for object_id in store.ids():
+        if object_id not in live:
+            store.remove(object_id)
+            removed += 1
+
+    write_config(cfg)
+
+    after = sum(store.size(object_id) for object_id in store.ids())
+    return removed, before, after
+
+
+def _make_dirs(path):
+    # Another process may create the directory at the same time
+    try:
+        os.makedirs(path)
+    except OSError as ex:
+        if ex.errno != errno.EEXIST or not os.path.isdir(path):
+            raise
+
+
+def _stash_base(cfg, store):
+    for stash_id in reversed(cfg.stash_stack):
+        if store.contains(stash_id):
+            return stash_id
+
+    return None
+
+
+def _stash_content(cfg, stash_id):
+    store = stash.ObjectStore(cfg.stash_dir)
+
+    if store.contains(stash_id):
+        return store.get(stash_id)
+
+    # Entries pushed before content addressing are plain copies
+    legacy_path = os.path.join(cfg.stash_dir, stash_id)
+
+    if not os.path.isfile(legacy_path):
+        raise ConfigurationError('Stash entry {} not found.'.format(stash_id))
 
-    return path
+    with open(legacy_path, 'rb') as fin:
+        return fin.read()
@@ -1,8 +1,22 @@
 import os
-import uuid
+import re
+import gc
+import sys
+import stat
+import time
+import errno
+import marshal
+import collections
+import hashlib
 import logging
+import tempfile
+import multiprocessing
 
 import nurpg.error as error
+import nurpg.compat as compat
+import nurpg.config as config
+import nurpg.journal as journal
+import nurpg.memprofile as memprofile
 
 
 # Logging!
@@ -31,18 +45,8 @@ D_WORDS = [
     'feature',
     'ref',
     'aspect',
-    'halt'
-]
-
-# Words that may contain other words
-D_ELEMENTS = [
-    'section',
-    'aspect',
-    'feature',
-    'mechanic',
-    'effect',
-    'ability',
-    'aspect'
+    'halt',
+    'include'
 ]
 
 # Set reserved words
@@ -50,6 +54,84 @@ for word in D_WORDS:
     name = 'D_{}'.format(word.upper())
     vars()[name] = word
 
+# How directives shape the tree. A directive first exits back to the scope
+# named by exits_to, then closes the current scope if its kind is in closes
+# and then either opens a scope of its own, that following nodes are
+# appended to, or is appended in place. Header directives are hoisted to the
+# root. Words not listed here are simply appended in place.
+#
+# Validation also checks that a directive ends up directly inside one of
+# the kinds in inside, or the kinds that list it in accepts.
+GRAMMAR = {
+    D_SECTION: {'exits_to': D_ROOT, 'opens': True},
+    D_FEATURE: {'exits_to': D_SECTION, 'opens': True},
+    D_EFFECT: {'exits_to': D_SECTION, 'opens': True},
+    D_ABILITY: {'exits_to': D_SECTION, 'opens': True},
+    D_ASPECT: {'exits_to': D_SECTION, 'opens': True},
+    D_MECHANIC: {'closes': [D_MECHANIC], 'opens': True, 'inside': [
+        D_FEATURE, D_EFFECT, D_ABILITY, D_ASPECT]},
+    D_COST: {'inside': [D_MECHANIC, D_FEATURE, D_EFFECT, D_ASPECT]},
+    D_DIFFICULTY: {'inside': [D_ABILITY]},
+    D_GRANTS: {'inside': [D_ABILITY, D_ASPECT]},
+    D_REQUIRES: {'inside': [D_ABILITY, D_ASPECT]},
+    D_TITLE: {'header': True},
+    D_AUTHOR: {'header': True}
+}
+
+
+def _compile_grammar():
+    # Flatten the grammar into the sets and dispatch table the parser uses
+    global DIRECTIVES, D_ELEMENTS, TOP_LEVEL, HEADERS, PLACEMENT, _DISPATCH, \
+        _KINDS
+
+    dispatch = dict()
+    placement = dict()
+
+    for kind, rule in GRAMMAR.items():
+        for parent in rule.get('inside', ()):
+            placement.setdefault(kind, set()).add(parent)
+
+        for child in rule.get('accepts', ()):
+            placement.setdefault(child, set()).add(kind)
+
+        # Words that are only ever placed are appended in place
+        if not (rule.get('exits_to') or rule.get('closes') or
+                rule.get('opens') or rule.get('header')):
+            continue
+
+        dispatch[kind] = (
+            rule.get('exits_to'),
+            frozenset(rule.get('closes', ())),
+            rule.get('opens', False),
+            rule.get('header', False))
+
+    DIRECTIVES = frozenset(D_WORDS)
+
+    # The one copy of each word every parsed node's kind refers to
+    _KINDS = dict((word, word) for word in D_WORDS)
+
+    # Words that may contain other words
+    D_ELEMENTS = frozenset(kind for kind, rule in dispatch.items() if rule[2])
+
+    # Elements that always start a new top level region of the document
+    TOP_LEVEL = frozenset(kind for kind, rule in dispatch.items()
+                          if rule[2] and rule[0] == D_ROOT)
+
+    HEADERS = frozenset(kind for kind, rule in dispatch.items() if rule[3])
+
+    # The kinds a directive may be placed directly inside of
+    PLACEMENT = dict((kind, frozenset(parents))
+                     for kind, parents in placement.items())
+
+    _DISPATCH = dispatch
+
+
+# Compile the built in grammar
+_compile_grammar()
+
+# Characters a directive word may not contain
+_WORD_UNSAFE_REGEX = re.compile('[\\s@\\\\]')
+
 # Token type identifiers
 CONTENT_TOKEN = 'content'
 DIRECTIVE_TOKEN = 'directive'
@@ -64,6 +146,15 @@ ESCAPE_CH = '\\'
 # Whitespace characters
 WHITE_SPACE = [ ' ', '\r', '\n', 't' ]
 
+# Shared by every node that has no children of its own
+_NO_CHILDREN = ()
+
+# Whitespace trimmed from around content, as str.strip() does
+_STRIP_CHARS = frozenset(' \t\n\r\x0b\x0c')
+
+# An escape character and the character it escapes
+_UNESCAPE_REGEX = re.compile('\\\\(.?)', re.DOTALL)
+
 # Token states
 TK_START = 1
 TK_CONTENT = 2
@@ -73,6 +164,44 @@ TK_DIRECTIVE = 3
 ST_NEXT = 0
 ST_WANTS_CONTENT = 1
 
+# Journal growth that triggers a full rewrite instead of patching in place
+JOURNAL_COMPACT_BYTES = MB_IN_BYTES
+JOURNAL_COMPACT_SAVES = 32
+
+# Buffer size used when writing a whole document out
+WRITE_BUFFER_BYTES = MB_IN_BYTES
+
+# Documents smaller than this are always parsed in-process; starting the
+# workers would cost more than they save
+PARALLEL_MIN_BYTES = MB_IN_BYTES
+
+# Parsing keeps a single copy of repeated kinds, arguments and content
+SHARE_STRINGS = True
+
+# Bumped whenever the layout of cached file tokens changes so stale caches
+# are tokenized again
+TOKEN_CACHE_VERSION = 1
+
+# Cached tokens no document has used for this long are removed whenever new
+# ones are written
+TOKEN_CACHE_SECONDS = 30 * 24 * 60 * 60
+
+# Sections are handed out in batches, about this many per worker, so that
+# one long section doesn't leave the other workers idle at the end
+PARALLEL_BATCHES_PER_JOB = 4
+
+# Escaped forms of the special characters
+_ESCAPED_ESCAPE_CH = ESCAPE_CH * 2
+_ESCAPED_DIRECTIVE_CH = ESCAPE_CH + DIRECTIVE_CH
+
+# Content nodes are separated by a blank line
+_CONTENT_END = DIRECTIVE_END_CH * 2
+
+# Node id formatting
+ID_SEPARATOR = '/'
+ID_SUFFIX = '{}-{}'
+_ID_UNSAFE_REGEX = re.compile('[^a-z0-9]+')
+
 
 class DocumentError(error.ErrorMessage):
     pass
@@ -84,79 +213,473 @@ class DocumentParsingError(DocumentError):
 
 class DocumentContext(object):
 
-    def __init__(self, filename):
+    def __init__(self, filename, journal_file=None):
         self.filename = filename
-        self._doc_ref = None
+        self.journal_file = journal_file or config.JOURNAL_FILE
+        self._session = None
 
     def __enter__(self):
-        if not os.path.exists(self.filename):
-            raise DocumentError('File {} not found!'.format(self.filename))
+        doc = read(self.filename)
+
+        # Saving would write every included file into this one
+        if doc.files is not None:
+            raise DocumentError('Documents composed with @include can not be '
+                                'edited in place.')
 
-        if  os.path.getsize(self.filename) >= (MAX_DOC_SIZE_MB * MB_IN_BYTES):
-            raise DocumentError('File is too large to read. Maximum file  size'
-                                ' supported is {} MB.'.format(MAX_DOC_SIZE_MB))
+        self._session = EditSession(
+            doc,
+            self.filename,
+            journal.Journal(self.journal_file))
 
-        self._doc_ref = _open(self.filename)
-        return self._doc_ref
+        self._session.begin()
+        return self._session
 
     def __exit__(self, type, value, traceback):
-        write(self._doc_ref, self.filename)
+        if type is None:
+            self._session.save()
+        else:
+            self._session.abort()
+
+
+class EditSession(object):
+
+    def __init__(self, document, filename, edit_journal):
+        self.document = document
+        self.filename = filename
+
+        self._journal = edit_journal
+        self._index = None
+        self._used = None
+        self._changed = False
+        self._preamble_dirty = False
+        self._needs_rewrite = False
+
+        # Sections that must be serialized again and the original spans of
+        # any sections that were removed
+        self._dirty = set()
+        self._removed_spans = list()
+
+    def begin(self):
+        length = os.path.getsize(self.filename)
+        pending = self._journal.pending(self.filename, length)
+
+        self._journal.append(journal.OP_BEGIN, file=self.filename,
+                             length=length)
+
+        # Recover the edits of a session that never got to save
+        for entry in pending:
+            self.replay(entry)
+
+    def node(self, node_id):
+        if self._index is None:
+            self._index = dict((node.id, node) for node in _walk(
+                self.document.root))
+
+            # Every id taken, the way _claim_id keeps them
+            self._used = dict.fromkeys(self._index, 1)
+            self._used[self.document.root.id] = 1
+
+        return self._index.get(node_id)
+
+    def insert(self, parent, index, node):
+        parent = self._resolve(parent)
+
+        self._journal.append(journal.OP_INSERT, parent=parent.id, index=index,
+                             node=_node_entry(node))
+
+        parent.insert(index, node)
+
+        # Fix the ids of the new subtree now so that a replay sees the same.
+        # A node inserted before siblings of its kind would otherwise take
+        # the id one of them already has.
+        self.node(None)
+        node.id = _claim_id(self._used, node_id(node))
+        _assign_ids(node, self._used)
+
+        for child in _walk(node, include_root=True):
+            self._index[child.id] = child
+
+        self._mark(node)
+        return node
+
+    def append(self, parent, node):
+        parent = self._resolve(parent)
+        return self.insert(parent, len(parent.children), node)
+
+    def remove(self, node):
+        node = self._resolve(node)
+        self._journal.append(journal.OP_REMOVE, node=node.id)
+
+        self._mark(node)
+        node.parent.remove(node)
+
+        if self._index is not None:
+            for child in _walk(node, include_root=True):
+                self._index.pop(child.id, None)
+                self._used.pop(child.id, None)
+
+        source_map = self.document.source_map
+
+        if source_map is not None and node in source_map.sections:
+            self._removed_spans.append(source_map.sections[node])
+
+    def set_content(self, node, content):
+        node = self._resolve(node)
+
+        if node.kind != D_CONTENT and DIRECTIVE_END_CH in (content or ''):
+            raise DocumentError('Directive arguments may not span lines.')
+
+        self._journal.append(journal.OP_SET, node=node.id, content=content)
+
+        node.content = content
+        self._mark(node)
+
+    def replay(self, entry):
+        op = entry['op']
+
+        if op == journal.OP_INSERT:
+            self.insert(entry['parent'], entry['index'],
+                        _node_from_entry(entry['node']))
+        elif op == journal.OP_REMOVE:
+            self.remove(entry['node'])
+        elif op == journal.OP_SET:
+            self.set_content(entry['node'], entry['content'])
+
+    def save(self):
+        if not self._changed:
+            self._journal.append(journal.OP_SAVE, length=None)
+            return
+
+        if self._should_compact():
+            self.compact()
+            return
+
+        source_map = self.document.source_map
+        segments = self._segments()
+
+        _patch_file(self.filename, segments, source_map)
+
+        self._journal.append(journal.OP_SAVE, length=source_map.length)
+        self._reset()
+
+    def compact(self):
+        # Full rewrite through an atomic rename, after which the journal has
+        # nothing left worth keeping
+        self.document.source_map = write(self.document, self.filename)
+
+        self._journal.clear()
+        self._journal.append(journal.OP_BEGIN, file=self.filename,
+                             length=self.document.source_map.length)
+        self._journal.append(journal.OP_SAVE,
+                             length=self.document.source_map.length)
+        self._reset()
+
+    def abort(self):
+        self._journal.append(journal.OP_ABORT)
+
+    def _reset(self):
+        self._changed = False
+        self._preamble_dirty = False
+        self._needs_rewrite = False
+        self._dirty = set()
+        self._removed_spans = list()
+
+    def _resolve(self, node):
+        if isinstance(node, DocumentNode):
+            return node
+
+        resolved = self.node(node)
+
+        if resolved is None:
+            raise DocumentError('Node {} not found.'.format(node))
+
+        return resolved
+
+    def _mark(self, node):
+        self._changed = True
+
+        # Find the top level node that owns this change
+        top = node
+        while top.parent is not None and top.parent.kind != D_ROOT:
+            top = top.parent
+
+        if top.kind in TOP_LEVEL:
+            self._dirty.add(top)
+        elif top in _preamble(self.document):
+            self._preamble_dirty = True
+        else:
+            # Titles and authors hoisted out of a section have no span of
+            # their own to patch
+            self._needs_rewrite = True
+
+        if top.kind == D_TITLE or top.kind == D_AUTHOR:
+            self.document.sync_header()
+
+    def _should_compact(self):
+        source_map = self.document.source_map
+
+        if source_map is None or self._needs_rewrite:
+            return True
+
+        if (self._journal.size >= JOURNAL_COMPACT_BYTES or
+                self._journal.saves() >= JOURNAL_COMPACT_SAVES):
+            return True
+
+        # Re-serializing a section would drop any hoisted title or author
+        touched = [source_map.sections[section] for section in self._dirty
+                   if section in source_map.sections]
+        touched.extend(self._removed_spans)
+
+        for offset in source_map.hoisted:
+            for start, end in touched:
+                if start <= offset < end:
+                    return True
+
+        return False
+
+    def _segments(self):
+        # (old start, old end, new source or None, section) for every top
+        # level region in document order. Untouched regions keep their
+        # original bytes.
+        source_map = self.document.source_map
+        segments = list()
+
+        preamble_start, preamble_end = source_map.preamble
+
+        if self._preamble_dirty:
+            parts = _header_parts(self.document)
+
+            for node in _preamble(self.document):
+                _source_parts(node, parts)
+
+            segments.append((preamble_start, preamble_end, ''.join(parts),
+                             None))
+        else:
+            segments.append((preamble_start, preamble_end, None, None))
+
+        for section in self.document.root.children:
+            if section.kind not in TOP_LEVEL:
+                continue
+
+            span = source_map.sections.get(section)
+
+            if span is None or section in self._dirty:
+                segments.append((None, None, source(section), section))
+            else:
+                segments.append((span[0], span[1], None, section))
+
+        # Whatever followed a halt directive
+        segments.append((source_map.end, source_map.length, None, None))
+        return segments
+
+
+class SourceMap(object):
+
+    # Offsets of the top level regions of a document's source: everything
+    # before the first section, every section and the end of parsed content.
+    # Titles and authors found inside a section are recorded as hoisted.
+
+    def __init__(self, length):
+        self.length = length
+        self.end = None
+        self.preamble = [0, None]
+        self.sections = dict()
+        self.hoisted = list()
+        self._last = None
+
+    def open_section(self, node, offset):
+        self._close_last(offset)
+        self.sections[node] = [offset, None]
+        self._last = node
+
+    def hoist(self, offset):
+        if self._last is not None:
+            self.hoisted.append(offset)
+
+    def close(self, end=None):
+        if self.end is None:
+            self.end = end if end is not None else self.length
+            self._close_last(self.end)
+
+        return self
+
+    def _close_last(self, offset):
+        if self._last is None:
+            self.preamble[1] = offset
+        else:
+            self.sections[self._last][1] = offset
+
+
+class _Unmapped(object):
+
+    # Stands in for a SourceMap while building a document that has no
+    # single source to map
+
+    def hoist(self, offset):
+        pass
+
+    def open_section(self, node, offset):
+        pass
+
+    def close(self, end=None):
+        return None
+
+
+_UNMAPPED = _Unmapped()
 
 
 class DocumentNode(object):
 
+    __slots__ = ('kind', 'parent', '_content', '_id', '_hash', '_children',
+                 '_loader')
+
     def __init__(self, kind=None, content=None):
-        self.id = str(uuid.uuid4())
         self.kind = kind
         self.parent = None
-        self.content = content
-        self._children = list()
+        self._content = content
+        self._id = None
+        self._hash = None
+
+        # Most nodes never have children so they all share one empty tuple
+        # until the first child is added
+        self._children = _NO_CHILDREN
+
+        # Sections of a lazily read document are only built when their
+        # children are first needed
+        self._loader = None
+
+    @property
+    def id(self):
+        if self._id is None and self.parent is not None:
+            # Nodes that haven't been through Document.assign_ids get their
+            # path derived id without collision handling
+            self._id = node_id(self)
+
+        return self._id
+
+    @id.setter
+    def id(self, value):
+        self._id = value
+
+    @property
+    def content(self):
+        content = self._content
+
+        # Content read as a view is only turned into a string on request
+        if type(content) is ContentView:
+            return content.text()
+
+        return content
+
+    @content.setter
+    def content(self, value):
+        self._content = value
+        self.invalidate()
+
+    @property
+    def hash(self):
+        # Structural (merkle) hash of this node and everything beneath it.
+        # Identical subtrees always share a hash regardless of position.
+        if self._hash is None:
+            self._hash = merkle_hash(self.kind, self.content, self.children)
+
+        return self._hash
 
     @property
     def children(self):
+        if self._loader is not None:
+            self._loader.load(self)
+
         return self._children
 
+    def invalidate(self):
+        # Drop cached hashes up to the root; anything that modifies the
+        # children list directly must call this itself
+        node = self
+
+        while node is not None and node._hash is not None:
+            node._hash = None
+            node = node.parent
+
     def append(self, child_element):
         # Let the child know that we're its parent
         child_element.parent = self
 
         # Actually link it
-        self._children.append(child_element)
+        self._own_children().append(child_element)
+        self.invalidate()
 
-    def find(self, kind, content=None):
-        return find(self, kind, content)
+    def insert(self, index, child_element):
+        child_element.parent = self
 
-    def __str__(self):
-        str_content = ''
+        self._own_children().insert(index, child_element)
+        self.invalidate()
+
+    def remove(self, child_element):
+        self._own_children().remove(child_element)
+        self.invalidate()
 
-        if self.kind is not None:
-            str_content += '{}{}'.format(DIRECTIVE_CH, escape_str(self.kind))
+    def _own_children(self):
+        children = self.children
 
-            if self.content is not None:
-                str_content += ' {}'.format(escape_str(self.content))
+        if children is _NO_CHILDREN:
+            children = self._children = list()
+
+        return children
+
+    def find(self, kind, content=None):
+        return find(self, kind, content)
 
-            str_content += '{}'.format(DIRECTIVE_END_CH)
+    def __str__(self):
+        # Just this node's own line of source, without its children
+        if self.kind is None or self.kind == D_ROOT:
+            return ''
 
-        return str_content
+        return _node_source(self.kind, self.content)
 
 
 class Document(object):
 
     def __init__(self):
         self.root = DocumentNode(D_ROOT, '')
+        self.root.id = D_ROOT
         self.title = None
         self.authors = list()
+        self.source_map = None
+
+        # The StringPool parsing shared repeated strings through, if any
+        self.strings = None
+
+        # Every file a document composed with @include was read from, the
+        # entry point first. None for a document read from a single source.
+        self.files = None
 
     @property
     def sections(self):
         for sec in find(self.root, D_SECTION):
             yield sec
 
+    def sync_header(self):
+        # Titles and authors always live directly under the root
+        self.title = None
+        self.authors = list()
+
+        for node in self.root.children:
+            if node.kind == D_TITLE:
+                self.title = node.content
+            elif node.kind == D_AUTHOR:
+                self.authors.append(node.content)
+
+    def assign_ids(self):
+        # Walk in document order so that colliding ids are always suffixed
+        # the same way
+        _assign_ids(self.root, dict.fromkeys([self.root.id], 1))
+
 
 class DocumentBuilder(object):
 
-    def __init__(self, root):
-        self._doc = Document()
+    def __init__(self, document=None):
+        self._doc = document if document is not None else Document()
 
         self._build_stack = list()
         self._current = self._doc.root
@@ -197,15 +720,85 @@ class DocumentBuilder(object):
         # Deref the current object and move to what's on the stack
         self._current = self._build_stack.pop()
 
+    def resume(self, node):
+        # Carry on building beneath a node that is already in the tree
+        ancestors = list()
+        parent = node.parent
+
+        while parent is not None:
+            ancestors.append(parent)
+            parent = parent.parent
+
+        self._build_stack = list(reversed(ancestors))
+        self._current = node
+
     def exit_if(self, *args):
         if self._current.kind in args:
             self.exit()
 
     def exit_to(self, kind):
         while self._current.kind != kind:
+            if len(self._build_stack) == 0:
+                raise DocumentParsingError('Expected to be inside a @{}.'.format(
+                    kind))
+
             self.exit()
 
 
+class StringPool(object):
+
+    # Hands out one copy of every distinct string it's given so repeated
+    # arguments and content, e.g. '@cost 1' or a mechanic's name, are only
+    # held once however often they appear. Directive words always come back
+    # as the grammar's own constants.
+
+    def __init__(self):
+        self.shared = 0
+        self.saved_bytes = 0
+
+        self._strings = dict(_KINDS)
+
+    def share(self, value):
+        strings = self._strings
+
+        if strings is None:
+            return value
+
+        pooled = strings.setdefault(value, value)
+
+        if pooled is not value:
+            self.shared += 1
+            self.saved_bytes += sys.getsizeof(value)
+
+        return pooled
+
+    def close(self):
+        # The counts stay, the strings held only for sharing are let go
+        self._strings = None
+
+
+class ContentView(object):
+
+    # Content as a span of the source it was read from. Escapes are only
+    # processed when the source span actually contains any.
+
+    __slots__ = ('source', 'start', 'end', 'escaped')
+
+    def __init__(self, source, start, end, escaped=False):
+        self.source = source
+        self.start = start
+        self.end = end
+        self.escaped = escaped
+
+    def text(self):
+        text = self.source[self.start:self.end]
+
+        if self.escaped:
+            return _unescape(text).strip()
+
+        return text
+
+
 class Token(object):
 
     def __init__(self, kind):
@@ -224,216 +817,1387 @@ class ContentToken(Token):
 
 class DirectiveToken(Token):
 
-    def __init__(self, directive, arguments=None):
+    def __init__(self, directive, arguments=None, offset=None):
         super(DirectiveToken, self).__init__(DIRECTIVE_TOKEN)
         self.directive = directive
         self.arguments = arguments or ''
+        self.offset = offset
 
     def __str__(self):
         return 'Command Token: {}, Args: {}'.format(
             self.directive, self.arguments)
 
 
-def escape_str(source):
-    return source.replace('\\', '\\\\').replace('|', '\\|')
+def register_directive(kind, exits_to=None, closes=(), opens=False,
+                       inside=(), accepts=()):
+    # Adds a house rule directive to the grammar without touching the parser.
+    # inside and accepts name the kinds it may be placed in and the kinds
+    # that may be placed in it.
+    if not kind or _WORD_UNSAFE_REGEX.search(kind) is not None:
+        raise DocumentError('Invalid directive word: {}'.format(kind))
 
+    if kind in DIRECTIVES:
+        raise DocumentError('Directive @{} is already defined.'.format(kind))
 
-def edit(doc_filename):
-    return DocumentContext(doc_filename)
+    if exits_to is not None and exits_to != D_ROOT and exits_to not in \
+            D_ELEMENTS:
+        raise DocumentError('Directive @{} can not exit to @{}, it never '
+                            'opens a scope.'.format(kind, exits_to))
 
+    for word in list(inside) + list(accepts):
+        if word not in DIRECTIVES:
+            raise DocumentError('Unknown directive @{} in the placement of '
+                                '@{}.'.format(word, kind))
 
-def write(document, doc_filename):
-    with open(doc_filename, 'w') as fout:
-        for node in document:
-            node_contents = str(node)
-            fout.write(str(node_contents))
+    D_WORDS.append(kind)
 
+    if (exits_to is not None or len(closes) > 0 or opens or
+            len(inside) > 0 or len(accepts) > 0):
+        GRAMMAR[kind] = {
+            'exits_to': exits_to,
+            'closes': list(closes),
+            'opens': opens,
+            'inside': list(inside),
+            'accepts': list(accepts)
+        }
 
-def read(doc_filename):
-    if not os.path.exists(doc_filename):
-        raise DocumentError('File {} not found!'.format(doc_filename))
+    _compile_grammar()
 
-    if  os.path.getsize(doc_filename) >= (MAX_DOC_SIZE_MB * MB_IN_BYTES):
-        raise DocumentError('File is too large to read. Maximum file  size'
-                            ' supported is {} MB.'.format(MAX_DOC_SIZE_MB))
 
-    document = None
-    doc_contents = _read_file(doc_filename)
+def node_id(node, ordinal=None):
+    parent = node.parent
 
-    if doc_contents is not None:
-        _LOG.info('Read {} Bytes.\n'.format(len(doc_contents)))
-        document = _parse(doc_contents)
+    if ordinal is None and node.kind not in D_ELEMENTS:
+        ordinal = 0
 
-    return document
+        for sibling in parent.children if parent is not None else (node,):
+            if sibling.kind == node.kind:
+                ordinal += 1
 
+            if sibling is node:
+                break
 
-def find(root, kind, content=None):
-    cursor_stack = [(0, root)]
+    return child_id(parent, node.kind, node.content, ordinal)
 
-    while len(cursor_stack) > 0:
-        # Unpack where we left off
-        cursor_idx, next_obj = cursor_stack.pop()
 
-        if cursor_idx < len(next_obj.children):
-            # Push where we want to pick up next
-            cursor_stack.append((cursor_idx + 1, next_obj))
+def child_id(parent, kind, content, ordinal=None):
+    # The id a node of this kind and content gets beneath parent, where
+    # ordinal is its position amongst its siblings of the same kind
+    at_root = parent is None or parent.kind == D_ROOT
 
-            # Pick up the child node of interest
-            node = next_obj.children[cursor_idx]
+    if kind in D_ELEMENTS:
+        # Named elements are identified by the kinds of the elements they
+        # are nested in and their own name, e.g. section/ability/lockpick
+        slug = _ID_UNSAFE_REGEX.sub('-', (content or '').lower())
+        slug = slug.strip('-') or kind
 
-            # Is the node the kind that we're looking for?
-            if node.kind == kind:
-                # Filter if we're trying to match content too
-                if content is not None:
-                    if content == node.content:
-                        yield node
-                else:
-                    yield node
+        if at_root:
+            return ID_SEPARATOR.join((kind, slug))
 
-            # Does the node have children to iterate through?
-            if len(node.children) > 0:
-                cursor_stack.append((0, node))
+        kind_path = parent.id.rsplit(ID_SEPARATOR, 1)[0]
+        return ID_SEPARATOR.join((kind_path, kind, slug))
 
-        # In the case where we run out of children we simply pass through
-        # and iterate through the loop
+    # Everything else is numbered amongst its siblings of the same kind
+    segment = ID_SUFFIX.format(kind, ordinal)
 
+    if at_root:
+        return segment
 
-def _matches_spec(node, node_spec, case_insensitive):
-    content = node.content or ''
-    formatted = content if not case_insensitive else content.lower()
+    return ID_SEPARATOR.join((parent.id, segment))
 
-    return fnmatch.fnmatchcase(formatted, node_spec)
 
+def merkle_hash(kind, content, children):
+    # Structural hash over a node's own kind and content and the hashes of
+    # its children
+    digest = hashlib.sha1(compat.to_bytes(
+        '{}\0{}\0'.format(kind, content or '')))
 
-def _parse(content):
-    doc_builder = DocumentBuilder(DocumentNode(D_ROOT, ''))
-
-    for node in _tokenize_content(content):
-        if node.kind == D_SECTION:
-            # Jump all the way back to the root
-            doc_builder.exit_to(D_ROOT)
-            doc_builder.enter(node)
-        elif node.kind == D_FEATURE:
-            # Jump to the parent section
-            doc_builder.exit_to(D_SECTION)
-            doc_builder.enter(node)
-        elif node.kind == D_EFFECT:
-            # Jump to the parent section
-            doc_builder.exit_to(D_SECTION)
-            doc_builder.enter(node)
-        elif node.kind == D_ABILITY:
-            # Jump to the parent section
-            doc_builder.exit_to(D_SECTION)
-            doc_builder.enter(node)
-        elif node.kind == D_ASPECT:
-            # Jump to the parent section
-            doc_builder.exit_to(D_SECTION)
-            doc_builder.enter(node)
-        elif node.kind == D_MECHANIC:
-            # Exit if this is another mechanic in a series
-            doc_builder.exit_if(D_MECHANIC)
-            doc_builder.enter(node)
-        elif node.kind == D_AUTHOR:
-            # Add this author to the list of authors
-            doc_builder.add_author(node.content)
-        elif node.kind == D_TITLE:
-            # Set the title of the document
-            doc_builder.set_title(node.content)
-        else:
-            # Simply append this node in-place
-            doc_builder.append_node(node)
+    for child in children:
+        digest.update(compat.to_bytes(child.hash))
 
-    # Return to the root and then return the built document
-    doc_builder.exit_to(D_ROOT)
-    return doc_builder.document
+    return digest.hexdigest()
 
 
-def _tokenize_content(content):
-    state = ST_NEXT
+def escape_str(source):
+    # Only the escape and directive characters are special to the tokenizer.
+    # Two replace calls measure faster than a single translate or regex pass
+    # since both stay in C and skip strings without either character.
+    return source.replace(ESCAPE_CH, _ESCAPED_ESCAPE_CH).replace(
+        DIRECTIVE_CH, _ESCAPED_DIRECTIVE_CH)
 
-    for token in _tokenize(content):
-        node = None
 
-        if token.kind == DIRECTIVE_TOKEN:
-            if token.directive == D_HALT:
-                # Halt processing of the content
-                break
-            elif token.directive in D_WORDS:
-                node = DocumentNode(token.directive, token.arguments)
-            else:
-                # Don't know this command chief
-                raise DocumentParsingError('Unknown directive: {}'.format(
-                    token.directive))
-        else:
-            node = DocumentNode(D_CONTENT, token.content)
+def source(node):
+    # The .nd source for a node and everything beneath it
+    parts = list()
+    _source_parts(node, parts)
+    return ''.join(parts)
 
-        # If a node has been set, save it to our list of nodes that represents
-        # the document
-        if node is not None:
-            yield node
 
+def dump(document, stream):
+    # Serialize a whole document to a file-like object in a single walk,
+    # returning the source map of what was written
+    source_map = SourceMap(0)
+    header = ''.join(_header_parts(document))
+    stream.write(header)
+    offset = len(header)
 
-def _tokenize(content):
-    ch_buff = ''
-    state = TK_START
-    escaped = False
+    parts = list()
 
-    for next_ch in content:
-        token = None
+    # One write per top level node, leaving small writes to the buffering
+    for node in document.root.children:
+        if node.kind in TOP_LEVEL:
+            source_map.open_section(node, offset)
+        elif node.kind in HEADERS:
+            source_map.hoist(offset)
 
-        if state == TK_START:
-            state = TK_CONTENT
+        _source_parts(node, parts)
+        chunk = ''.join(parts)
+        del parts[:]
 
-        if state == TK_CONTENT:
-            if escaped:
-                ch_buff += next_ch
-                escaped = False
-            else:
-                if next_ch == DIRECTIVE_CH:
-                    token = _parse_content(ch_buff)
+        stream.write(chunk)
+        offset += len(chunk)
 
-                    state = TK_DIRECTIVE
-                    ch_buff = ''
-                elif next_ch == ESCAPE_CH:
-                    escaped = True
-                else:
-                    ch_buff += next_ch
+    source_map.length = offset
+    return source_map.close()
 
-        elif state == TK_DIRECTIVE:
-            if next_ch == DIRECTIVE_END_CH:
-                token = _parse_directive(ch_buff)
 
-                state = TK_CONTENT
-                ch_buff = ''
-            else:
-                ch_buff += next_ch
+def dumps(document):
+    stream = compat.StringIO()
+    dump(document, stream)
+    return stream.getvalue()
 
-        if token is not None:
-            yield token
 
-    if state == TK_CONTENT:
-        if len(ch_buff) > 0:
-            yield _parse_content(ch_buff)
-    else:
-        raise DocumentParsingError('Illegal end state for parsing: {}'.format(
-            state))
+def edit(doc_filename, journal_file=None):
+    return DocumentContext(doc_filename, journal_file)
+
 
+def write(document, doc_filename):
+    # Write next to the target and rename over it so readers only ever see
+    # the old or the new document
+    doc_dir = os.path.dirname(os.path.abspath(doc_filename))
+    fd, tmp_path = compat.mkstemp(doc_dir, '.nd-')
 
-def _parse_content(content):
-    clean_content = content.strip()
+    # The document keeps the mode it had
+    try:
+        mode = stat.S_IMODE(os.stat(doc_filename).st_mode)
+    except OSError:
+        mode = None
 
-    if len(clean_content) > 0:
-        return ContentToken(clean_content)
-    return None
+    try:
+        with os.fdopen(fd, 'w', WRITE_BUFFER_BYTES) as fout:
+            source_map = dump(document, fout)
 
+            fout.flush()
+            os.fsync(fout.fileno())
 
-def _parse_directive(content):
-    split_content = content.split(' ', 1)
+        if mode is not None:
+            os.chmod(tmp_path, mode)
 
-    if len(split_content) == 1:
-        return DirectiveToken(split_content[0])
-    else:
-        return DirectiveToken(split_content[0], split_content[1])
+        os.rename(tmp_path, doc_filename)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+    return source_map
+
+
+def read(doc_filename, lazy=False, views=False, jobs=1):
+    document = None
+
+    with memprofile.phase(memprofile.READ):
+        doc_contents = read_source(doc_filename)
+
+    if doc_contents is not None:
+        _LOG.info('Read {} Bytes.\n'.format(len(doc_contents)))
+
+        # Composed documents are always built whole, from plain strings, as
+        # their sections may come from any of the files
+        if has_includes(doc_contents):
+            return _read_composed(doc_filename, doc_contents, jobs)
+
+        document = parse(doc_contents, lazy, views, jobs)
+
+    return document
+
+
+def has_includes(doc_contents):
+    return next(directive_offsets(doc_contents, D_INCLUDE), None) is not None
+
+
+def include_path(path, arguments):
+    # Included files are named relative to the file including them
+    if not arguments.strip():
+        raise DocumentParsingError('{}: @include needs a file to '
+                                   'include.'.format(path))
+
+    return os.path.normpath(os.path.join(
+        os.path.dirname(path), arguments.strip()))
+
+
+def included_files(doc_filename):
+    # Every file a document includes, directly or through another included
+    # file, found by searching their sources rather than parsing them, as a
+    # part may only make sense in the place it's included. Files that can't
+    # be found are left to reading the document to report.
+    entry = os.path.normpath(doc_filename)
+    found = list()
+    pending = [entry]
+
+    while len(pending) > 0:
+        path = pending.pop()
+
+        if not os.path.isfile(path):
+            continue
+
+        content = read_source(path)
+
+        for offset in directive_offsets(content, D_INCLUDE):
+            line_end = content.find(DIRECTIVE_END_CH, offset)
+
+            if line_end < 0:
+                line_end = len(content)
+
+            try:
+                child = include_path(path, _parse_directive(
+                    content[offset + 1:line_end]).arguments)
+            except DocumentParsingError:
+                continue
+
+            if child != entry and child not in found:
+                found.append(child)
+                pending.append(child)
+
+    return found
+
+
+def directive_offsets(content, word, start=0, end=None):
+    # Offsets of every @word directive between start and end, leaving out
+    # escaped ones and ones inside another directive's line
+    needle = DIRECTIVE_CH + word
+    end = len(content) if end is None else end
+    offset = content.find(needle, start, end)
+
+    while offset >= 0:
+        word_end = offset + len(needle)
+
+        if (content[word_end:word_end + 1] in (' ', DIRECTIVE_END_CH) and
+                _starts_directive(content, offset)):
+            yield offset
+
+        offset = content.find(needle, word_end, end)
+
+
+def parse(doc_contents, lazy=False, views=False, jobs=1):
+    # Lazily parsed documents only build the body of a section when its
+    # children are first touched. With views, content nodes refer back into
+    # doc_contents and only build their text when it's asked for.
+    if lazy:
+        with memprofile.phase(memprofile.BUILD):
+            return _parse_lazy(doc_contents, views)
+
+    # Sections always start back at the root so once they've been found
+    # their bodies can be built by separate processes. A jobs of None uses
+    # every CPU.
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+
+    if jobs > 1 and len(doc_contents) >= PARALLEL_MIN_BYTES:
+        with memprofile.phase(memprofile.BUILD):
+            return _parse_parallel(doc_contents, views, jobs)
+
+    return _parse(doc_contents, views)
+
+
+def read_source(doc_filename):
+    if not os.path.exists(doc_filename):
+        raise DocumentError('File {} not found!'.format(doc_filename))
+
+    if  os.path.getsize(doc_filename) >= (MAX_DOC_SIZE_MB * MB_IN_BYTES):
+        raise DocumentError('File is too large to read. Maximum file  size'
+                            ' supported is {} MB.'.format(MAX_DOC_SIZE_MB))
+
+    return _read_file(doc_filename)
+
+
+def find(root, kind, content=None):
+    # Parsed nodes all share the grammar's copy of their kind, which
+    # compares equal without looking at the characters
+    kind = _KINDS.get(kind, kind)
+
+    # Top level elements and headers only ever live directly beneath the
+    # root, so there's no need to descend (or load lazy sections) for them
+    if root.kind == D_ROOT and (kind in TOP_LEVEL or kind in HEADERS):
+        return (node for node in root.children if node.kind == kind and (
+            content is None or content == node.content))
+
+    return _find(root, kind, content)
+
+
+def scan_directives(section, kind):
+    # The arguments of every @kind directive beneath a top level section in
+    # document order. Sections of a lazily read document that haven't been
+    # built are searched in the source rather than being built.
+    loader = section._loader
+
+    if loader is None:
+        return [node.content for node in _find(section, kind, None)]
+
+    content = loader.content
+    found = list()
+
+    for start, end in loader._spans[section]:
+        for offset in directive_offsets(content, kind, start, end):
+            line_end = content.find(DIRECTIVE_END_CH, offset, end)
+
+            # Parsing the section would fail on a directive left unfinished
+            if line_end < 0:
+                break
+
+            found.append(_parse_directive(
+                content[offset + 1:line_end]).arguments)
+
+    return found
+
+
+def detached_section(section):
+    # A copy of a top level section with its body built, leaving the
+    # document it came from as it was. Sections of a lazily read document
+    # are otherwise only built in document order; a copy built on its own
+    # only suffixes ids that collide within the section itself.
+    copy = DocumentNode(section.kind, section._content)
+    copy.id = section.id
+
+    loader = section._loader
+
+    if loader is None:
+        for child in section.children:
+            copy.append(_copy(child))
+
+        return copy
+
+    # Scopes close exactly as they would beneath the real root
+    copy.parent = DocumentNode(D_ROOT)
+
+    doc_builder = DocumentBuilder()
+    doc_builder.resume(copy)
+
+    for start, end in loader._spans[section]:
+        _build(doc_builder, _tokenize_content(
+            loader.content, start, end, loader.views, loader.pool))
+
+    copy.parent = None
+    _assign_ids(copy, dict.fromkeys([D_ROOT, copy.id], 1))
+    return copy
+
+
+def is_escaped(content, offset, content_start=0):
+    # A directive character is escaped by an odd run of escape characters
+    escapes = 0
+
+    while (offset - escapes > content_start and
+           content[offset - escapes - 1] == ESCAPE_CH):
+        escapes += 1
+
+    return escapes % 2 == 1
+
+
+def _find(root, kind, content):
+    cursor_stack = [(0, root)]
+
+    while len(cursor_stack) > 0:
+        # Unpack where we left off
+        cursor_idx, next_obj = cursor_stack.pop()
+
+        if cursor_idx < len(next_obj.children):
+            # Push where we want to pick up next
+            cursor_stack.append((cursor_idx + 1, next_obj))
+
+            # Pick up the child node of interest
+            node = next_obj.children[cursor_idx]
+
+            # Is the node the kind that we're looking for?
+            if node.kind == kind:
+                # Filter if we're trying to match content too
+                if content is not None:
+                    if content == node.content:
+                        yield node
+                else:
+                    yield node
+
+            # Does the node have children to iterate through?
+            if len(node.children) > 0:
+                cursor_stack.append((0, node))
+
+        # In the case where we run out of children we simply pass through
+        # and iterate through the loop
+
+
+def _matches_spec(node, node_spec, case_insensitive):
+    content = node.content or ''
+    formatted = content if not case_insensitive else content.lower()
+
+    return fnmatch.fnmatchcase(formatted, node_spec)
+
+
+def _parse(content, views=False):
+    doc_builder = DocumentBuilder()
+    source_map = SourceMap(len(content))
+    pool = _string_pool()
+    nodes = _tokenize_content(content, views=views, pool=pool)
+
+    # Tokens are normally built as they're produced. A memory profile needs
+    # them all up front to tell the two phases apart.
+    if memprofile.active():
+        with memprofile.phase(memprofile.TOKENIZE):
+            nodes = list(nodes)
+
+    with memprofile.phase(memprofile.BUILD):
+        _build(doc_builder, nodes, source_map)
+
+        # Return to the root and then return the built document
+        doc_builder.exit_to(D_ROOT)
+        doc_builder.document.assign_ids()
+        doc_builder.document.source_map = source_map.close()
+
+    _close_pool(doc_builder.document, pool)
+    return doc_builder.document
+
+
+def _build(doc_builder, nodes, source_map=None):
+    # Without a source map headers are skipped as they've already been
+    # hoisted. The dispatch table and builder operations are bound once,
+    # they're used for every node.
+    dispatch = _DISPATCH
+    append_node = doc_builder.append_node
+    enter = doc_builder.enter
+
+    for offset, node in nodes:
+        if node is None:
+            # Everything past a halt is left untouched
+            source_map.close(offset)
+            break
+
+        kind = node.kind
+        rule = dispatch.get(kind)
+
+        if rule is None:
+            # Simply append this node in-place
+            append_node(node)
+            continue
+
+        exits_to, closes, opens, header = rule
+
+        if header:
+            # Titles and authors are hoisted to the root
+            if source_map is not None:
+                source_map.hoist(offset)
+                _add_header(doc_builder, node)
+
+            continue
+
+        if exits_to is not None:
+            doc_builder.exit_to(exits_to)
+
+            if exits_to == D_ROOT and source_map is not None:
+                source_map.open_section(node, offset)
+
+        if closes:
+            doc_builder.exit_if(*closes)
+
+        if opens:
+            enter(node)
+        else:
+            append_node(node)
+
+
+def _add_header(doc_builder, node):
+    if node.kind == D_TITLE:
+        doc_builder.set_title(node.content)
+    else:
+        doc_builder.add_author(node.content)
+
+
+def _read_composed(doc_filename, content, jobs):
+    # A document made of its entry file with every @include replaced by the
+    # file it names, relative to the including file. Each file is tokenized
+    # on its own, or taken from the token cache, and the tokens are then
+    # built as one stream so scopes carry on across files as though the
+    # text had been written in place. A halt only ends the file it's in.
+    entry = os.path.normpath(doc_filename)
+    rows = dict()
+    files = list()
+    level = [(entry, content)]
+
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+
+    with memprofile.phase(memprofile.TOKENIZE):
+        while len(level) > 0:
+            _tokenize_files(level, rows, jobs)
+            files.extend(path for path, content in level)
+
+            included = list()
+
+            for path, content in level:
+                for kind, arguments in rows[path]:
+                    if kind != D_INCLUDE:
+                        continue
+
+                    child = include_path(path, arguments)
+
+                    if child not in rows and child not in [
+                            path for path, content in included]:
+                        with memprofile.phase(memprofile.READ):
+                            included.append((child, read_source(child)))
+
+            level = included
+
+    doc_builder = DocumentBuilder()
+    pool = _string_pool()
+
+    with memprofile.phase(memprofile.BUILD):
+        _build(doc_builder, _spliced(entry, rows, pool, (entry,)),
+               _UNMAPPED)
+
+        doc_builder.exit_to(D_ROOT)
+        doc_builder.document.assign_ids()
+
+    doc_builder.document.files = files
+    _close_pool(doc_builder.document, pool)
+    return doc_builder.document
+
+
+def _tokenize_files(files, rows, jobs):
+    # Fills in the rows of every (path, content) in files from the cache,
+    # tokenizing the rest across a pool of workers when there's enough
+    pending = list()
+
+    for path, content in files:
+        key = '{}-{}'.format(hashlib.sha1(content).hexdigest(),
+                             TOKEN_CACHE_VERSION)
+        cached = _cached_rows(key)
+
+        if cached is not None:
+            rows[path] = cached
+        else:
+            pending.append((path, content, key))
+
+    contents = [content for path, content, key in pending]
+
+    if (jobs > 1 and len(pending) > 1 and
+            sum(len(content) for content in contents) >= PARALLEL_MIN_BYTES):
+        pool = multiprocessing.Pool(min(jobs, len(pending)), memprofile.detach)
+
+        try:
+            results = pool.map(_tokenize_file, contents)
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        results = [_tokenize_file(content) for content in contents]
+
+    for (path, content, key), (file_rows, failure) in zip(pending, results):
+        if failure is not None:
+            raise DocumentParsingError('{}: {}'.format(path, failure))
+
+        rows[path] = file_rows
+        _cache_rows(key, file_rows)
+
+    if len(pending) > 0 and os.path.isdir(config.TOKENS_DIR):
+        _prune_cache()
+
+
+def _tokenize_file(content):
+    # (kind, content) rows for one file of a composed document along with
+    # the failure's message, as exceptions don't come back from a worker
+    # intact
+    rows = list()
+
+    try:
+        for token in _tokenize(content):
+            if token.kind != DIRECTIVE_TOKEN:
+                rows.append((D_CONTENT, token.content))
+            elif token.directive == D_HALT:
+                break
+            elif token.directive in DIRECTIVES:
+                rows.append((token.directive, token.arguments))
+            else:
+                raise DocumentParsingError('Unknown directive: {}'.format(
+                    token.directive))
+    except DocumentParsingError as ex:
+        return None, ex.msg
+
+    return rows, None
+
+
+def _cached_rows(key):
+    path = os.path.join(config.TOKENS_DIR, key)
+
+    if not os.path.isfile(path):
+        return None
+
+    try:
+        with open(path, 'rb') as fin:
+            rows = marshal.load(fin)
+
+        # Marks the entry as still in use
+        os.utime(path, None)
+        return rows
+    except (EOFError, ValueError, TypeError, OSError):
+        # The cache can always be rebuilt
+        return None
+
+
+def _cache_rows(key, rows):
+    # Only workspaces have somewhere to keep the cache
+    if not os.path.isdir(os.path.dirname(config.TOKENS_DIR)):
+        return
+
+    try:
+        os.mkdir(config.TOKENS_DIR)
+    except OSError as ex:
+        if ex.errno != errno.EEXIST:
+            raise
+
+    fd, tmp_path = tempfile.mkstemp(dir=config.TOKENS_DIR, prefix='.')
+
+    try:
+        with os.fdopen(fd, 'wb') as fout:
+            marshal.dump(rows, fout)
+
+        os.rename(tmp_path, os.path.join(config.TOKENS_DIR, key))
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def _prune_cache():
+    cutoff = time.time() - TOKEN_CACHE_SECONDS
+
+    for name in os.listdir(config.TOKENS_DIR):
+        path = os.path.join(config.TOKENS_DIR, name)
+
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            # Another process got to it first
+            continue
+
+
+def _spliced(path, rows, pool, including):
+    # (offset, node) for every row of path with included files' rows in
+    # place of their @include, the way _tokenize_content hands them out
+    share = pool.share if pool is not None else _unshared
+
+    for kind, content in rows[path]:
+        if kind != D_INCLUDE:
+            yield None, DocumentNode(share(kind), share(content))
+            continue
+
+        child = include_path(path, content)
+
+        if child in including:
+            raise DocumentParsingError('{} includes itself through {}.'.format(
+                child, path))
+
+        for item in _spliced(child, rows, pool, including + (child,)):
+            yield item
+
+
+def _parse_lazy(content, views=False):
+    return _parse_sections(content, views)[0]
+
+
+def _parse_parallel(content, views, jobs):
+    document, loader = _parse_sections(content, views)
+    loader.load_all(jobs)
+    return document
+
+
+def _parse_sections(content, views=False):
+    # Builds the preamble, headers and top level elements of a document and
+    # returns it along with the loader for the section bodies
+    document = Document()
+    doc_builder = DocumentBuilder(document)
+    source_map = SourceMap(len(content))
+    loader = _SectionLoader(document, content, views)
+
+    section = None
+    position = 0
+
+    # Only the directives that shape the root are parsed up front. The text
+    # between them belongs to the preamble, which is built straight away,
+    # or to the section before it, which is built when first needed.
+    for offset, line_end, kind, arguments in _scan_top_level(content):
+        if section is None:
+            _build(doc_builder, _tokenize_content(
+                content, position, offset, views, loader.pool))
+        else:
+            loader.add_span(section, position, offset)
+
+        if kind == D_HALT:
+            source_map.close(offset)
+            position = None
+            break
+
+        node = DocumentNode(kind, loader.share(arguments))
+
+        if kind in HEADERS:
+            source_map.hoist(offset)
+            _add_header(doc_builder, node)
+        else:
+            source_map.open_section(node, offset)
+            document.root.append(node)
+            loader.add(node)
+            section = node
+
+        position = line_end + 1
+
+    if position is not None:
+        if section is None:
+            _build(doc_builder, _tokenize_content(
+                content, position, views=views, pool=loader.pool))
+        else:
+            loader.add_span(section, position, len(content))
+
+    _assign_ids(document.root, loader.used)
+    document.source_map = source_map.close()
+    loader.check_loaded()
+    return document, loader
+
+
+def _scan_top_level(content):
+    # (offset, line end, kind, arguments) of every top level element and
+    # header up to the first halt, in document order. Only occurrences of
+    # those words are examined so this costs little more than a str.find
+    # per word.
+    found = list()
+
+    for kind in TOP_LEVEL | HEADERS | frozenset([D_HALT]):
+        needle = DIRECTIVE_CH + kind
+        offset = content.find(needle)
+
+        while offset >= 0:
+            line_end = content.find(DIRECTIVE_END_CH, offset)
+            directive_end = line_end if line_end >= 0 else len(content)
+
+            word, separator, arguments = content[
+                offset + 1:directive_end].partition(' ')
+
+            if word == kind and _starts_directive(content, offset):
+                found.append((offset, line_end, kind, arguments))
+
+            offset = content.find(needle, offset + 1)
+
+    found.sort()
+
+    for idx, entry in enumerate(found):
+        if entry[1] < 0:
+            raise DocumentParsingError('Illegal end state for parsing: '
+                                       '{}'.format(TK_DIRECTIVE))
+
+        if entry[2] == D_HALT:
+            # Nothing after a halt is part of the document
+            del found[idx + 1:]
+            break
+
+    return found
+
+
+def _starts_directive(content, offset):
+    # Lines always begin outside of a directive, so a directive character
+    # starts one unless it's escaped or an earlier directive on the same
+    # line runs over it
+    line_start = content.rfind(DIRECTIVE_END_CH, 0, offset) + 1
+    earlier = content.find(DIRECTIVE_CH, line_start, offset)
+
+    while earlier >= 0:
+        if not is_escaped(content, earlier, line_start):
+            return False
+
+        earlier = content.find(DIRECTIVE_CH, earlier + 1, offset)
+
+    return not is_escaped(content, offset, line_start)
+
+
+class _SectionLoader(object):
+
+    # Builds the bodies of a lazily parsed document's sections. Sections are
+    # always built in document order so their node ids come out exactly as
+    # a full parse would assign them.
+
+    def __init__(self, document, content, views=False):
+        self.document = document
+        self.content = content
+        self.views = views
+        self.used = dict.fromkeys([D_ROOT], 1)
+        self.pool = _string_pool()
+        self.share = self.pool.share if self.pool is not None else _unshared
+        self._pending = collections.deque()
+        self._spans = dict()
+
+    def add(self, section):
+        section._loader = self
+        self._pending.append(section)
+        self._spans[section] = list()
+
+    def add_span(self, section, start, end):
+        if end > start:
+            self._spans[section].append((start, end))
+
+    def load(self, section):
+        while section._loader is not None:
+            self._build(self._pending.popleft())
+
+    def load_all(self, jobs):
+        # Builds every pending section across a pool of worker processes.
+        # Workers fork with the source already in memory and send back each
+        # body as flat rows, which are attached and given ids in document
+        # order here.
+        sections = list(self._pending)
+
+        if len(sections) == 0:
+            return
+
+        batches = _batch_sections(
+            [self._spans[section] for section in sections],
+            jobs * PARALLEL_BATCHES_PER_JOB)
+
+        pool = multiprocessing.Pool(
+            jobs, _init_parse_worker, (self.content, self.views))
+
+        # Nodes arrive far faster than anything becomes garbage, and the
+        # collector would otherwise keep rescanning the whole growing tree
+        collecting = gc.isenabled()
+        gc.disable()
+
+        try:
+            bodies = pool.imap(_parse_batch, [
+                [(sections[idx].kind, sections[idx].id,
+                  self._spans[sections[idx]]) for idx in batch]
+                for batch in batches])
+
+            for batch, (rows, failure) in zip(batches, bodies):
+                for idx, section_rows in zip(batch, rows):
+                    self._attach(sections[idx], section_rows)
+
+                # Sections before the failure are kept, as a serial parse
+                # would have built them
+                if failure is not None:
+                    raise DocumentParsingError(failure)
+        finally:
+            if collecting:
+                gc.enable()
+
+            pool.terminate()
+            pool.join()
+
+    def _build(self, section):
+        section._loader = None
+
+        doc_builder = DocumentBuilder()
+        doc_builder.resume(section)
+
+        for start, end in self._spans.pop(section):
+            _build(doc_builder, _tokenize_content(
+                self.content, start, end, self.views, self.pool))
+
+        self._built(section)
+
+    def _attach(self, section, rows):
+        section._loader = None
+        self._pending.popleft()
+        self._spans.pop(section)
+
+        # Nothing here has been hashed yet so nodes are linked in directly,
+        # and given their ids in the same pass
+        nodes = [section]
+        trusted = [True]
+        used = self.used
+        share = self.share
+
+        # Rows arrive as fresh copies, so strings are shared again here
+        # across every batch
+        for index, kind, content, hint, suffixed in rows:
+            if type(content) is tuple:
+                content = ContentView(self.content, *content)
+            else:
+                content = share(content)
+
+            parent = nodes[index]
+            node = DocumentNode(share(kind), content)
+            node.parent = parent
+
+            if parent._children is _NO_CHILDREN:
+                parent._children = list()
+
+            parent._children.append(node)
+
+            # The worker's id only had to avoid the rest of its section. It
+            # still holds unless the worker suffixed it or the parent's id
+            # changed here.
+            if trusted[index] and not suffixed:
+                base = hint
+            else:
+                base = node_id(node)
+
+            node._id = _claim_id(used, base)
+            nodes.append(node)
+            trusted.append(node._id == hint)
+
+        self._loaded()
+
+    def _built(self, section):
+        _assign_ids(section, self.used)
+        self._loaded()
+
+    def check_loaded(self):
+        # A document with no sections is loaded as soon as it's read
+        if len(self._pending) == 0:
+            self._loaded()
+
+    def _loaded(self):
+        # A fully loaded document has no further use for its source, or
+        # for the strings held for sharing
+        if len(self._pending) == 0:
+            self.content = None
+            _close_pool(self.document, self.pool)
+
+
+# Source and mode of the document being parsed, for each parse worker
+_worker_source = None
+
+
+def _init_parse_worker(content, views):
+    global _worker_source
+    _worker_source = (content, views)
+
+    memprofile.detach()
+
+
+def _parse_batch(batch):
+    # Returns the rows for each section body built before a failure, and
+    # the failure's message. Exceptions don't carry their message back
+    # from a worker intact.
+    content, views = _worker_source
+    rows = list()
+    suffixed = set()
+
+    try:
+        for kind, section_id, spans in batch:
+            # Scopes close exactly as they would beneath the real root
+            section = DocumentNode(kind)
+            section.parent = DocumentNode(D_ROOT)
+            section.id = section_id
+
+            doc_builder = DocumentBuilder()
+            doc_builder.resume(section)
+
+            for start, end in spans:
+                _build(doc_builder, _tokenize_content(
+                    content, start, end, views))
+
+            _assign_ids(section, dict(), suffixed)
+            rows.append(_body_rows(section, suffixed))
+    except DocumentParsingError as ex:
+        return rows, ex.msg
+
+    return rows, None
+
+
+def _body_rows(section, suffixed):
+    # Rows are (parent, kind, content, id, suffixed) in the order ids are
+    # assigned, which always reaches a parent before its children. parent is
+    # the position of the parent's row, counting the section itself as 0.
+    rows = list()
+    stack = [(0, section)]
+
+    while len(stack) > 0:
+        index, parent = stack.pop()
+        children = list()
+
+        for child in parent.children:
+            content = child._content
+
+            # Views are sent as offsets; the source is already on the other
+            # end
+            if type(content) is ContentView:
+                content = (content.start, content.end, content.escaped)
+
+            rows.append((index, child.kind, content, child._id,
+                         child in suffixed))
+            children.append((len(rows), child))
+
+        stack.extend(reversed(children))
+
+    return rows
+
+
+def _batch_sections(spans, count):
+    # Splits the sections into about count runs of consecutive sections
+    # with similar amounts of source
+    sizes = [sum(end - start for start, end in section_spans)
+             for section_spans in spans]
+    target = max(1, sum(sizes) // count)
+
+    batches = list()
+    batch = list()
+    batch_size = 0
+
+    for idx, size in enumerate(sizes):
+        batch.append(idx)
+        batch_size += size
+
+        if batch_size >= target:
+            batches.append(batch)
+            batch = list()
+            batch_size = 0
+
+    if len(batch) > 0:
+        batches.append(batch)
+
+    return batches
+
+
+def _tokenize_content(content, start=0, end=None, views=False, pool=None):
+    share = pool.share if pool is not None else _unshared
+
+    for token in _tokenize(content, start, end, views):
+        node = None
+        offset = None
+
+        if token.kind == DIRECTIVE_TOKEN:
+            offset = token.offset
+
+            if token.directive == D_HALT:
+                # Halt processing of the content, letting the parser know
+                # where the source stopped
+                yield offset, None
+                break
+            elif token.directive in DIRECTIVES:
+                node = DocumentNode(share(token.directive),
+                                    share(token.arguments))
+            else:
+                # Don't know this command chief
+                raise DocumentParsingError('Unknown directive: {}'.format(
+                    token.directive))
+        elif type(token.content) is str:
+            node = DocumentNode(D_CONTENT, share(token.content))
+        else:
+            # Views are already shared with the source
+            node = DocumentNode(D_CONTENT, token.content)
+
+        # If a node has been set, save it to our list of nodes that represents
+        # the document
+        if node is not None:
+            yield offset, node
+
+
+def _tokenize(content, start=0, end=None, views=False):
+    # Scan between directive characters with str.find rather than a
+    # character at a time. Every line starts outside of a directive and a
+    # directive runs to the end of its line.
+    find = content.find
+    end = len(content) if end is None else end
+    run_start = search = start
+
+    while True:
+        offset = find(DIRECTIVE_CH, search, end)
+
+        if offset < 0:
+            break
+
+        if is_escaped(content, offset, run_start):
+            search = offset + 1
+            continue
+
+        token = _parse_content(content, run_start, offset, views)
+
+        if token is not None:
+            yield token
+
+        line_end = find(DIRECTIVE_END_CH, offset, end)
+
+        if line_end < 0:
+            raise DocumentParsingError('Illegal end state for parsing: '
+                                       '{}'.format(TK_DIRECTIVE))
+
+        yield _parse_directive(content[offset + 1:line_end], offset)
+        run_start = search = line_end + 1
+
+    token = _parse_content(content, run_start, end, views)
+
+    if token is not None:
+        yield token
+
+
+def _parse_content(content, start, end, views=False):
+    # Trim surrounding whitespace by offset rather than by copying
+    while start < end and content[start] in _STRIP_CHARS:
+        start += 1
+
+    while end > start and content[end - 1] in _STRIP_CHARS:
+        end -= 1
+
+    if start == end:
+        return None
+
+    escaped = content.find(ESCAPE_CH, start, end) >= 0
+
+    # Escaped whitespace only becomes strippable once it's unescaped
+    if escaped and len(_unescape(content[start:end]).strip()) == 0:
+        return None
+
+    if views:
+        return ContentToken(ContentView(content, start, end, escaped))
+
+    if escaped:
+        return ContentToken(_unescape(content[start:end]).strip())
+
+    return ContentToken(content[start:end])
+
+
+def _string_pool():
+    return StringPool() if SHARE_STRINGS else None
+
+
+def _close_pool(document, pool):
+    if pool is None:
+        return
+
+    pool.close()
+    document.strings = pool
+
+    _LOG.info('Shared {} repeated strings, saving {} Bytes.'.format(
+        pool.shared, pool.saved_bytes))
+
+
+def _unshared(value):
+    return value
+
+
+def _unescape(source):
+    # Every escape character stands for the character after it
+    return _UNESCAPE_REGEX.sub('\\1', source)
+
+
+def _parse_directive(content, offset=None):
+    split_content = content.split(' ', 1)
+
+    if len(split_content) == 1:
+        return DirectiveToken(split_content[0], offset=offset)
+    else:
+        return DirectiveToken(split_content[0], split_content[1], offset)
+
+
+def _source_parts(root, parts):
+    append = parts.append
+    stack = [root]
+
+    # Hot loop: touch the private attributes directly and keep the stack
+    # operations bound
+    pop = stack.pop
+    extend = stack.extend
+
+    while len(stack) > 0:
+        node = pop()
+        kind = node.kind
+
+        if kind == D_CONTENT:
+            append(escape_str(node.content))
+            append(_CONTENT_END)
+        elif kind != D_ROOT:
+            append(_node_source(kind, node.content))
+
+        children = node._children if node._loader is None else node.children
+
+        if len(children) > 0:
+            extend(reversed(children))
+
+
+def _node_source(kind, content):
+    if kind == D_CONTENT:
+        return escape_str(content) + _CONTENT_END
+
+    # Directive arguments run to the end of the line and are never unescaped
+    # by the tokenizer, so they're written as they are
+    if content is None:
+        return DIRECTIVE_CH + kind + DIRECTIVE_END_CH
+
+    return DIRECTIVE_CH + kind + ' ' + content + DIRECTIVE_END_CH
+
+
+def _header_parts(document):
+    # A title or authors set on the document without matching nodes (e.g.
+    # a document built by hand) are still written out. Headers written after
+    # the first section are also top level nodes and are written in place.
+    kinds = set(node.kind for node in document.root.children
+                if node.kind in HEADERS)
+    parts = list()
+
+    if document.title is not None and D_TITLE not in kinds:
+        parts.append(_node_source(D_TITLE, document.title))
+
+    if D_AUTHOR not in kinds:
+        parts.extend(_node_source(D_AUTHOR, author)
+                     for author in document.authors)
+
+    return parts
+
+
+def _assign_ids(top, used, suffixed=None):
+    # Ids for everything beneath top, in document order. Lazy sections that
+    # haven't been built yet are skipped. Nodes that had to be suffixed to
+    # avoid a collision are added to suffixed.
+    stack = [top]
+
+    while len(stack) > 0:
+        parent = stack.pop()
+        ordinals = dict()
+
+        for child in parent._children:
+            ordinal = ordinals.get(child.kind, 0) + 1
+            ordinals[child.kind] = ordinal
+
+            child_id = node_id(child, ordinal)
+            candidate = _claim_id(used, child_id)
+
+            if suffixed is not None and candidate != child_id:
+                suffixed.add(child)
+
+            child.id = candidate
+
+        stack.extend(reversed(parent._children))
+
+
+def _claim_id(used, base):
+    # used maps every id taken to the last suffix handed out with it as the
+    # base, so a name that keeps repeating doesn't probe every suffix again
+    suffix = used.get(base)
+
+    if suffix is None:
+        used[base] = 1
+        return base
+
+    candidate = base
+
+    while candidate in used:
+        suffix += 1
+        candidate = ID_SUFFIX.format(base, suffix)
+
+    used[base] = suffix
+    used[candidate] = 1
+    return candidate
+
+
+def _copy(node):
+    copy = DocumentNode(node.kind, node._content)
+    copy.id = node.id
+
+    for child in node.children:
+        copy.append(_copy(child))
+
+    return copy
+
+
+def _preamble(document):
+    # Top level nodes that come before the first section
+    preamble = list()
+
+    for node in document.root.children:
+        if node.kind in TOP_LEVEL:
+            break
+
+        preamble.append(node)
+
+    return preamble
+
+
+def _walk(root, include_root=False):
+    stack = [root] if include_root else list(reversed(root.children))
+
+    while len(stack) > 0:
+        node = stack.pop()
+        yield node
+        stack.extend(reversed(node.children))
+
+
+def _node_entry(node):
+    return {
+        'kind': node.kind,
+        'content': node.content,
+        'children': [_node_entry(child) for child in node.children]
+    }
+
+
+def _node_from_entry(entry):
+    node = DocumentNode(entry['kind'], entry['content'])
+
+    for child in entry['children']:
+        node.append(_node_from_entry(child))
+
+    return node
+
+
+def _patch_file(filename, segments, source_map):
+    writes = list()
+    layout = list()
+    offset = 0
+
+    # Lay the regions out again. Untouched regions that haven't moved stay
+    # exactly where they are on disk.
+    for start, end, new_source, section in segments:
+        if new_source is None:
+            length = end - start
+
+            if start != offset:
+                writes.append((offset, start, end))
+        else:
+            length = len(new_source)
+            writes.append((offset, new_source, None))
+
+        layout.append([offset, offset + length])
+        offset += length
+
+    moved_from = min([write[1] for write in writes if write[2] is not None] +
+                     [source_map.length])
+
+    with open(filename, 'r+b') as fout:
+        # Regions that are shifting have to be read before anything is
+        # written over them
+        fout.seek(moved_from)
+        moved = fout.read()
+
+        for write_offset, data, end in writes:
+            if end is not None:
+                data = moved[data - moved_from:end - moved_from]
+
+            fout.seek(write_offset)
+            fout.write(compat.to_bytes(data))
+
+        fout.truncate(offset)
+        fout.flush()
+        os.fsync(fout.fileno())
+
+    # Hoisted titles and authors move along with their untouched section
+    hoisted = list()
+
+    for segment, span in zip(segments, layout):
+        start, end, new_source, section = segment
+
+        if new_source is None:
+            hoisted.extend(hoisted_offset + span[0] - start
+                           for hoisted_offset in source_map.hoisted
+                           if start <= hoisted_offset < end)
+
+    # The preamble always leads and whatever followed a halt always trails
+    source_map.preamble = layout[0]
+    source_map.sections = dict((segment[3], span) for segment, span in zip(
+        segments[1:-1], layout[1:-1]))
+    source_map.hoisted = hoisted
+    source_map.end = layout[-1][0]
+    source_map.length = offset
 
 
 def _read_file(filename):
@@ -9,5 +9,6 @@ class ErrorMessage(Exception):
 OKAY = 0
 GENERAL_FAILURE = 1
 BAD_DOCUMENT = 2
+OVER_MEMORY_BUDGET = 3
 CONFIGURATION_ERROR = 10
 NODE_NOT_FOUND = 100
@@ -1,11 +1,32 @@
+import re
 import copy
 import types
 import inspect
+import threading
+import contextlib
 import collections
 
 
 _CALL_ATTR = '__call__'
 
+# Tags whose text, and the text of every tag within them, is kept exactly
+# as given, even when minified
+_RAW_TAGS = frozenset([
+    'pre',
+    'script',
+    'style',
+    'textarea'
+])
+
+# Whitespace that renders no differently as a single space
+_WHITESPACE_REGEX = re.compile('[ \t\n\r\f]{2,}|[\t\n\r\f]')
+
+# Attribute values that don't need quotes
+_UNQUOTED_VALUE_REGEX = re.compile('^[^ \t\n\r\f"\'=<>`]+$')
+
+# Render settings for the current thread, see minified()
+_settings = threading.local()
+
 _TAGS = list()
 _TAG_NAMES = [
     'html',
@@ -135,11 +156,18 @@ class PartialGenerator(object):
         raise NotImplementedError()
 
 
+class Markup(str):
+
+    # Rendered html, as opposed to text that's still to be placed in a tag
+    pass
+
+
 class HtmlTag(PartialGenerator):
 
     def __init__(self, tag):
         self.name = tag
         self._template = '<' + tag + '{attributes}>{content}</' + tag + '>'
+        self._raw = tag in _RAW_TAGS
 
     def prime(self, *args):
         attrs = dict()
@@ -151,18 +179,32 @@ class HtmlTag(PartialGenerator):
             else:
                 contents.append(arg)
 
-        return HtmlPartial(self._template, attrs, contents).complete
+        return HtmlPartial(self._template, attrs, contents, self._raw).complete
 
 
 class HtmlPartial(Partial):
 
-    def __init__(self, template, attrs=None, contents=None):
+    def __init__(self, template, attrs=None, contents=None, raw=False):
         self._template = template
+        self._raw = raw
 
         self.attrs = attrs or dict()
         self.contents = contents or list()
 
     def complete(self):
+        if not self._raw:
+            return self._complete()
+
+        # Tags within a raw tag are completed while it is, and keep their
+        # text as given too
+        _settings.raw_depth = getattr(_settings, 'raw_depth', 0) + 1
+
+        try:
+            return self._complete()
+        finally:
+            _settings.raw_depth -= 1
+
+    def _complete(self):
         # Copy the contents so we don't damage the original datastructure
         op_stack = copy.copy(self.contents)
 
@@ -173,6 +215,8 @@ class HtmlPartial(Partial):
         # Capture vars
         results = list()
         attrs = copy.copy(self.attrs)
+        minify = (getattr(_settings, 'minify', False) and
+                  getattr(_settings, 'raw_depth', 0) == 0)
 
         # Keep going until there aren't any more ops left
         while len(op_stack) > 0:
@@ -198,20 +242,32 @@ class HtmlPartial(Partial):
                 else:
                     # Append and reduce additional components
                     op_stack.extend(reversed(next_op))
+            elif type(next_op) is Markup:
+                # Tags that have already been rendered
+                results.append(next_op)
             else:
                 # All other nodes are appended
-                results.append(next_op if type(next_op) is str else str(next_op))
+                text = next_op if type(next_op) is str else str(next_op)
+
+                if minify:
+                    text = _WHITESPACE_REGEX.sub(' ', text)
+
+                results.append(text)
 
         # Unpack attributes
         attr_str = ''
         if len(attrs) > 0:
-            attr_str = ''.join([' {}="{}"'.format(k, v)
-                 for k, v in attrs.iteritems()])
+            if getattr(_settings, 'minify', False):
+                attr_str = ''.join([_minified_attr(k, v)
+                    for k, v in sorted(attrs.iteritems())])
+            else:
+                attr_str = ''.join([' {}="{}"'.format(k, v)
+                     for k, v in attrs.iteritems()])
 
         # Return our formatted template
-        return self._template.format(
+        return Markup(self._template.format(
             attributes=attr_str,
-            content=''.join(results))
+            content=''.join(results)))
 
 
 class MatchPartial(Partial):
@@ -281,6 +337,19 @@ class DocumentObjectPartial(Partial):
         return self._delegate(self._doc)
 
 
+@contextlib.contextmanager
+def minified(enabled=True):
+    # Html completed within this block carries no whitespace or quoting that
+    # a browser doesn't need
+    previous = getattr(_settings, 'minify', False)
+    _settings.minify = enabled
+
+    try:
+        yield
+    finally:
+        _settings.minify = previous
+
+
 def defer(node, delegate):
     return DocumentObjectPartial(node, delegate)
 
@@ -305,6 +374,19 @@ def when(condition):
     return WhenPartial(condition)
 
 
+def _minified_attr(name, value):
+    value = str(value)
+
+    if name == 'style':
+        value = ';'.join(':'.join(part.strip() for part in rule.split(':', 1))
+                         for rule in value.split(';') if rule.strip())
+
+    if _UNQUOTED_VALUE_REGEX.match(value):
+        return ' {}={}'.format(name, value)
+
+    return ' {}="{}"'.format(name, value)
+
+
 def _callable(obj):
     return hasattr(obj, _CALL_ATTR)
 
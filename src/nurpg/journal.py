@@ -0,0 +1,98 @@
+import os
+import json
+
+import nurpg.error as error
+
+
+# Journal operations
+OP_BEGIN = 'begin'
+OP_INSERT = 'insert'
+OP_REMOVE = 'remove'
+OP_SET = 'set'
+OP_SAVE = 'save'
+OP_ABORT = 'abort'
+
+# Operations that modify the document tree
+EDIT_OPS = frozenset([
+    OP_INSERT,
+    OP_REMOVE,
+    OP_SET
+])
+
+# Operations that end an edit session
+_END_OPS = frozenset([
+    OP_SAVE,
+    OP_ABORT
+])
+
+
+class JournalError(error.ErrorMessage):
+    pass
+
+
+class Journal(object):
+
+    def __init__(self, path):
+        self.path = path
+
+    @property
+    def size(self):
+        return os.path.getsize(self.path) if os.path.isfile(self.path) else 0
+
+    def append(self, op, **fields):
+        fields['op'] = op
+
+        journal_dir = os.path.dirname(self.path)
+
+        if journal_dir and not os.path.isdir(journal_dir):
+            os.makedirs(journal_dir)
+
+        # Entries are only ever appended, one JSON object per line
+        with open(self.path, 'a') as fout:
+            fout.write(json.dumps(fields, sort_keys=True))
+            fout.write('\n')
+
+            # Session boundaries must be durable before the document changes
+            if op not in EDIT_OPS:
+                fout.flush()
+                os.fsync(fout.fileno())
+
+    def entries(self):
+        if not os.path.isfile(self.path):
+            return
+
+        with open(self.path, 'r') as fin:
+            for line in fin:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # A torn final entry from a crash is simply ignored
+                    break
+
+    def saves(self):
+        # Sessions that closed without changing anything don't count
+        return sum(1 for entry in self.entries()
+                   if entry['op'] == OP_SAVE and entry['length'] is not None)
+
+    def pending(self, doc_filename, length):
+        # Edits from a session on this file that never saved or aborted, as
+        # long as the file is still the one that session started from
+        pending = None
+
+        for entry in self.entries():
+            op = entry['op']
+
+            if op == OP_BEGIN:
+                matches = (entry['file'] == doc_filename and
+                           entry['length'] == length)
+                pending = list() if matches else None
+            elif op in _END_OPS:
+                pending = None
+            elif pending is not None:
+                pending.append(entry)
+
+        return pending or list()
+
+    def clear(self):
+        if os.path.isfile(self.path):
+            os.remove(self.path)
@@ -7,6 +7,7 @@ import nurpg.error as error
 import nurpg.config as config
 import nurpg.output as output
 import nurpg.document as document
+import nurpg.memprofile as memprofile
 
 import nurpg.tools.cli as tools
 
@@ -40,6 +41,35 @@ def build_argparser():
             Sets the logging output to quiet. This supercedes enabling the
             debug output switch.""")
 
+    argparser.add_argument(
+        '-j', '--jobs',
+        dest='jobs',
+        type=int,
+        default=1,
+        help="""
+            Number of processes used to parse large documents. 0 uses every
+            CPU.""")
+
+    argparser.add_argument(
+        '--memprofile',
+        dest='memprofile',
+        action='store_true',
+        default=False,
+        help="""
+            Reports the peak, used and retained memory of each phase (read,
+            tokenize, build, validate, costs, render and write). On Python
+            3.4 and later, also the lines that allocated the most in each;
+            otherwise the figures are the process's resident size.""")
+
+    argparser.add_argument(
+        '--memory-budget',
+        dest='memory_budget',
+        type=float,
+        default=None,
+        help="""
+            Aborts as soon as a phase finishes having used more than this
+            many MB of memory on top of what was held when it started.""")
+
     subparsers = argparser.add_subparsers(
         dest='tool_name',
         title='NuRPG Document Commands',
@@ -62,9 +92,75 @@ def build_argparser():
 
     export_parser.add_argument(
         'format',
-        help='Name of the export format.'
+        help='Name of the export format: html, md, txt, json or ndjson. '
+             'Several may be given separated by commas, e.g. html,md,txt.'
     )
 
+    export_parser.add_argument(
+        '--sharded',
+        dest='sharded',
+        action='store_true',
+        default=False,
+        help="""
+            Writes an index page and one page per section that's loaded on
+            demand, instead of a single page.""")
+
+    export_parser.add_argument(
+        '--minify',
+        dest='minify',
+        action='store_true',
+        default=False,
+        help="""Leaves out whitespace and quoting browsers don't need.""")
+
+    export_parser.add_argument(
+        '--compress',
+        dest='compress',
+        action='append',
+        choices=['gz', 'xz'],
+        default=[],
+        help="""
+            Also writes precompressed copies of every file in this format.
+            May be given more than once. Implies --manifest.""")
+
+    export_parser.add_argument(
+        '--manifest',
+        dest='manifest',
+        action='store_true',
+        default=False,
+        help="""
+            Writes a manifest.json of the hashes and sizes of every file
+            written.""")
+
+    export_parser.add_argument(
+        '--section',
+        dest='sections',
+        action='append',
+        default=[],
+        help="""
+            Exports a handout of only the sections whose names match this
+            pattern, e.g. 'Ranger*', along with whatever they grant, require
+            or refer to. May be given more than once.""")
+
+    export_parser.add_argument(
+        '--timings',
+        dest='timings',
+        action='store_true',
+        default=False,
+        help="""
+            Reports how long rendering and writing took, and how much of the
+            writing happened while rendering was still going on.""")
+
+    export_parser.add_argument(
+        '-o', '--output',
+        dest='output',
+        default=None,
+        help="""
+            Directory every format is written to, or - to write a single
+            json or ndjson export to stdout. Defaults to the current
+            directory, or for a sharded export to a directory named after
+            the document title, followed by Handout when exporting
+            sections.""")
+
     # find sub-directive
     find_parser = subparsers.add_parser(
         'find',
@@ -76,6 +172,65 @@ def build_argparser():
         help='The desired document node kind.'
     )
 
+    # complete sub-directive
+    complete_parser = subparsers.add_parser(
+        'complete',
+        help='Lists the names of a kind that start with a prefix, from the '
+             'document and the rest of the workspace.')
+
+    complete_parser.add_argument(
+        'kind',
+        help='The kind of node named, e.g. ability.'
+    )
+
+    complete_parser.add_argument(
+        'prefix',
+        nargs='?',
+        default='',
+        help='The start of the name, case is ignored. An opening bracket '
+             'completes the subtypes of the name before it.'
+    )
+
+    complete_parser.add_argument(
+        '--limit',
+        dest='limit',
+        type=int,
+        default=20,
+        help='The most names listed. Defaults to 20.'
+    )
+
+    # diff sub-directive
+    diff_parser = subparsers.add_parser(
+        'diff',
+        help='Compares the document against a stash entry or another '
+             'document file.')
+
+    diff_parser.add_argument(
+        'target',
+        nargs='?',
+        default=None,
+        help='A stash id or document file. Defaults to the most recent '
+             'stash entry.'
+    )
+
+    # stash sub-directive
+    stash_parser = subparsers.add_parser(
+        'stash',
+        help='Saves and restores snapshots of the document file.')
+
+    stash_parser.add_argument(
+        'action',
+        choices=['push', 'pop', 'list', 'gc'],
+        help='Push a snapshot, pop and restore the most recent one, list the '
+             'stash or compact its storage.'
+    )
+
+    # serve sub-directive
+    subparsers.add_parser(
+        'serve',
+        help='Serves diagnostics and costs of the documents open in an '
+             'editor over stdio, speaking the language server protocol.')
+
     # status sub-directive
     status_parser= subparsers.add_parser(
         'status',
@@ -106,7 +261,11 @@ def run():
         try:
             # Run the associated tool function
             tool_func = tools.tool_functions().get(args.tool_name)
-            tool_func(args)
+
+            if args.memprofile or args.memory_budget is not None:
+                _run_profiled(tool_func, args)
+            else:
+                tool_func(args)
 
             # Looks like everything ran okay
             retval = error.OKAY
@@ -127,3 +286,23 @@ def run():
             _LOG.exception(ex)
 
     sys.exit(retval)
+
+
+def _run_profiled(tool_func, args):
+    budget = None
+
+    if args.memory_budget is not None:
+        budget = int(args.memory_budget * document.MB_IN_BYTES)
+
+    profile = memprofile.MemoryProfile(budget)
+
+    try:
+        with memprofile.profiling(profile):
+            tool_func(args)
+    except memprofile.MemoryBudgetError as ex:
+        tools.ToolError.wrap(ex, error.OVER_MEMORY_BUDGET)
+    finally:
+        # Reported even when a phase went over, that's when it's wanted most
+        if args.memprofile:
+            for line in profile.report():
+                output.console(line)
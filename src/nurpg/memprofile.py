@@ -0,0 +1,308 @@
+import os
+import sys
+import threading
+import contextlib
+
+import nurpg.error as error
+import nurpg.compat as compat
+
+
+# Phases a document goes through on its way to an export
+READ = 'read'
+TOKENIZE = 'tokenize'
+BUILD = 'build'
+VALIDATE = 'validate'
+COSTS = 'costs'
+RENDER = 'render'
+WRITE = 'write'
+
+PHASES = (READ, TOKENIZE, BUILD, VALIDATE, COSTS, RENDER, WRITE)
+
+# Allocation sites listed for each phase
+TOP_LINES = 5
+
+# Frames kept for every traced allocation, only the line it came from
+_TRACE_FRAMES = 1
+
+# The profile measuring phases on the current thread, see profiling() and
+# attached()
+_settings = threading.local()
+
+# Allocations made by the profiler itself are left out of its reports
+_SOURCE_FILE = os.path.splitext(__file__)[0] + '.py'
+
+
+class MemoryBudgetError(error.ErrorMessage):
+    pass
+
+
+class PhaseStats(object):
+
+    def __init__(self, name):
+        self.name = name
+
+        # The most memory held at any point during the phase
+        self.peak = 0
+
+        # The most the phase added to what was held when it started, over
+        # every run
+        self.used = 0
+
+        # Memory the phase allocated and still held once it finished
+        self.retained = 0
+
+        # How many times the phase ran, e.g. once per shard
+        self.runs = 0
+
+        # 'file:line' -> bytes retained by allocations made on that line
+        self.lines = dict()
+
+    def top(self, count=TOP_LINES):
+        return sorted(self.lines.items(), key=lambda line: -line[1])[:count]
+
+
+# Measures every phase run while the profile is active. With tracemalloc the
+# figures are traced Python allocations and the lines responsible can be
+# listed. Without it they're the process's resident size, where a phase's
+# peak is only seen when it raises the process's high water mark. Either
+# way memory is measured for the whole process, so phases may run on other
+# threads at the same time, each seeing what the others hold.
+class MemoryProfile(object):
+
+    def __init__(self, budget=None, top=TOP_LINES):
+        self.budget = budget
+        self.top = top
+        self.tracing = compat.tracemalloc is not None
+
+        # name -> PhaseStats, and the order phases first ran in
+        self.phases = dict()
+        self.order = list()
+
+        # [start, high] for every phase currently running on any thread
+        self._running = list()
+        self._lock = threading.Lock()
+
+        self._started = False
+        self._reset_high = 0
+
+    def start(self):
+        if self.tracing and not compat.tracemalloc.is_tracing():
+            compat.tracemalloc.start(_TRACE_FRAMES)
+            self._started = True
+
+    def stop(self):
+        if self._started:
+            compat.tracemalloc.stop()
+            self._started = False
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        with self._lock:
+            stats = self.phases.get(name)
+
+            if stats is None:
+                stats = self.phases[name] = PhaseStats(name)
+                self.order.append(name)
+
+            # Phases already running keep the peak they'd already seen
+            peak = self._peak()
+
+            for running in self._running:
+                running[1] = max(running[1], peak)
+
+            self._reset_peak()
+
+            start = self._current()
+            snapshot = self._snapshot()
+            running = [start, start]
+            self._running.append(running)
+
+        try:
+            yield stats
+        finally:
+            with self._lock:
+                self._running = [other for other in self._running
+                                 if other is not running]
+
+                high = max(running[1], self._peak())
+                stats.peak = max(stats.peak, high)
+                stats.used = max(stats.used, high - start)
+                stats.retained += self._current() - start
+                stats.runs += 1
+
+                if snapshot is not None:
+                    self._count_lines(stats, snapshot)
+
+        # Budgets are for what a phase itself adds, whatever was already
+        # held, which without tracemalloc includes the whole interpreter
+        if self.budget is not None and high - start > self.budget:
+            raise MemoryBudgetError(
+                'The {} phase used {} of memory, over the {} budget.'.format(
+                    name, format_size(high - start),
+                    format_size(self.budget)))
+
+    def report(self):
+        if self.tracing:
+            heading = 'Memory by phase (traced allocations):'
+        else:
+            heading = ('Memory by phase (resident size, allocation sites '
+                       'need tracemalloc from Python 3.4):')
+
+        lines = [heading, '  {:<10} {:>12} {:>12} {:>12}'.format(
+            'phase', 'peak', 'used', 'retained')]
+
+        for name in self.order:
+            stats = self.phases[name]
+
+            lines.append('  {:<10} {:>12} {:>12} {:>12}'.format(
+                name, format_size(stats.peak), format_size(stats.used),
+                format_size(stats.retained)))
+
+            for line, size in stats.top(self.top):
+                lines.append('    {} {}'.format(line, format_size(size)))
+
+        return lines
+
+    def _current(self):
+        if self.tracing:
+            return compat.tracemalloc.get_traced_memory()[0]
+
+        return _resident_bytes()
+
+    def _peak(self):
+        if self.tracing:
+            return compat.tracemalloc.get_traced_memory()[1]
+
+        # The high water mark can't be reset, it only says something about
+        # a phase that raised it
+        high = _max_resident_bytes()
+        return high if high > self._reset_high else self._current()
+
+    def _reset_peak(self):
+        if not self.tracing:
+            self._reset_high = _max_resident_bytes()
+
+        elif hasattr(compat.tracemalloc, 'reset_peak'):
+            compat.tracemalloc.reset_peak()
+
+    def _snapshot(self):
+        if not self.tracing or self.top == 0:
+            return None
+
+        return _filtered(compat.tracemalloc.take_snapshot())
+
+    def _count_lines(self, stats, before):
+        after = _filtered(compat.tracemalloc.take_snapshot())
+
+        for diff in after.compare_to(before, 'lineno')[:self.top]:
+            if diff.size_diff <= 0:
+                continue
+
+            frame = diff.traceback[0]
+            line = '{}:{}'.format(frame.filename, frame.lineno)
+            stats.lines[line] = stats.lines.get(line, 0) + diff.size_diff
+
+
+# Stands in for a phase when nothing is being profiled
+class _Unprofiled(object):
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, type, value, traceback):
+        return False
+
+
+_UNPROFILED = _Unprofiled()
+
+
+@contextlib.contextmanager
+def profiling(profile):
+    # Phases run within this block on this thread are measured by profile
+    previous = getattr(_settings, 'profile', None)
+    _settings.profile = profile
+    profile.start()
+
+    try:
+        yield profile
+    finally:
+        profile.stop()
+        _settings.profile = previous
+
+
+@contextlib.contextmanager
+def attached(profile):
+    # Phases run within this block on this thread are measured by a profile
+    # another thread started, e.g. by the thread writing out what it renders.
+    # A profile of None measures nothing.
+    previous = getattr(_settings, 'profile', None)
+    _settings.profile = profile
+
+    try:
+        yield profile
+    finally:
+        _settings.profile = previous
+
+
+def current():
+    return getattr(_settings, 'profile', None)
+
+
+def active():
+    return current() is not None
+
+
+def detach():
+    # Forked workers inherit the profile but have no way to report to it
+    _settings.profile = None
+
+
+def phase(name):
+    profile = getattr(_settings, 'profile', None)
+
+    if profile is None:
+        return _UNPROFILED
+
+    return profile.phase(name)
+
+
+def format_size(size):
+    if abs(size) < 1024:
+        return '{} B'.format(size)
+
+    if abs(size) < 1048576:
+        return '{:.1f} KB'.format(size / 1024.0)
+
+    return '{:.1f} MB'.format(size / 1048576.0)
+
+
+def _filtered(snapshot):
+    # Leave out the profiler's own bookkeeping
+    return snapshot.filter_traces([
+        compat.tracemalloc.Filter(False, compat.tracemalloc.__file__),
+        compat.tracemalloc.Filter(False, _SOURCE_FILE)
+    ])
+
+
+def _resident_bytes():
+    try:
+        with open('/proc/self/statm') as fin:
+            pages = int(fin.read().split()[1])
+
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        # Only the high water mark is known elsewhere
+        return _max_resident_bytes()
+
+
+def _max_resident_bytes():
+    if compat.resource is None:
+        return 0
+
+    usage = compat.resource.getrusage(compat.resource.RUSAGE_SELF)
+
+    # Linux reports kilobytes where macOS reports bytes
+    if sys.platform == 'darwin':
+        return usage.ru_maxrss
+
+    return usage.ru_maxrss * 1024
@@ -0,0 +1,314 @@
+import threading
+
+import nurpg.error as error
+import nurpg.document as document
+
+
+# Marks an attribute that replace() should carry over unchanged
+_KEEP = object()
+
+
+class SnapshotError(error.ErrorMessage):
+    pass
+
+
+# A read only document node. Nodes don't know their parent so an unchanged
+# subtree can be shared by every snapshot that contains it.
+class SnapshotNode(object):
+
+    __slots__ = ('kind', 'content', 'children', 'id', '_hash')
+
+    def __init__(self, kind, content, children, node_id):
+        init = super(SnapshotNode, self).__setattr__
+
+        init('kind', kind)
+        init('content', content)
+        init('children', tuple(children))
+        init('id', node_id)
+        init('_hash', None)
+
+    def __setattr__(self, name, value):
+        raise SnapshotError('Snapshot nodes are read only.')
+
+    @property
+    def hash(self):
+        # Caching is safe without a lock since every thread would compute the
+        # same value
+        if self._hash is None:
+            super(SnapshotNode, self).__setattr__('_hash', document.merkle_hash(
+                self.kind, self.content, self.children))
+
+        return self._hash
+
+    def find(self, kind, content=None):
+        return document.find(self, kind, content)
+
+    def replace(self, content=_KEEP, children=_KEEP):
+        return SnapshotNode(
+            self.kind,
+            self.content if content is _KEEP else content,
+            self.children if children is _KEEP else children,
+            self.id)
+
+
+# A read only version of a whole document. Every edit returns a new snapshot
+# that copies only the nodes on the path down to the edit and shares the
+# rest with this one, so readers never need a lock.
+class Snapshot(object):
+
+    __slots__ = ('root', 'title', 'authors', 'version', '_paths')
+
+    def __init__(self, root, version=0, header=None):
+        init = super(Snapshot, self).__setattr__
+
+        init('root', root)
+        init('version', version)
+        init('_paths', dict())
+
+        if header is None:
+            header = _header(root)
+
+        init('title', header[0])
+        init('authors', header[1])
+
+    def __setattr__(self, name, value):
+        raise SnapshotError('Snapshots are read only.')
+
+    @property
+    def sections(self):
+        for sec in document.find(self.root, document.D_SECTION):
+            yield sec
+
+    def node(self, node_id):
+        path = self.path(node_id)
+
+        if path is None:
+            return None
+
+        return _nodes_on(self.root, path)[-1]
+
+    def path(self, node_id):
+        # Child indexes leading from the root to the node
+        if node_id == self.root.id:
+            return ()
+
+        path = self._paths.get(node_id)
+
+        if path is None:
+            path = _locate(self.root, node_id)
+
+            if path is not None:
+                self._paths[node_id] = path
+
+        return path
+
+    def set_content(self, node, content):
+        path = self._resolve(node)
+        target = _nodes_on(self.root, path)[-1]
+
+        if (target.kind != document.D_CONTENT and
+                document.DIRECTIVE_END_CH in (content or '')):
+            raise SnapshotError('Directive arguments may not span lines.')
+
+        return self._replace(path, target.replace(content=content))
+
+    def insert(self, parent, index, node):
+        path = self._resolve(parent)
+        target = _nodes_on(self.root, path)[-1]
+
+        # Same-kind siblings before the new node give it its ordinal
+        ordinal = 1 + sum(1 for sibling in target.children[:index]
+                          if sibling.kind == node.kind)
+
+        children = list(target.children)
+        children.insert(index, _freeze_new(node, target, ordinal,
+                                           _TakenIds(self)))
+
+        return self._replace(path, target.replace(children=children))
+
+    def append(self, parent, node):
+        path = self._resolve(parent)
+        target = _nodes_on(self.root, path)[-1]
+        return self.insert(path, len(target.children), node)
+
+    def remove(self, node):
+        path = self._resolve(node)
+
+        if len(path) == 0:
+            raise SnapshotError('The root node can not be removed.')
+
+        parent_path, index = path[:-1], path[-1]
+        target = _nodes_on(self.root, parent_path)[-1]
+
+        children = list(target.children)
+        del children[index]
+
+        return self._replace(parent_path, target.replace(children=children))
+
+    def _resolve(self, node):
+        # Edits accept a node, its id or a path
+        if isinstance(node, tuple):
+            return node
+
+        node_id = getattr(node, 'id', node)
+        path = self.path(node_id)
+
+        if path is None:
+            raise SnapshotError('Node {} not found.'.format(node_id))
+
+        return path
+
+    def _replace(self, path, node):
+        # Copy every ancestor of the replaced node; everything else is shared
+        ancestors = _nodes_on(self.root, path)[:-1]
+
+        for parent, index in reversed(list(zip(ancestors, path))):
+            children = list(parent.children)
+            children[index] = node
+            node = parent.replace(children=children)
+
+        # Titles and authors can only change with the root's own children
+        header = None if len(path) <= 1 else (self.title, self.authors)
+        return Snapshot(node, self.version + 1, header)
+
+
+# The ids a snapshot's nodes hold and those handed out since, looked up the
+# way document._claim_id keeps them so new nodes are suffixed the same way
+class _TakenIds(object):
+
+    def __init__(self, snapshot):
+        self._snapshot = snapshot
+        self._claimed = dict()
+
+    def get(self, node_id):
+        if node_id in self._claimed:
+            return self._claimed[node_id]
+
+        return 1 if self._snapshot.path(node_id) is not None else None
+
+    def __contains__(self, node_id):
+        return self.get(node_id) is not None
+
+    def __setitem__(self, node_id, suffix):
+        self._claimed[node_id] = suffix
+
+
+# Publishes the latest snapshot of a document. Readers simply take
+# head.current and keep a consistent view for as long as they hold it;
+# only writers are serialized.
+class Head(object):
+
+    def __init__(self, snapshot):
+        self.current = snapshot
+        self._lock = threading.Lock()
+
+    def update(self, edit):
+        # edit takes the current snapshot and returns the next one
+        with self._lock:
+            self.current = edit(self.current)
+            return self.current
+
+
+def freeze(doc):
+    # Node ids are kept as they were assigned to the document
+    return Snapshot(_freeze(doc.root))
+
+
+def thaw(snapshot):
+    # A mutable copy, e.g. to write the snapshot back out
+    doc = document.Document()
+
+    for child in snapshot.root.children:
+        doc.root.append(_thaw(child))
+
+    doc.sync_header()
+    return doc
+
+
+def _header(root):
+    # Titles and authors always live directly under the root
+    title = None
+    authors = list()
+
+    for node in root.children:
+        if node.kind == document.D_TITLE:
+            title = node.content
+        elif node.kind == document.D_AUTHOR:
+            authors.append(node.content)
+
+    return title, tuple(authors)
+
+
+def _freeze(node):
+    return SnapshotNode(node.kind, node.content,
+                        [_freeze(child) for child in node.children], node.id)
+
+
+def _freeze_new(node, parent, ordinal, taken):
+    # New nodes get the id they would have been given beneath parent, or a
+    # suffixed one when a node already holds it
+    frozen = SnapshotNode(node.kind, node.content, (), document._claim_id(
+        taken, document.child_id(parent, node.kind, node.content, ordinal)))
+
+    children = list()
+    ordinals = dict()
+
+    for child in node.children:
+        ordinals[child.kind] = ordinals.get(child.kind, 0) + 1
+        children.append(_freeze_new(child, frozen, ordinals[child.kind],
+                                    taken))
+
+    return frozen.replace(children=children)
+
+
+def _thaw(node):
+    thawed = document.DocumentNode(node.kind, node.content)
+    thawed.id = node.id
+
+    for child in node.children:
+        thawed.append(_thaw(child))
+
+    return thawed
+
+
+def _nodes_on(root, path):
+    nodes = [root]
+
+    for index in path:
+        nodes.append(nodes[-1].children[index])
+
+    return nodes
+
+
+def _locate(root, node_id):
+    # Ids are derived from the kinds and ids of their ancestors, so only
+    # subtrees whose ids could lead to node_id are searched
+    stack = [(root, ())]
+
+    while len(stack) > 0:
+        node, path = stack.pop()
+
+        for index, child in enumerate(node.children):
+            if child.id == node_id:
+                return path + (index,)
+
+            if _may_contain(child, node_id):
+                stack.append((child, path + (index,)))
+
+    return None
+
+
+def _may_contain(node, node_id):
+    if len(node.children) == 0:
+        return False
+
+    # Numbered descendants extend their parent's id
+    if node_id.startswith(node.id + document.ID_SEPARATOR):
+        return True
+
+    # Element descendants extend the kinds their parent is nested in
+    if node.kind not in document.D_ELEMENTS:
+        return False
+
+    kind_path = node.id.rsplit(document.ID_SEPARATOR, 1)[0]
+    return node_id.startswith(kind_path + document.ID_SEPARATOR)
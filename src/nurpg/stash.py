@@ -0,0 +1,205 @@
+import os
+import zlib
+import hashlib
+import tempfile
+
+import nurpg.error as error
+
+
+_OBJECTS_DIR = 'objects'
+
+# Object headers
+_FULL = b'F'
+_DELTA = b'D'
+_HEADER_END = b'\n'
+
+# Delta operations
+_COPY_OP = b'C'
+_LITERAL_OP = b'L'
+
+# A delta larger than this fraction of its snapshot isn't worth keeping
+_MAX_DELTA_RATIO = 0.5
+
+
+class StashError(error.ErrorMessage):
+    pass
+
+
+# Content addressed snapshot storage. Every object is named by the sha1 of
+# the snapshot it restores to and is stored zlib compressed, either in full or
+# as a line based delta against a full base object.
+class ObjectStore(object):
+
+    def __init__(self, stash_dir):
+        self.root = os.path.join(stash_dir, _OBJECTS_DIR)
+
+    def path(self, object_id):
+        return os.path.join(self.root, object_id)
+
+    def contains(self, object_id):
+        return os.path.isfile(self.path(object_id))
+
+    def ids(self):
+        if not os.path.isdir(self.root):
+            return list()
+
+        return [name for name in os.listdir(self.root)
+                if not name.startswith('.')]
+
+    def size(self, object_id):
+        return os.path.getsize(self.path(object_id))
+
+    def put(self, content, base_id=None):
+        object_id = content_id(content)
+
+        # Identical snapshots are stored exactly once
+        if self.contains(object_id):
+            return object_id
+
+        self._write(object_id, self._encode(content, base_id))
+        return object_id
+
+    def get(self, object_id):
+        kind, base_id, payload = self._read(object_id)
+
+        if kind == _FULL:
+            return payload
+
+        return apply_delta(self.get(base_id).splitlines(True), payload)
+
+    def base_of(self, object_id):
+        kind, base_id, payload = self._read(object_id)
+        return object_id if kind == _FULL else base_id
+
+    def rebase(self, object_id, base_id=None):
+        # Re-encode an object against a new base (or in full)
+        content = self.get(object_id)
+        self._write(object_id, self._encode(content, base_id))
+
+    def remove(self, object_id):
+        os.remove(self.path(object_id))
+
+    def _encode(self, content, base_id):
+        if base_id is not None:
+            # Deltas are only ever taken against full objects so restoring
+            # never has to walk a chain
+            base_id = self.base_of(base_id)
+
+        if base_id is not None and base_id != content_id(content):
+            delta = make_delta(self.get(base_id).splitlines(True),
+                               content.splitlines(True))
+
+            if len(delta) < len(content) * _MAX_DELTA_RATIO:
+                return _DELTA + b' ' + base_id.encode('ascii') + \
+                    _HEADER_END + delta
+
+        return _FULL + _HEADER_END + content
+
+    def _read(self, object_id):
+        if not self.contains(object_id):
+            raise StashError('Stash object {} not found.'.format(object_id))
+
+        with open(self.path(object_id), 'rb') as fin:
+            data = zlib.decompress(fin.read())
+
+        header, payload = data.split(_HEADER_END, 1)
+
+        if header[:1] == _FULL:
+            return _FULL, None, payload
+
+        return _DELTA, header[2:].decode('ascii'), payload
+
+    def _write(self, object_id, data):
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+
+        # Write to a temp file first so a crash never leaves a torn object
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix='.')
+
+        try:
+            with os.fdopen(fd, 'wb') as fout:
+                fout.write(zlib.compress(data))
+
+            os.rename(tmp_path, self.path(object_id))
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+
+def content_id(content):
+    return hashlib.sha1(content).hexdigest()
+
+
+def make_delta(base_lines, lines):
+    # Index the first occurrence of each base line so that runs of matching
+    # lines can be found without comparing every pair
+    index = dict()
+
+    for position, line in enumerate(base_lines):
+        index.setdefault(line, position)
+
+    ops = list()
+    literal = list()
+
+    cursor = 0
+    base_cursor = 0
+
+    while cursor < len(lines):
+        line = lines[cursor]
+
+        # Prefer continuing from where the last copy left off
+        if base_cursor < len(base_lines) and base_lines[base_cursor] == line:
+            start = base_cursor
+        else:
+            start = index.get(line)
+
+        if start is None:
+            literal.append(line)
+            cursor += 1
+            continue
+
+        count = 0
+        while (cursor + count < len(lines) and
+               start + count < len(base_lines) and
+               lines[cursor + count] == base_lines[start + count]):
+            count += 1
+
+        if len(literal) > 0:
+            ops.append(_literal(literal))
+            literal = list()
+
+        ops.append(_COPY_OP + b' ' + str(start).encode('ascii') + b' ' +
+                   str(count).encode('ascii') + b'\n')
+
+        cursor += count
+        base_cursor = start + count
+
+    if len(literal) > 0:
+        ops.append(_literal(literal))
+
+    return b''.join(ops)
+
+
+def apply_delta(base_lines, delta):
+    parts = list()
+    offset = 0
+
+    while offset < len(delta):
+        line_end = delta.index(b'\n', offset)
+        op = delta[offset:line_end].split(b' ')
+        offset = line_end + 1
+
+        if op[0] == _COPY_OP:
+            start = int(op[1])
+            parts.extend(base_lines[start:start + int(op[2])])
+        else:
+            length = int(op[1])
+            parts.append(delta[offset:offset + length])
+            offset += length
+
+    return b''.join(parts)
+
+
+def _literal(lines):
+    text = b''.join(lines)
+    return _LITERAL_OP + b' ' + str(len(text)).encode('ascii') + b'\n' + text
@@ -1,10 +1,21 @@
-import nurpg.html as html
+import os
+import sys
+
 import nurpg.error as error
 import nurpg.config as config
 import nurpg.output as output
 import nurpg.document as document
 
-import nurpg.tools.export as export
+import nurpg.tools.diff as diff
+import nurpg.tools.shards as shards
+import nurpg.tools.handout as handout
+import nurpg.tools.publish as publish
+import nurpg.tools.complete as complete
+import nurpg.tools.server as server
+import nurpg.tools.records as records
+import nurpg.tools.symbols as symbols
+import nurpg.tools.pipeline as pipeline
+import nurpg.tools.validate as validate
 
 
 class ToolError(error.ErrorMessage):
@@ -30,7 +41,11 @@ def tool_functions():
         'init': init_tool,
         'export': export_tool,
         'status': status_tool,
-        'find': find_tool
+        'find': find_tool,
+        'complete': complete_tool,
+        'diff': diff_tool,
+        'serve': serve_tool,
+        'stash': stash_tool
     }
 
 
@@ -51,30 +66,97 @@ def export_tool(args):
     # Read the configuration or attempt to
     cfg = config.read_config()
 
-    # Read the document
-    doc = document.read(cfg.document_file)
-
-    if args.format == 'html':
-        with open('{}.html'.format(doc.title), 'w') as html_out:
-            html_stmt= html.html(
-                html.head(
-                    html.title(doc.title)
-                ),
+    sections = getattr(args, 'sections', None) or list()
 
-                html.body(
-                    html.div(export.render_doc(doc))))
+    if len(sections) > 0:
+        # Only the sections asked for and what they depend on are built
+        try:
+            doc = handout.build(document.read(cfg.document_file, lazy=True),
+                                sections)
+        except handout.HandoutError as ex:
+            ToolError.wrap(ex, error.NODE_NOT_FOUND)
 
-            html_out.write(html_stmt())
+        name = '{} Handout'.format(doc.title)
     else:
-        raise ToolError('No export format {} available.'.format(args.format))
+        doc = document.read(cfg.document_file, jobs=_jobs(args))
+        name = doc.title
+
+    # Names other documents in the workspace define
+    index = symbols.workspace_index(cfg)
+
+    compress = getattr(args, 'compress', None) or list()
+    minify = getattr(args, 'minify', False)
+    manifest = getattr(args, 'manifest', False) or len(compress) > 0
+
+    # Formats may be combined, e.g. html,md,txt
+    formats = list()
+
+    for fmt in args.format.split(','):
+        if fmt not in pipeline.FORMATS + (records.JSON, records.NDJSON):
+            raise ToolError('No export format {} available.'.format(fmt))
+
+        if fmt not in formats:
+            formats.append(fmt)
+
+    sharded = pipeline.HTML in formats and getattr(args, 'sharded', False)
+
+    # Every format is written into the output directory. Only a lone json or
+    # ndjson export can go to stdout instead.
+    out_dir = getattr(args, 'output', None)
+
+    if out_dir == '-' and (sharded or len(formats) > 1 or
+                           formats[0] not in (records.JSON, records.NDJSON)):
+        raise ToolError('Only a single json or ndjson export can be written '
+                        'to stdout.')
+
+    if out_dir not in (None, '-') and not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    if sharded:
+        formats.remove(pipeline.HTML)
+
+        shard_dir = out_dir or name
+        written = shards.export_shards(
+            doc, shard_dir, _jobs(args), compress, minify, manifest, index)
+
+        output.console('Wrote {} changed file(s) to {}.'.format(
+            len(written), shard_dir))
+
+    rendered = [fmt for fmt in formats if fmt in pipeline.FORMATS]
+
+    if len(rendered) > 0:
+        publisher = publish.Publisher(out_dir or '.', compress, manifest)
+
+        # Every format comes out of a single walk of the document and is
+        # written out by another thread while the walk goes on
+        changed, timings = pipeline.stream(
+            doc, rendered, publisher, minify, index, name)
+
+        publisher.close()
+
+        if getattr(args, 'timings', False):
+            output.console(
+                'Rendered in {:.3f}s, writing took {:.3f}s of which {:.3f}s '
+                'was hidden behind rendering.'.format(
+                    timings.rendering, timings.writing, timings.hidden))
+
+    for fmt in formats:
+        if fmt not in (records.JSON, records.NDJSON):
+            continue
+
+        if out_dir == '-':
+            records.dump(doc, sys.stdout, fmt)
+        else:
+            records.write(doc, os.path.join(
+                out_dir or '.', '{}.{}'.format(name, fmt)), fmt)
 
 
 def find_tool(args):
     # Read the configuration or attempt to
     cfg = config.read_config()
 
-    # Read the document
-    doc = document.read(cfg.document_file)
+    # Read the document, sections are only built if the search needs them
+    doc = document.read(cfg.document_file, lazy=True)
 
     # Normalize the matcher
     kind_spec = args.kind.lower()
@@ -89,17 +171,113 @@ def find_tool(args):
         output.console(''.join([str(n) for n in nodes]))
     else:
         raise ToolError(
-            'Spec "{}" not found.'.format(args.node_spec),
+            'Spec "{}" not found.'.format(args.kind),
             error.NODE_NOT_FOUND)
 
 
+def complete_tool(args):
+    # Read the configuration or attempt to
+    cfg = config.read_config()
+
+    # The index is only rebuilt when a document in the workspace changed
+    index = complete.workspace_completions(cfg)
+
+    try:
+        completions = index.complete(args.kind, args.prefix, args.limit)
+    except complete.CompletionError as ex:
+        ToolError.wrap(ex)
+
+    for completion in completions:
+        output.console(completion.text())
+
+
 def status_tool(args):
     # Read the configuration or attempt to
     cfg = config.read_config()
 
-    # Read the document
-    doc = document.read(cfg.document_file)
+    # Check the whole document in one pass, collecting every problem. Names
+    # may also come from the other documents in the workspace.
+    report = validate.check(cfg.document_file, symbols.workspace_index(cfg))
+
+    for problem in report.problems:
+        output.console(str(problem))
+
+    if not report.valid:
+        raise ToolError(
+            'Document has {} problem(s).'.format(len(report.problems)),
+            error.BAD_DOCUMENT)
 
     output.console('Document is valid!')
-    output.console('Document title: {}'.format(doc.title))
-    output.console('Document length: {} nodes'.format(len(doc)))
+    output.console('Document title: {}'.format(report.title))
+    output.console('Document length: {} nodes'.format(report.node_count))
+
+
+def serve_tool(args):
+    # Read the configuration or attempt to
+    cfg = config.read_config()
+
+    # Names other documents in the workspace define. stdout belongs to the
+    # protocol from here on.
+    serving = server.Server(getattr(sys.stdin, 'buffer', sys.stdin),
+                            getattr(sys.stdout, 'buffer', sys.stdout),
+                            symbols.workspace_index(cfg))
+
+    if not serving.run():
+        raise ToolError('The editor exited without shutting the server down.')
+
+
+def diff_tool(args):
+    # Read the configuration or attempt to
+    cfg = config.read_config()
+
+    # The target is either another document file or a stash entry
+    if args.target is not None and os.path.isfile(args.target):
+        previous = document.read(args.target, jobs=_jobs(args))
+    else:
+        previous = document.parse(config.stash_read(args.target),
+                                  jobs=_jobs(args))
+
+    current = document.read(cfg.document_file, jobs=_jobs(args))
+
+    changes = diff.diff(previous, current)
+
+    for change in changes:
+        output.console(str(change))
+
+    for cost_change in diff.cost_changes(previous, current, changes):
+        output.console(str(cost_change))
+
+    if len(changes) == 0:
+        output.console('No differences.')
+
+
+def stash_tool(args):
+    # Read the configuration or attempt to
+    cfg = config.read_config()
+
+    if args.action == 'push':
+        stash_id = config.stash_push(cfg.document_file)
+        output.console('Stashed {}.'.format(stash_id))
+
+    elif args.action == 'pop':
+        stash_id = config.stash_pop(cfg.document_file)
+
+        if stash_id is None:
+            raise ToolError('The stash is empty.')
+
+        output.console('Restored {}.'.format(stash_id))
+
+    elif args.action == 'list':
+        for stash_id in reversed(cfg.stash_stack):
+            output.console(stash_id)
+
+    elif args.action == 'gc':
+        removed, before, after = config.stash_gc()
+        output.console('Removed {} object(s), {} -> {} bytes.'.format(
+            removed, before, after))
+
+
+def _jobs(args):
+    # 0 asks for a process per CPU
+    jobs = getattr(args, 'jobs', 1)
+    return None if jobs == 0 else jobs
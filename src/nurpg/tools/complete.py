@@ -0,0 +1,262 @@
+import os
+import json
+import bisect
+import hashlib
+import tempfile
+
+import nurpg.error as error
+import nurpg.config as config
+import nurpg.compat as compat
+import nurpg.document as document
+
+import nurpg.tools.costs as costs
+import nurpg.tools.export as export
+import nurpg.tools.symbols as symbols
+
+
+# Completions given for a prefix when no limit is asked for
+DEFAULT_LIMIT = 20
+
+# Bumped whenever the cached layout changes so stale caches are rebuilt
+INDEX_VERSION = 1
+
+# Joins a name to its subtype in keys. It sorts before anything a name may
+# hold, so a name comes right before its own subtypes.
+_SUBTYPE_SEP = '\0'
+
+
+class CompletionError(error.ErrorMessage):
+    pass
+
+
+# A name that can be granted, required or referred to, as it would be
+# written after the kind, e.g. 'Weapon Proficiency (Sword)'
+class Completion(object):
+
+    def __init__(self, kind, name, subtype, title):
+        self.kind = kind
+        self.name = name
+        self.subtype = subtype
+
+        # The title of the document defining it
+        self.title = title
+
+    def text(self):
+        if self.subtype is None:
+            return self.name
+
+        return '{} ({})'.format(self.name, self.subtype)
+
+    def __str__(self):
+        return self.text()
+
+
+# Every name the document and the rest of the workspace define, kept per
+# kind in a sorted array of case folded keys. A prefix is found by bisecting
+# for the first key it could start, so a query only ever looks at the
+# results it gives back.
+class CompletionIndex(object):
+
+    def __init__(self, names=None, files=None, workspace=None):
+        # kind -> [[key, name, subtype, title], ...] sorted by key
+        self.names = names or dict()
+
+        # [path, sha1] of every file the configured document was read from,
+        # the document file itself first
+        self.files = files or list()
+
+        # path -> sha1 of the other documents in the workspace
+        self.workspace = workspace or dict()
+
+        # kind -> the keys alone, for bisecting
+        self._keys = dict((kind, [entry[0] for entry in entries])
+                          for kind, entries in self.names.items())
+
+    @classmethod
+    def build(cls, definitions, files, workspace):
+        # definitions are (kind, name, subtype, title) tuples, where the
+        # first of any that repeat is kept
+        names = dict()
+        seen = set()
+
+        for kind, name, subtype, title in definitions:
+            if (kind, name, subtype) in seen:
+                continue
+
+            seen.add((kind, name, subtype))
+            names.setdefault(kind, list()).append(
+                [_key(name, subtype), name, subtype, title])
+
+        for entries in names.values():
+            entries.sort(key=lambda entry: (entry[0], entry[1]))
+
+        return CompletionIndex(names, files, workspace)
+
+    @classmethod
+    def from_json(cls, source_str):
+        source = json.loads(source_str)
+
+        if source.get('version') != INDEX_VERSION:
+            return CompletionIndex()
+
+        names = dict()
+
+        for kind, entries in source['names'].items():
+            names[compat.to_native(kind)] = [
+                [compat.to_native(field) for field in entry]
+                for entry in entries]
+
+        return CompletionIndex(names, source['files'], source['workspace'])
+
+    def to_json(self):
+        return json.dumps({
+            'version': INDEX_VERSION,
+            'files': self.files,
+            'workspace': self.workspace,
+            'names': self.names
+        }, sort_keys=True)
+
+    def complete(self, kind, prefix, limit=DEFAULT_LIMIT):
+        # Completions of kind starting with prefix, ignoring case, in order.
+        # A prefix with an opening bracket matches the subtypes of the name
+        # before it, e.g. 'weapon proficiency (s'.
+        kind = kind.lower()
+
+        if kind not in costs.INDEXED_KINDS:
+            raise CompletionError('Nothing can name a {}.'.format(kind))
+
+        keys = self._keys.get(kind, ())
+        entries = self.names.get(kind, ())
+        query = _query(prefix)
+        found = list()
+        idx = bisect.bisect_left(keys, query)
+
+        while (idx < len(keys) and len(found) < limit and
+                keys[idx].startswith(query)):
+            key, name, subtype, title = entries[idx]
+            found.append(Completion(kind, name, subtype, title))
+            idx += 1
+
+        return found
+
+
+def document_definitions(doc):
+    # (kind, name, subtype) of everything a document defines in document
+    # order. Sections a lazily read document hasn't built are only searched.
+    for section in doc.sections:
+        name = _parse_name(section.content)
+
+        if name is not None:
+            yield (document.D_SECTION,) + name
+
+        for kind in sorted(costs.INDEXED_KINDS - set([document.D_SECTION])):
+            for arguments in document.scan_directives(section, kind):
+                name = _parse_name(arguments)
+
+                if name is not None:
+                    yield (kind,) + name
+
+
+def workspace_completions(cfg):
+    # The index of the configured document and every other document in the
+    # workspace, cached in .nds until one of them changes. Names the
+    # document defines itself come before the same names elsewhere.
+    index = symbols.workspace_index(cfg)
+    workspace = dict((path, entry['sha1'])
+                     for path, entry in index.documents.items()
+                     if entry['title'] is not None)
+
+    with config.WorkspaceLock(exclusive=True):
+        cached = read_index()
+
+        if _fresh(cached, cfg, workspace):
+            return cached
+
+        doc = document.read(cfg.document_file, lazy=True)
+        files = doc.files or [cfg.document_file]
+
+        definitions = [(kind, name, subtype, doc.title) for kind, name, subtype
+                       in document_definitions(doc)]
+
+        for path in sorted(workspace):
+            entry = index.documents[path]
+
+            for kind, name, node_id, content in entry['symbols']:
+                subtype = _parse_name(content)[1]
+                definitions.append((kind, name, subtype, entry['title']))
+
+        completions = CompletionIndex.build(
+            definitions, [[path, _sha1(path)] for path in files], workspace)
+        write_index(completions)
+
+        return completions
+
+
+def read_index():
+    if not os.path.isfile(config.COMPLETIONS_FILE):
+        return CompletionIndex()
+
+    with open(config.COMPLETIONS_FILE, 'r') as fin:
+        try:
+            return CompletionIndex.from_json(fin.read())
+        except ValueError:
+            # The index is only a cache, so a damaged one is rebuilt
+            return CompletionIndex()
+
+
+def write_index(index):
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(config.COMPLETIONS_FILE), prefix='.completions-')
+
+    try:
+        with os.fdopen(fd, 'w') as fout:
+            fout.write(index.to_json())
+
+        os.rename(tmp_path, config.COMPLETIONS_FILE)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def _fresh(index, cfg, workspace):
+    if len(index.files) == 0 or index.files[0][0] != cfg.document_file:
+        return False
+
+    if index.workspace != workspace:
+        return False
+
+    # Whatever the document includes can only have changed if one of the
+    # files it was read from did
+    try:
+        return all(_sha1(path) == sha1 for path, sha1 in index.files)
+    except (IOError, OSError, document.DocumentError):
+        return False
+
+
+def _sha1(path):
+    return hashlib.sha1(document.read_source(path)).hexdigest()
+
+
+def _parse_name(content):
+    try:
+        return export.parse_name(content or '')
+    except export.ExportError:
+        # Grants can't name these either
+        return None
+
+
+def _key(name, subtype):
+    if subtype is None:
+        return name.lower()
+
+    return name.lower() + _SUBTYPE_SEP + subtype.strip().lower()
+
+
+def _query(prefix):
+    name, bracket, subtype = prefix.lstrip().partition('(')
+
+    if len(bracket) == 0:
+        return name.lower()
+
+    return (name.strip().lower() + _SUBTYPE_SEP +
+            subtype.rstrip(')').lstrip().lower())
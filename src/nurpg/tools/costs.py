@@ -0,0 +1,403 @@
+import nurpg.error as error
+import nurpg.document as document
+import nurpg.memprofile as memprofile
+
+import nurpg.tools.export as export
+
+
+# Kinds that may be referenced by name from a grant
+INDEXED_KINDS = frozenset([
+    document.D_SECTION,
+    document.D_FEATURE,
+    document.D_MECHANIC,
+    document.D_EFFECT,
+    document.D_ABILITY,
+    document.D_ASPECT
+])
+
+# Kinds whose AP total is derived from the grants they carry
+COMPOSITE_KINDS = frozenset([
+    document.D_ABILITY,
+    document.D_ASPECT
+])
+
+
+class CostGraphError(error.ErrorMessage):
+    pass
+
+
+class CostGraph(object):
+
+    def __init__(self, doc):
+        self._doc = doc
+
+        # id -> node for every indexed node
+        self._nodes = dict()
+
+        # id -> (kind, name) that the node is indexed under
+        self._keys = dict()
+
+        # (kind, name) -> list of node ids in document order
+        self._by_name = dict()
+
+        # (kind, name) -> set of composite ids that have a grant for it
+        self._referrers = dict()
+
+        # id -> local cost: summed @cost values or, for abilities, the
+        # difficulty modifier
+        self._local = dict()
+
+        # composite id -> list of (target id, multiplier)
+        self._edges = dict()
+
+        # composite id -> list of (kind, name) keys its grants refer to
+        self._grant_keys = dict()
+
+        # target id -> set of composite ids that grant it
+        self._dependents = dict()
+
+        # composite id -> AP total
+        self._totals = dict()
+
+        for node in _walk(doc.root):
+            self._index(node)
+
+        self._recompute(set(self._nodes))
+
+    def __contains__(self, node):
+        return _node_id(node) in self._nodes
+
+    def cost(self, node):
+        node_id = _node_id(node)
+
+        if node_id in self._totals:
+            return self._totals[node_id]
+
+        if node_id not in self._local:
+            raise CostGraphError('Node {} is not part of the cost '
+                                 'graph.'.format(node_id))
+
+        return self._local[node_id]
+
+    def node(self, node_id):
+        return self._nodes[node_id]
+
+    def totals(self):
+        return dict(self._totals)
+
+    def grants(self, node):
+        # (target node, multiplier) for every node a composite's grants
+        # resolve to
+        return [(self._nodes[target_id], multiplier) for target_id, multiplier
+                in self._edges.get(_node_id(node), ())]
+
+    def dependents(self, node):
+        # Every composite that would need a new total if this node changed
+        return [self._nodes[node_id] for node_id in
+                self._closure([_node_id(node)]) if node_id in self._totals]
+
+    def update(self, nodes):
+        # Nodes may have been edited in place, newly inserted or may be the
+        # @cost, @difficulty or @grants children of an indexed node. Indexed
+        # nodes they're beneath take the place of any node with their id, so
+        # the graph can follow another version of the document.
+        dirty = set()
+
+        for node in nodes:
+            # New subtrees need to be indexed before anything else
+            for child in _walk(node, include_root=True):
+                if child.id not in self._nodes:
+                    dirty.update(self._index(child))
+
+            # Costs bubble up to every indexed ancestor through find()
+            for owner in _owners(node):
+                if owner.id in self._nodes:
+                    dirty.update(self._reindex(owner))
+
+        return self._recompute(dirty)
+
+    def remove(self, nodes):
+        dirty = set()
+
+        for node in nodes:
+            for child in _walk(node, include_root=True):
+                if child.id in self._nodes:
+                    dirty.update(self._unindex(child.id))
+
+            # The former parent may have lost a @cost or a @grants
+            for owner in _owners(node.parent):
+                if owner.id in self._nodes:
+                    dirty.update(self._reindex(owner))
+
+        dirty.intersection_update(self._nodes)
+        return self._recompute(dirty)
+
+    def what_if(self, edits):
+        # Edits map a node (or node id) to a new value: indexed nodes take a
+        # new local cost while @cost and @difficulty nodes take their new
+        # argument. Only an overlay is computed, nothing here is modified.
+        local = dict()
+
+        for node, value in edits.items():
+            for node_id, delta in self._local_deltas(node, value):
+                current = local.get(node_id, self._local[node_id])
+                local[node_id] = current + delta
+
+        totals = dict()
+        order = self._ordered(self._closure(local))
+
+        for node_id in order:
+            if node_id in self._totals:
+                totals[node_id] = self._total(node_id, local, totals)
+
+        deltas = dict()
+        for node_id, total in totals.items():
+            if total != self._totals[node_id]:
+                deltas[node_id] = total - self._totals[node_id]
+
+        return deltas
+
+    def _local_deltas(self, node, value):
+        if not hasattr(node, 'kind'):
+            node = self._nodes[node]
+
+        if node.id in self._nodes:
+            return [(node.id, int(value) - self._local[node.id])]
+
+        if node.kind == document.D_COST:
+            delta = int(value) - int(node.content)
+            return [(owner.id, delta) for owner in _owners(node.parent)
+                    if owner.id in self._nodes and
+                    owner.kind != document.D_ABILITY]
+
+        if node.kind == document.D_DIFFICULTY:
+            delta = (export.difficulty_cost(value) -
+                     export.difficulty_cost(node.content))
+            return [(owner.id, delta) for owner in _owners(node.parent)
+                    if owner.kind == document.D_ABILITY]
+
+        raise CostGraphError('Unable to apply a cost edit to a {} '
+                             'node.'.format(node.kind))
+
+    def _index(self, node):
+        if node.kind not in INDEXED_KINDS:
+            return set()
+
+        key = _name_key(node)
+
+        self._nodes[node.id] = node
+        self._keys[node.id] = key
+        self._by_name.setdefault(key, list()).append(node.id)
+        self._local[node.id] = _local_cost(node)
+
+        # Composites are linked once everything has been indexed
+        if node.kind in COMPOSITE_KINDS:
+            self._totals[node.id] = 0
+
+        # Anything that already granted this name now resolves to it
+        dirty = set(self._referrers.get(key, ()))
+        dirty.add(node.id)
+        return dirty
+
+    def _unindex(self, node_id):
+        key = self._keys.pop(node_id)
+        node = self._nodes.pop(node_id)
+
+        self._by_name[key].remove(node_id)
+        self._unlink(node_id)
+
+        del self._local[node_id]
+        self._totals.pop(node_id, None)
+
+        dirty = set(self._referrers.get(key, ()))
+        dirty.update(self._dependents.pop(node_id, ()))
+        return dirty
+
+    def _reindex(self, node):
+        dirty = set([node.id])
+        key = _name_key(node)
+
+        self._nodes[node.id] = node
+
+        # Renamed nodes change which grants resolve to them
+        if key != self._keys[node.id]:
+            old_key = self._keys[node.id]
+
+            self._by_name[old_key].remove(node.id)
+            self._by_name.setdefault(key, list()).append(node.id)
+            self._keys[node.id] = key
+
+            dirty.update(self._referrers.get(old_key, ()))
+            dirty.update(self._referrers.get(key, ()))
+
+        self._local[node.id] = _local_cost(node)
+        return dirty
+
+    def _link(self, node):
+        edges = list()
+        keys = list()
+
+        for grant in node.find(document.D_GRANTS):
+            kind, name, subtype, multiplier = export.parse_grant_spec(
+                grant.content)
+
+            key = (kind, name)
+            keys.append(key)
+            self._referrers.setdefault(key, set()).add(node.id)
+
+            for target_id in self._by_name.get(key, ()):
+                edges.append((target_id, multiplier))
+                self._dependents.setdefault(target_id, set()).add(node.id)
+
+        self._edges[node.id] = edges
+        self._grant_keys[node.id] = keys
+
+    def _unlink(self, node_id):
+        for target_id, multiplier in self._edges.pop(node_id, ()):
+            self._dependents.get(target_id, set()).discard(node_id)
+
+        for key in self._grant_keys.pop(node_id, ()):
+            self._referrers[key].discard(node_id)
+
+    def _closure(self, node_ids):
+        # Walk the reverse edges to find everything that needs recomputing
+        seen = set(node_ids)
+        stack = list(seen)
+
+        while len(stack) > 0:
+            for dependent in self._dependents.get(stack.pop(), ()):
+                if dependent not in seen:
+                    seen.add(dependent)
+                    stack.append(dependent)
+
+        return seen
+
+    def _ordered(self, node_ids):
+        # Kahn's algorithm restricted to the affected nodes: a composite is
+        # ready once every target in the set has been computed
+        waiting = dict()
+        ready = list()
+
+        for node_id in node_ids:
+            count = 0
+
+            for target_id, multiplier in self._edges.get(node_id, ()):
+                if target_id in node_ids and target_id != node_id:
+                    count += 1
+                elif target_id == node_id:
+                    raise CostGraphError('Grant cycle detected at {}.'.format(
+                        self._nodes[node_id].content))
+
+            waiting[node_id] = count
+
+            if count == 0:
+                ready.append(node_id)
+
+        order = list()
+
+        while len(ready) > 0:
+            node_id = ready.pop()
+            order.append(node_id)
+
+            for dependent in self._dependents.get(node_id, ()):
+                if dependent not in waiting:
+                    continue
+
+                waiting[dependent] -= sum(
+                    1 for target_id, multiplier in self._edges[dependent]
+                    if target_id == node_id)
+
+                if waiting[dependent] == 0:
+                    ready.append(dependent)
+
+        if len(order) < len(node_ids):
+            cycle = [self._nodes[node_id].content for node_id in node_ids
+                     if waiting[node_id] > 0]
+
+            raise CostGraphError('Grant cycle detected between: {}'.format(
+                ', '.join(sorted(cycle))))
+
+        return order
+
+    def _recompute(self, dirty):
+        # Rebuild the grant edges of any dirty composite before ordering
+        for node_id in dirty:
+            if node_id in self._totals:
+                self._unlink(node_id)
+                self._link(self._nodes[node_id])
+
+        changed = dict()
+
+        for node_id in self._ordered(self._closure(dirty)):
+            if node_id not in self._totals:
+                continue
+
+            total = self._total(node_id, self._local, self._totals)
+
+            if total != self._totals[node_id]:
+                changed[node_id] = total - self._totals[node_id]
+
+            self._totals[node_id] = total
+
+        return changed
+
+    def _total(self, node_id, local, totals):
+        node = self._nodes[node_id]
+        ap_cost = 0
+
+        # Aspect @cost values only matter when the aspect is granted
+        if node.kind == document.D_ABILITY:
+            ap_cost += local.get(node_id, self._local[node_id])
+
+        for target_id, multiplier in self._edges[node_id]:
+            target = self._nodes[target_id]
+
+            if target.kind == document.D_ABILITY:
+                ap_cost += totals.get(target_id, self._totals[target_id])
+            else:
+                ap_cost += local.get(target_id,
+                                     self._local[target_id]) * multiplier
+
+        return ap_cost
+
+
+def build(doc):
+    with memprofile.phase(memprofile.COSTS):
+        return CostGraph(doc)
+
+
+def _node_id(node):
+    return node.id if hasattr(node, 'id') else node
+
+
+def _name_key(node):
+    try:
+        name, subtype = export.parse_name(node.content or '')
+    except export.ExportError:
+        # Unparsable names can still carry costs, they just can't be granted
+        name = node.content
+
+    return (node.kind, name)
+
+
+def _local_cost(node):
+    if node.kind == document.D_ABILITY:
+        return sum(export.difficulty_cost(difficulty.content)
+                   for difficulty in node.find(document.D_DIFFICULTY))
+
+    return sum(int(cost.content) for cost in node.find(document.D_COST))
+
+
+def _owners(node):
+    while node is not None:
+        yield node
+        node = node.parent
+
+
+def _walk(root, include_root=False):
+    stack = [root] if include_root else list(reversed(root.children))
+
+    while len(stack) > 0:
+        node = stack.pop()
+        yield node
+        stack.extend(reversed(node.children))
@@ -0,0 +1,216 @@
+import nurpg.document as document
+
+import nurpg.tools.costs as costs
+
+
+# Change types
+ADDED = 'added'
+REMOVED = 'removed'
+MODIFIED = 'modified'
+
+# Console markers for each change type
+_MARKERS = {
+    ADDED: '+',
+    REMOVED: '-',
+    MODIFIED: '~'
+}
+
+
+class Change(object):
+
+    def __init__(self, change, node, previous=None, parent=None):
+        self.change = change
+        self.node = node
+        self.previous = previous
+
+        # The new node a removed node was taken out of
+        self.parent = parent
+
+    def __str__(self):
+        return '{} {} @{} {}'.format(
+            _MARKERS[self.change], self.node.id, self.node.kind,
+            _summary(self.node.content))
+
+
+class CostChange(object):
+
+    def __init__(self, node, before, after):
+        self.node = node
+        self.before = before
+        self.after = after
+
+    @property
+    def delta(self):
+        return self.after - self.before
+
+    def __str__(self):
+        return '$ {} AP {} -> {} ({:+d})'.format(
+            self.node.id, self.before, self.after, self.delta)
+
+
+def diff(old_doc, new_doc):
+    changes = list()
+
+    # Only descend into subtrees whose merkle hashes differ. Node ids are
+    # path derived so children are paired up by id.
+    stack = [(old_doc.root, new_doc.root)]
+
+    while len(stack) > 0:
+        old_node, new_node = stack.pop()
+
+        if old_node.hash == new_node.hash:
+            continue
+
+        if (old_node.kind != new_node.kind or
+                old_node.content != new_node.content):
+            changes.append(Change(MODIFIED, new_node, old_node))
+
+        old_children = dict((child.id, child) for child in old_node.children)
+        pending = list()
+
+        for child in new_node.children:
+            previous = old_children.pop(child.id, None)
+
+            if previous is None:
+                changes.append(Change(ADDED, child))
+            else:
+                pending.append((previous, child))
+
+        for child in old_node.children:
+            if child.id in old_children:
+                changes.append(Change(REMOVED, child, parent=new_node))
+
+        stack.extend(reversed(pending))
+
+    return changes
+
+
+def cost_changes(old_doc, new_doc, changes=None):
+    # The cost graph of the old document is brought up to date with only
+    # the nodes the merkle diff found, so the work follows the size of the
+    # change rather than of the document. Nodes whose subtree didn't change
+    # are left as the old document's, they're the same either way.
+    if changes is None:
+        changes = diff(old_doc, new_doc)
+
+    graph = costs.build(old_doc)
+
+    if _shifts_ids(graph, changes):
+        return _rebuilt_cost_changes(graph, new_doc)
+
+    removed = [change.node for change in changes if change.change == REMOVED]
+    updated = [change.node for change in changes if change.change != REMOVED]
+
+    # What a node was removed from has lost a @cost or a @grants. Nothing
+    # at the root carries one.
+    updated.extend(change.parent for change in changes
+                   if change.change == REMOVED and
+                   change.parent.kind != document.D_ROOT)
+
+    # Totals of composites that go and may come back under the same id,
+    # and the ids of those that are new
+    before = dict((node.id, graph.cost(node)) for node in _composites(
+        graph, removed))
+
+    deltas = graph.remove(removed)
+    added = set(node.id for change in changes if change.change == ADDED
+                for node in document._walk(change.node, include_root=True)
+                if node.id not in graph and node.id not in before)
+
+    for node_id, delta in graph.update(updated).items():
+        deltas[node_id] = deltas.get(node_id, 0) + delta
+
+    found = list()
+
+    for node_id in sorted(set(deltas) | set(before)):
+        if node_id in added or node_id not in graph:
+            continue
+
+        node = graph.node(node_id)
+
+        if node.kind not in costs.COMPOSITE_KINDS:
+            continue
+
+        after = graph.cost(node)
+        previous = before.get(node_id, after - deltas.get(node_id, 0))
+
+        if previous != after:
+            found.append(CostChange(node, previous, after))
+
+    return found
+
+
+def _rebuilt_cost_changes(old_graph, new_doc):
+    old_totals = old_graph.totals()
+    new_graph = costs.build(new_doc)
+
+    changes = list()
+
+    for node_id, after in sorted(new_graph.totals().items()):
+        before = old_totals.get(node_id)
+
+        if before is not None and before != after:
+            changes.append(CostChange(
+                new_graph.node(node_id), before, after))
+
+    return changes
+
+
+def _shifts_ids(graph, changes):
+    # Element ids only take a suffix when their name is already taken, in
+    # document order. Adding or removing one that shares its name with
+    # another may move the suffixes of elements whose subtrees didn't
+    # change, which the diff never visits.
+    removed = dict()
+    added = list()
+
+    for change in changes:
+        if change.change == MODIFIED:
+            continue
+
+        for node in document._walk(change.node, include_root=True):
+            if node.kind not in costs.INDEXED_KINDS:
+                continue
+
+            base = document.child_id(node.parent, node.kind, node.content)
+
+            if change.change == REMOVED:
+                if _holders(graph, base) > 1:
+                    return True
+
+                removed[base] = removed.get(base, 0) + 1
+            else:
+                added.append(base)
+
+    return any(_holders(graph, base) > removed.get(base, 0)
+               for base in added)
+
+
+def _holders(graph, base):
+    # How many indexed nodes have base or a suffixed form of it as their id,
+    # the second taking base-2 and so on
+    if base not in graph:
+        return 0
+
+    count = 1
+
+    while document.ID_SUFFIX.format(base, count + 1) in graph:
+        count += 1
+
+    return count
+
+
+def _composites(graph, nodes):
+    for node in nodes:
+        for child in document._walk(node, include_root=True):
+            if child.kind in costs.COMPOSITE_KINDS and child in graph:
+                yield child
+
+
+def _summary(content, limit=60):
+    summary = ' '.join((content or '').split())
+
+    if len(summary) > limit:
+        return summary[:limit - 3] + '...'
+
+    return summary
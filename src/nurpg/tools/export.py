@@ -2,6 +2,7 @@ import re
 import fnmatch
 
 import nurpg.html as html
+import nurpg.error as error
 import nurpg.document as document
 
 
@@ -22,6 +23,10 @@ _REPLACEMENT_PATTERN = '<>'
 _SUBTYPE_REPLACEMENT_PATTERN = '(<>)'
 
 
+class ExportError(error.ErrorMessage):
+    pass
+
+
 ###
 # Formatters
 ###
@@ -46,7 +51,7 @@ def parse_name(name):
     match = _NAME_REGEX.match(name)
 
     if match is None:
-        raise ToolError('Unable to parse name: {}'.format(name))
+        raise ExportError('Unable to parse name: {}'.format(name))
 
     # Bind all of the good bits to names
     clean_name = match.group(1).strip()
@@ -60,7 +65,7 @@ def parse_grant_spec(content):
     match = _GRANT_REGEX.match(content)
 
     if match is None:
-        raise ToolError('Unable to parse grant statement: {}'.format(content))
+        raise ExportError('Unable to parse grant statement: {}'.format(content))
 
     # Bind all of the good bits to names
     kind = match.group(1).strip()
@@ -94,7 +99,7 @@ def parse_grant(doc, grant):
 
         return (ref.id, kind, ''.join(grant_title))
 
-    raise ToolError('Unable to locate ref: {}'.format(kind))
+    raise ExportError('Unable to locate ref: {}'.format(kind))
 
 
 def grant_cost(doc, grant):
@@ -116,13 +121,18 @@ def grant_cost(doc, grant):
     return ap_cost
 
 
+def difficulty_cost(difficulty):
+    # Every 5 points of difficulty away from 15 is worth one AP
+    cost_magnitude = int(difficulty) - 15
+    return -(cost_magnitude // 5)
+
+
 def ability_cost(doc, ability):
     ap_cost = 0
 
     for difficulty in ability.find(document.D_DIFFICULTY):
         # Check to see if the base difficulty modifies the AP cost
-        cost_magnitude = int(difficulty.content) - 15
-        ap_cost += -(cost_magnitude / 5)
+        ap_cost += difficulty_cost(difficulty.content)
 
     for grant in ability.find(document.D_GRANTS):
         ap_cost += grant_cost(doc, grant)
@@ -131,12 +141,44 @@ def ability_cost(doc, ability):
 
 
 ###
-# Render Functions
+# Render Pieces
 ###
 
-def render_mechanic(doc, mechanic):
-    yield html.style_attr('font-size: 10pt;')
-    yield html.div(
+def render_heading(element):
+    return html.div(
+        html.id_attr(element.id),
+        html.h4(format_name(element.content)))
+
+
+def render_ap_cost(ap_cost, shown=None):
+    return html.div(
+        html.style_attr('font-size: 10pt;'),
+
+        html.span(
+            # Make sure the text is bold
+            html.style_attr('font-weight: bold;'),
+
+            'Aspect Point {}: '.format(
+                'Cost' if ap_cost >= 0 else 'Return')
+        ),
+
+        html.span(ap_cost if shown is None else shown))
+
+
+def render_cost(cost):
+    # A @cost is shown just as it was written
+    return render_ap_cost(int(cost.content), cost.content)
+
+
+def render_paragraph(node):
+    return html.p(
+        html.style_attr('font-size: 10pt;'),
+        format_content(node.content)
+    )
+
+
+def render_mechanic_heading(mechanic):
+    return html.div(
         html.id_attr(mechanic.id),
         html.style_attr('font-size: 10pt;'),
 
@@ -147,91 +189,111 @@ def render_mechanic(doc, mechanic):
         ),
         html.span(format_name(mechanic.content)))
 
-    for child in mechanic.children:
-        if child.kind == document.D_COST:
-            yield html.div(
-                html.style_attr('font-size: 10pt;'),
 
-                html.span(
-                    # Make sure the text is bold
-                    html.style_attr('font-weight: bold;'),
+def render_effect_mechanic(mechanic):
+    return html.div(
+        # Make sure the text is bold
+        html.style_attr('font-weight: bold; font-size: 10pt;'),
+
+        'Effect Mechanic: ', mechanic.content
+    )
+
+
+def render_effect_cost(cost):
+    return html.div(
+        # Make sure the text is bold
+        html.style_attr('font-weight: bold; font-size: 10pt;'),
+
+        html.span(
+            'AP Cost: ', cost.content
+        )
+    )
+
+
+def render_difficulty(difficulty):
+    return html.div(
+        html.style_attr('font-size: 10pt;'),
+
+        html.span(
+            # Make sure the text is bold
+            html.style_attr('font-weight: bold;'),
+
+            'Difficulty: '
+        ),
+
+        html.span(difficulty.content))
 
-                    'Aspect Point {}: '.format(
-                        'Cost' if int(child.content) >= 0 else 'Return')
-                ),
 
-                html.span(child.content))
+def render_reference(label, reference, href=None):
+    # A grant or requirement linking to the node it resolved to, which is on
+    # this page unless an href says otherwise
+    ref_id, kind, title = reference
+
+    if href is None:
+        href = '#{}'.format(ref_id)
+
+    return html.div(
+        html.style_attr('font-size: 10pt; padding-top: 5px;'),
+
+        html.span(
+            # Make sure the text is bold
+            html.style_attr('font-weight: bold;'),
+
+            '{} {}: '.format(label, kind.title())
+        ),
+
+        html.span(
+            html.a(
+                html.attribute('href', href),
+                ''.join(title))))
+
+
+###
+# Render Functions
+###
+
+def render_mechanic(doc, mechanic):
+    yield html.style_attr('font-size: 10pt;')
+    yield render_mechanic_heading(mechanic)
+
+    for child in mechanic.children:
+        if child.kind == document.D_COST:
+            yield render_cost(child)
 
         else:
-            yield html.p(
-                html.style_attr('font-size: 10pt;'),
-                format_content(child.content))
+            yield render_paragraph(child)
 
 
 def render_feature(doc, feature):
-    yield html.div(
-        html.id_attr(feature.id),
-        html.h4(format_name(feature.content)))
+    yield render_heading(feature)
 
     for child in feature.children:
         if child.kind == document.D_MECHANIC:
             yield html.div(render_mechanic(doc, child))
 
         elif child.kind == document.D_COST:
-            yield html.div(
-                html.style_attr('font-size: 10pt;'),
-
-                html.span(
-                    # Make sure the text is bold
-                    html.style_attr('font-weight: bold;'),
-
-                    'Aspect Point {}: '.format(
-                        'Cost' if int(child.content) >= 0 else 'Return')
-                ),
-
-                html.span(child.content))
+            yield render_cost(child)
 
         else:
-            yield html.p(
-                html.style_attr('font-size: 10pt;'),
-                format_content(child.content))
+            yield render_paragraph(child)
 
 
 def render_effect(doc, effect):
-    yield html.div(
-        html.id_attr(effect.id),
-        html.h4(format_name(effect.content)))
+    yield render_heading(effect)
 
     for child in effect.children:
         if child.kind == document.D_MECHANIC:
-            yield html.div(
-                # Make sure the text is bold
-                html.style_attr('font-weight: bold; font-size: 10pt;'),
-
-                'Effect Mechanic: ', child.content
-            )
+            yield render_effect_mechanic(child)
 
         elif child.kind == document.D_COST:
-            yield html.div(
-                # Make sure the text is bold
-                html.style_attr('font-weight: bold; font-size: 10pt;'),
-
-                html.span(
-                    'AP Cost: ', child.content
-                )
-            )
+            yield render_effect_cost(child)
 
         else:
-            yield html.p(
-                html.style_attr('font-size: 10pt;'),
-                format_content(child.content)
-            )
+            yield render_paragraph(child)
 
 
 def render_aspect(doc, aspect):
-    yield html.div(
-        html.id_attr(aspect.id),
-        html.h4(format_name(aspect.content)))
+    yield render_heading(aspect)
 
     # Figure out some important stuff
     ap_cost = 0
@@ -240,18 +302,7 @@ def render_aspect(doc, aspect):
         cost = grant_cost(doc, grant)
         ap_cost += cost
 
-    yield html.div(
-        html.style_attr('font-size: 10pt;'),
-
-        html.span(
-            # Make sure the text is bold
-            html.style_attr('font-weight: bold;'),
-
-            'Aspect Point {}: '.format(
-                'Cost' if ap_cost >= 0 else 'Return')
-        ),
-
-        html.span(ap_cost))
+    yield render_ap_cost(ap_cost)
 
     for child in aspect.children:
         if child.kind == document.D_GRANTS:
@@ -259,106 +310,43 @@ def render_aspect(doc, aspect):
         elif child.kind == document.D_REQUIRES:
             yield render_requires(doc, child)
         else:
-            yield html.p(
-                html.style_attr('font-size: 10pt;'),
-                format_content(child.content)
-            )
+            yield render_paragraph(child)
 
 
 def render_requires(doc, reqires):
-    ref_id, kind, reqires_title = parse_grant(doc, reqires)
-
-    return html.div(
-        html.style_attr('font-size: 10pt; padding-top: 5px;'),
-
-        html.span(
-            # Make sure the text is bold
-            html.style_attr('font-weight: bold;'),
-
-            'Requires {}: '.format(kind.title())
-        ),
-
-        html.span(
-            html.a(
-                html.attribute('href', '#{}'.format(ref_id)),
-                ''.join(reqires_title))))
+    return render_reference('Requires', parse_grant(doc, reqires))
 
 
 def render_grant(doc, grant):
-    ref_id, kind, grant_title = parse_grant(doc, grant)
-
-    return html.div(
-        html.style_attr('font-size: 10pt; padding-top: 5px;'),
-
-        html.span(
-            # Make sure the text is bold
-            html.style_attr('font-weight: bold;'),
-
-            'Grants {}: '.format(kind.title())
-        ),
-
-        html.span(
-            html.a(
-                html.attribute('href', '#{}'.format(ref_id)),
-                ''.join(grant_title))))
+    return render_reference('Grants', parse_grant(doc, grant))
 
 
 def render_ability(doc, ability):
-    yield html.div(
-        html.id_attr(ability.id),
-        html.h4(format_name(ability.content)))
+    yield render_heading(ability)
 
     # Figure out some important stuff
-    ap_cost = ability_cost(doc, ability)
-
-    yield html.div(
-        html.style_attr('font-size: 10pt;'),
-
-        html.span(
-            # Make sure the text is bold
-            html.style_attr('font-weight: bold;'),
-
-            'Aspect Point {}: '.format(
-                'Cost' if ap_cost >= 0 else 'Return')
-        ),
-
-        html.span(ap_cost))
+    yield render_ap_cost(ability_cost(doc, ability))
 
     for child in ability.children:
         if child.kind == document.D_GRANTS:
             yield render_grant(doc, child)
         elif child.kind == document.D_DIFFICULTY:
-            yield html.div(
-                html.style_attr('font-size: 10pt;'),
-
-                html.span(
-                    # Make sure the text is bold
-                    html.style_attr('font-weight: bold;'),
-
-                    'Difficulty: '
-                ),
-
-                html.span(child.content))
+            yield render_difficulty(child)
         else:
-            yield html.p(
-                html.style_attr('font-size: 10pt;'),
-                format_content(child.content)
-            )
+            yield render_paragraph(child)
 
 
 def render_section(doc, section):
     yield html.h3(section.content)
 
     for child in section.children:
-        if child.kind in [document.D_FEATURE, document.D_EFFECT, document.D_ABILITY, document.D_ASPECT]:
-            render_func = globals()['render_{}'.format(child.kind)]
+        render_func = SECTION_RENDERERS.get(child.kind)
+
+        if render_func is not None:
             yield html.div(render_func(doc, child))
 
         else:
-            yield html.p(
-                html.style_attr('font-size: 10pt;'),
-                format_content(child.content)
-            )
+            yield render_paragraph(child)
 
 
 def render_doc(doc):
@@ -370,3 +358,12 @@ def render_doc(doc):
 
     for section in doc.sections:
         yield render_section(doc, section)
+
+
+# The elements a section renders with their own function
+SECTION_RENDERERS = {
+    document.D_FEATURE: render_feature,
+    document.D_EFFECT: render_effect,
+    document.D_ABILITY: render_ability,
+    document.D_ASPECT: render_aspect
+}
@@ -0,0 +1,201 @@
+import fnmatch
+
+import nurpg.error as error
+import nurpg.document as document
+
+import nurpg.tools.export as export
+
+
+# References that pull whatever they name into a handout
+_REFERENCES = frozenset([
+    document.D_GRANTS,
+    document.D_REQUIRES,
+    document.D_REF
+])
+
+
+class HandoutError(error.ErrorMessage):
+    pass
+
+
+# A few sections of a document along with everything they need through
+# grants, requires and refs, so AP totals and links come out as they do in
+# the whole document. Needed elements are taken whole from the section they
+# live in, which holds everything their own costs depend on. Only sections
+# that are selected or define something needed are ever built, the rest
+# are only searched by name, so the work follows the size of the handout
+# rather than the size of the document. Ids are assigned across the handout
+# itself, so they only match the whole document's where no name collides
+# with one in a section that was left out.
+class Handout(object):
+
+    def __init__(self, doc, patterns):
+        self.doc = doc
+        self.patterns = [pattern.lower() for pattern in patterns]
+        self.sections = list(doc.sections)
+
+        # section -> detached copy of the section with its body built
+        self._built = dict()
+
+        # section -> None when it's included whole, otherwise the ids of
+        # the elements included from it
+        self._included = dict()
+
+        # kind -> (name -> sections defining it in document order)
+        self._definitions = dict()
+
+        # (kind, name) references already followed
+        self._followed = set()
+
+        # Included nodes whose references haven't been followed yet
+        self._pending = list()
+
+    def build(self):
+        selected = [section for section in self.sections
+                    if self._selected(section)]
+
+        if len(selected) == 0:
+            raise HandoutError('No section matches {}.'.format(
+                ', '.join(self.patterns)))
+
+        for section in selected:
+            self._include_section(section)
+
+        while len(self._pending) > 0:
+            self._follow(self._pending.pop())
+
+        return self._document()
+
+    def _selected(self, section):
+        name = (section.content or '').lower()
+        return any(fnmatch.fnmatchcase(name, pattern)
+                   for pattern in self.patterns)
+
+    def _follow(self, node):
+        for ref in document._walk(node, include_root=True):
+            if ref.kind not in _REFERENCES:
+                continue
+
+            try:
+                kind, name, subtype, multiplier = export.parse_grant_spec(
+                    ref.content)
+            except export.ExportError:
+                # Rendering reports it the same way it would for the whole
+                # document
+                continue
+
+            if (kind, name) not in self._followed:
+                self._followed.add((kind, name))
+                self._require(kind, name)
+
+    def _require(self, kind, name):
+        if kind == document.D_SECTION:
+            for section in self.sections:
+                if _name(section) == name:
+                    self._include_section(section)
+
+            return
+
+        # Names the document doesn't define may come from the workspace
+        for section in self._defining(kind).get(name, ()):
+            copy = self._copy(section)
+
+            for element in copy.children:
+                if _defines(element, kind, name):
+                    self._include_element(section, element)
+
+    def _include_section(self, section):
+        if section in self._included and self._included[section] is None:
+            return
+
+        self._included[section] = None
+        self._pending.append(self._copy(section))
+
+    def _include_element(self, section, element):
+        included = self._included.setdefault(section, set())
+
+        if included is None or element.id in included:
+            return
+
+        included.add(element.id)
+        self._pending.append(element)
+
+    def _copy(self, section):
+        copy = self._built.get(section)
+
+        if copy is None:
+            copy = self._built[section] = document.detached_section(section)
+
+        return copy
+
+    def _defining(self, kind):
+        definitions = self._definitions.get(kind)
+
+        if definitions is not None:
+            return definitions
+
+        definitions = self._definitions[kind] = dict()
+
+        for section in self.sections:
+            for arguments in document.scan_directives(section, kind):
+                try:
+                    name = export.parse_name(arguments)[0]
+                except export.ExportError:
+                    continue
+
+                defining = definitions.setdefault(name, list())
+
+                if len(defining) == 0 or defining[-1] is not section:
+                    defining.append(section)
+
+        return definitions
+
+    def _document(self):
+        handout = document.Document()
+
+        for node in self.doc.root.children:
+            if node.kind in document.HEADERS:
+                handout.root.append(document.DocumentNode(
+                    node.kind, node.content))
+
+        for section in self.sections:
+            if section not in self._included:
+                continue
+
+            copy = self._built[section]
+            included = self._included[section]
+
+            if included is not None:
+                # Just the elements needed from it, in document order
+                shell = document.DocumentNode(copy.kind, copy.content)
+                shell.id = copy.id
+
+                for element in list(copy.children):
+                    if element.id in included:
+                        shell.append(element)
+
+                copy = shell
+
+            handout.root.append(copy)
+
+        handout.sync_header()
+        handout.assign_ids()
+        return handout
+
+
+def build(doc, patterns):
+    # The handout of every section whose name matches one of the patterns,
+    # e.g. 'Ranger *'. Matching ignores case.
+    return Handout(doc, patterns).build()
+
+
+def _name(node):
+    try:
+        return export.parse_name(node.content or '')[0]
+    except export.ExportError:
+        return None
+
+
+def _defines(element, kind, name):
+    return any(node.kind == kind and _name(node) == name
+               for node in document._walk(element, include_root=True))
@@ -0,0 +1,593 @@
+import re
+import time
+import textwrap
+
+import nurpg.html as html
+import nurpg.error as error
+import nurpg.document as document
+import nurpg.memprofile as memprofile
+
+import nurpg.tools.costs as costs
+import nurpg.tools.export as export
+import nurpg.tools.publish as publish
+
+
+# Formats the pipeline renders, named for their file extensions
+HTML = 'html'
+MARKDOWN = 'md'
+TEXT = 'txt'
+
+FORMATS = (HTML, MARKDOWN, TEXT)
+
+# Plain text is wrapped to this many columns for printing
+TEXT_WIDTH = 78
+
+# Markdown characters that would otherwise be read as formatting
+_MARKDOWN_SPECIAL_REGEX = re.compile(r'([\\`*_\[\]<>#])')
+
+# Kinds a section hands off to an element's handlers
+_ELEMENT_KINDS = (
+    document.D_FEATURE,
+    document.D_EFFECT,
+    document.D_ABILITY,
+    document.D_ASPECT
+)
+
+# Kinds whose children may hold an @ref
+_REF_PARENTS = (document.D_SECTION, document.D_MECHANIC) + _ELEMENT_KINDS
+
+# Walk actions: visit a node, or write what its handlers left for after its
+# children
+_ENTER = 0
+_LEAVE = 1
+
+
+class PipelineError(error.ErrorMessage):
+    pass
+
+
+# Resolution work that every backend needs, done once per export: AP totals
+# come from a single cost graph and each grant's target is looked up in a
+# per-kind index instead of searching the whole document per grant. Names
+# the document doesn't define are looked up in the workspace's symbols.
+class Resolver(object):
+
+    def __init__(self, doc, symbols=None):
+        self.doc = doc
+        self.symbols = symbols
+
+        self._graph = None
+
+        # kind -> (name -> (ref, subtype), error stopping the index or None)
+        self._indexes = dict()
+
+        # grant content -> ((ref id, kind, title), symbol or None)
+        self._references = dict()
+
+    def prepare(self):
+        # Builds the cost graph up front, e.g. before forking workers that
+        # would otherwise each build their own
+        if self._graph is None:
+            self._graph = costs.build(self.doc)
+
+    def cost(self, node):
+        self.prepare()
+        return self._graph.cost(node)
+
+    def reference(self, grant):
+        # The same (ref id, kind, title) that export.parse_grant gives
+        return self.resolve(grant)[0]
+
+    def resolve(self, grant):
+        # The reference along with the symbol it resolved to when it's
+        # defined in another document
+        resolved = self._references.get(grant.content)
+
+        if resolved is None:
+            resolved = self._resolve(grant.content)
+            self._references[grant.content] = resolved
+
+        return resolved
+
+    def _resolve(self, content):
+        kind, name, subtype, multiplier = export.parse_grant_spec(content)
+        names, failure = self._index(kind)
+        symbol = None
+
+        if name in names:
+            ref, ref_subtype = names[name]
+            ref_id, ref_content = ref.id, ref.content
+        else:
+            if self.symbols is not None:
+                symbol = self.symbols.lookup(kind, name)
+
+            if symbol is None:
+                # parse_grant would have reached the unparsable name first
+                if failure is not None:
+                    raise failure
+
+                raise export.ExportError('Unable to locate ref: {}'.format(
+                    kind))
+
+            ref_id, ref_content = symbol.id, symbol.content
+            ref_subtype = export.parse_name(ref_content)[1]
+
+        # If the ref_subtype is null then we simply ignore it
+        if ref_subtype == export._REPLACEMENT_PATTERN:
+            ref_subtype = subtype
+
+        title = [export.format_name(ref_content, ref_subtype)]
+
+        if multiplier > 1:
+            title.append(' x {}'.format(multiplier))
+
+        return (ref_id, kind, ''.join(title)), symbol
+
+    def _index(self, kind):
+        index = self._indexes.get(kind)
+
+        if index is not None:
+            return index
+
+        names = dict()
+        failure = None
+
+        for ref in document.find(self.doc.root, kind):
+            try:
+                ref_name, ref_subtype = export.parse_name(ref.content)
+            except export.ExportError as e:
+                # Nothing past an unparsable name can be resolved
+                failure = e
+                break
+
+            if ref_name not in names:
+                names[ref_name] = (ref, ref_subtype)
+
+        index = self._indexes[kind] = (names, failure)
+        return index
+
+
+# Renders one format from the nodes the visitor hands it. Handlers are
+# looked up by (parent kind, kind), falling back to (parent kind, None), and
+# return None to skip the node's children or the text to write once they've
+# been visited.
+class Backend(object):
+
+    extension = None
+
+    handlers = {
+        (document.D_ROOT, document.D_SECTION): 'section',
+        (document.D_SECTION, None): 'paragraph',
+        (document.D_FEATURE, document.D_MECHANIC): 'feature_mechanic',
+        (document.D_FEATURE, document.D_COST): 'cost',
+        (document.D_FEATURE, None): 'paragraph',
+        (document.D_MECHANIC, document.D_COST): 'cost',
+        (document.D_MECHANIC, None): 'paragraph',
+        (document.D_EFFECT, document.D_MECHANIC): 'effect_mechanic',
+        (document.D_EFFECT, document.D_COST): 'effect_cost',
+        (document.D_EFFECT, None): 'paragraph',
+        (document.D_ASPECT, document.D_GRANTS): 'grants',
+        (document.D_ASPECT, document.D_REQUIRES): 'requires',
+        (document.D_ASPECT, None): 'paragraph',
+        (document.D_ABILITY, document.D_GRANTS): 'grants',
+        (document.D_ABILITY, document.D_DIFFICULTY): 'difficulty',
+        (document.D_ABILITY, None): 'paragraph'
+    }
+
+    handlers.update(((document.D_SECTION, kind), 'element')
+                    for kind in _ELEMENT_KINDS)
+
+    handlers.update(((kind, document.D_REF), 'ref') for kind in _REF_PARENTS)
+
+    def __init__(self, resolver, out=None):
+        self.resolver = resolver
+        self.parts = list()
+
+        # Text goes straight to out when given, e.g. a StreamedFile, rather
+        # than being kept for output()
+        if out is not None:
+            self.write = out.write
+
+        # Bound once so visiting a node is a single lookup
+        self._dispatch = dict((key, getattr(self, name))
+                              for key, name in self.handlers.items())
+
+    def write(self, text):
+        self.parts.append(text)
+
+    def begin(self, doc):
+        pass
+
+    def end(self, doc):
+        pass
+
+    def visit(self, node):
+        parent_kind = node.parent.kind
+
+        handler = self._dispatch.get((parent_kind, node.kind))
+
+        if handler is None:
+            handler = self._dispatch.get((parent_kind, None))
+
+        if handler is None:
+            return None
+
+        return handler(node)
+
+    def output(self):
+        return ''.join(self.parts)
+
+
+# The single page export, built from the same pieces as export.render_doc
+# so the page comes out identical
+class HtmlBackend(Backend):
+
+    extension = HTML
+
+    def begin(self, doc):
+        self.write(_start_tag(html.html()))
+        self.write(html.head(html.title(doc.title))())
+        self.write(_start_tag(html.body()))
+        self.write(_start_tag(html.div(
+            html.style_attr('max-width: 1000px; margin-left: 50px;'))))
+
+        self.write(html.div(
+            html.style_attr('margin-left: 25px; padding-bottom: 5px;'),
+            html.h1(doc.title))())
+
+    def end(self, doc):
+        self.write('</div></body></html>')
+
+    def section(self, section):
+        self.write(html.h3(section.content)())
+        return ''
+
+    def element(self, element):
+        self.write(_start_tag(html.div()))
+        self.write(export.render_heading(element)())
+
+        if element.kind in costs.COMPOSITE_KINDS:
+            self.write(export.render_ap_cost(
+                self.resolver.cost(element))())
+
+        return '</div>'
+
+    def feature_mechanic(self, mechanic):
+        self.write(_start_tag(html.div(html.style_attr('font-size: 10pt;'))))
+        self.write(export.render_mechanic_heading(mechanic)())
+        return '</div>'
+
+    def cost(self, cost):
+        self.write(export.render_cost(cost)())
+
+    def effect_mechanic(self, mechanic):
+        self.write(export.render_effect_mechanic(mechanic)())
+
+    def effect_cost(self, cost):
+        self.write(export.render_effect_cost(cost)())
+
+    def difficulty(self, difficulty):
+        self.write(export.render_difficulty(difficulty)())
+
+    def grants(self, grant):
+        self._reference('Grants', grant)
+
+    def requires(self, requires):
+        self._reference('Requires', requires)
+
+    def ref(self, ref):
+        self._reference('See', ref)
+
+    def paragraph(self, node):
+        self.write(export.render_paragraph(node)())
+
+    def _reference(self, label, node):
+        reference, symbol = self.resolver.resolve(node)
+        href = symbol.href(HTML) if symbol is not None else None
+
+        self.write(export.render_reference(label, reference, href)())
+
+
+# Markdown with an anchor per element, so grants link the same way the html
+# export's do
+class MarkdownBackend(Backend):
+
+    extension = MARKDOWN
+
+    def begin(self, doc):
+        self.write('# {}\n\n'.format(_escape_markdown(doc.title or '')))
+
+    def section(self, section):
+        self.write('## {}\n\n'.format(_escape_markdown(section.content or '')))
+        return ''
+
+    def element(self, element):
+        self.write('<a id="{}"></a>\n\n### {}\n\n'.format(
+            element.id, _escape_markdown(export.format_name(element.content))))
+
+        if element.kind in costs.COMPOSITE_KINDS:
+            ap_cost = self.resolver.cost(element)
+            self._field(_ap_label(ap_cost), ap_cost)
+
+        return ''
+
+    def feature_mechanic(self, mechanic):
+        self.write('<a id="{}"></a>\n\n#### Feature Mechanic: {}\n\n'.format(
+            mechanic.id, _escape_markdown(export.format_name(mechanic.content))))
+        return ''
+
+    def cost(self, cost):
+        self._field(_ap_label(int(cost.content)), cost.content)
+
+    def effect_mechanic(self, mechanic):
+        self._field('Effect Mechanic', mechanic.content)
+
+    def effect_cost(self, cost):
+        self._field('AP Cost', cost.content)
+
+    def difficulty(self, difficulty):
+        self._field('Difficulty', difficulty.content)
+
+    def grants(self, grant):
+        self._reference('Grants', grant)
+
+    def requires(self, requires):
+        self._reference('Requires', requires)
+
+    def ref(self, ref):
+        self._reference('See', ref)
+
+    def paragraph(self, node):
+        lines = [_escape_markdown(line) for line in node.content.split('\n')
+                 if len(line) > 0]
+
+        # Hard breaks, as the html export keeps the document's line breaks
+        self.write('  \n'.join(lines) + '\n\n')
+
+    def _field(self, label, value):
+        self.write('**{}:** {}\n\n'.format(label, _escape_markdown(str(value))))
+
+    def _reference(self, label, node):
+        (ref_id, kind, title), symbol = self.resolver.resolve(node)
+
+        if symbol is not None:
+            href = symbol.href(MARKDOWN)
+        else:
+            href = '#{}'.format(ref_id)
+
+        self.write('**{} {}:** [{}]({})\n\n'.format(
+            label, kind.title(), _escape_markdown(title), href))
+
+
+# Plain text for printing: elements are indented beneath their section and
+# paragraphs wrapped to TEXT_WIDTH
+class TextBackend(Backend):
+
+    extension = TEXT
+
+    def begin(self, doc):
+        self._underlined(doc.title or '', '=')
+
+    def section(self, section):
+        self._underlined(section.content or '', '-')
+        return ''
+
+    def element(self, element):
+        self.write('{}\n'.format(export.format_name(element.content)))
+
+        if element.kind in costs.COMPOSITE_KINDS:
+            ap_cost = self.resolver.cost(element)
+            self._line(element, '{}: {}'.format(_ap_label(ap_cost), ap_cost),
+                       nested=1)
+
+        return '\n'
+
+    def feature_mechanic(self, mechanic):
+        self._line(mechanic, 'Feature Mechanic: {}'.format(
+            export.format_name(mechanic.content)))
+        return ''
+
+    def cost(self, cost):
+        self._line(cost, '{}: {}'.format(
+            _ap_label(int(cost.content)), cost.content))
+
+    def effect_mechanic(self, mechanic):
+        self._line(mechanic, 'Effect Mechanic: {}'.format(mechanic.content))
+
+    def effect_cost(self, cost):
+        self._line(cost, 'AP Cost: {}'.format(cost.content))
+
+    def difficulty(self, difficulty):
+        self._line(difficulty, 'Difficulty: {}'.format(difficulty.content))
+
+    def grants(self, grant):
+        self._reference('Grants', grant)
+
+    def requires(self, requires):
+        self._reference('Requires', requires)
+
+    def ref(self, ref):
+        self._reference('See', ref)
+
+    def paragraph(self, node):
+        for line in node.content.split('\n'):
+            if len(line) > 0:
+                self._line(node, line)
+
+        # Paragraphs directly in a section stand apart from what follows
+        if node.parent.kind == document.D_SECTION:
+            self.write('\n')
+
+    def _line(self, node, text, nested=0):
+        indent = '  ' * (_element_depth(node) + nested)
+
+        self.write(textwrap.fill(
+            text, TEXT_WIDTH, initial_indent=indent,
+            subsequent_indent=indent) + '\n')
+
+    def _reference(self, label, node):
+        (ref_id, kind, title), symbol = self.resolver.resolve(node)
+
+        # Printed pages can only say which document to look in
+        if symbol is not None:
+            title = '{} ({})'.format(title, symbol.title)
+
+        self._line(node, '{} {}: {}'.format(label, kind.title(), title))
+
+    def _underlined(self, text, underline):
+        self.write('{}\n{}\n\n'.format(text, underline * len(text)))
+
+
+# The visitor every format's output comes from. The document is walked once,
+# in document order, and each node is handed to every backend that wanted
+# its parent's children.
+class Visitor(object):
+
+    def __init__(self, backends):
+        self.backends = list(backends)
+
+    def run(self, doc):
+        for backend in self.backends:
+            backend.begin(doc)
+
+        self.walk(doc.root.children)
+
+        for backend in self.backends:
+            backend.end(doc)
+
+    def walk(self, nodes):
+        stack = [(_ENTER, node, self.backends) for node in reversed(nodes)]
+
+        while len(stack) > 0:
+            action, node, payload = stack.pop()
+
+            if action == _LEAVE:
+                for backend, closing in payload:
+                    backend.write(closing)
+
+                continue
+
+            descending = list()
+            closings = list()
+
+            for backend in payload:
+                closing = backend.visit(node)
+
+                if closing is not None:
+                    descending.append(backend)
+                    closings.append((backend, closing))
+
+            if len(descending) > 0:
+                stack.append((_LEAVE, node, closings))
+                stack.extend((_ENTER, child, descending)
+                             for child in reversed(node.children))
+
+
+# Backends by format
+BACKENDS = dict((backend.extension, backend)
+                for backend in (HtmlBackend, MarkdownBackend, TextBackend))
+
+def check_format(fmt):
+    if fmt not in BACKENDS:
+        raise PipelineError('No export format {} available.'.format(fmt))
+
+
+def render(doc, formats, minify=False, symbols=None):
+    # Renders every format in a single walk of the document, returning
+    # (format, content) pairs in the order they were asked for
+    for fmt in formats:
+        check_format(fmt)
+
+    resolver = Resolver(doc, symbols)
+    backends = [BACKENDS[fmt](resolver) for fmt in formats]
+
+    # Costs are evaluated before rendering starts so each phase is measured
+    # on its own
+    resolver.prepare()
+
+    with memprofile.phase(memprofile.RENDER), html.minified(minify):
+        Visitor(backends).run(doc)
+
+    return [(backend.extension, backend.output()) for backend in backends]
+
+
+def stream(doc, formats, publisher, minify=False, symbols=None, name=None):
+    # Renders every format like render() but writes each out as it's
+    # rendered, a writer thread per format taking care of the file. Files
+    # are named for the document's title unless given a name. Returns
+    # (format, changed) pairs and the WriteTimings of all of them.
+    name = name or doc.title
+
+    for fmt in formats:
+        check_format(fmt)
+
+    resolver = Resolver(doc, symbols)
+    resolver.prepare()
+
+    timings = publish.WriteTimings()
+    files = list()
+
+    try:
+        for fmt in formats:
+            files.append(publisher.open('{}.{}'.format(name, fmt)))
+
+        backends = [BACKENDS[fmt](resolver, out)
+                    for fmt, out in zip(formats, files)]
+
+        started = time.time()
+
+        with memprofile.phase(memprofile.RENDER), html.minified(minify):
+            Visitor(backends).run(doc)
+
+        timings.rendering = time.time() - started
+
+        # Each writer thread measures its own write phase
+        changed = [out.close()[0] for out in files]
+    except Exception:
+        for out in files:
+            out.abort()
+
+        raise
+
+    for out in files:
+        timings.add(out.timings)
+
+    return list(zip(formats, changed)), timings
+
+
+def render_section(resolver, section):
+    # One section as html, the same as html.div(export.render_section(...))
+    backend = HtmlBackend(resolver)
+
+    backend.write(_start_tag(html.div()))
+    Visitor([backend]).walk([section])
+    backend.write('</div>')
+
+    return backend.output()
+
+
+def _start_tag(partial):
+    # Everything up to the closing tag, for a tag whose children are
+    # written as they're visited
+    markup = partial()
+    return markup[:markup.rindex('</')]
+
+
+def _ap_label(ap_cost):
+    return 'Aspect Point {}'.format('Cost' if ap_cost >= 0 else 'Return')
+
+
+def _escape_markdown(text):
+    return _MARKDOWN_SPECIAL_REGEX.sub(r'\\\1', text)
+
+
+def _element_depth(node):
+    # How far a node sits beneath the section it belongs to, counting from
+    # the element itself
+    depth = -1
+
+    while node.kind != document.D_SECTION:
+        depth += 1
+        node = node.parent
+
+    return max(depth, 0)
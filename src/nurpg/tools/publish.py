@@ -0,0 +1,437 @@
+import os
+import json
+import gzip
+import time
+import hashlib
+import threading
+
+import nurpg.error as error
+import nurpg.compat as compat
+import nurpg.memprofile as memprofile
+
+
+MANIFEST_FILE = 'manifest.json'
+
+# Compressed sibling formats, named for their file extensions
+GZIP = 'gz'
+XZ = 'xz'
+
+FORMATS = (GZIP, XZ)
+
+# Content is fed to the file and every compressor in chunks of this size
+CHUNK_BYTES = 65536
+
+# Chunks a streamed file lets rendering get ahead of its writer by before
+# rendering waits for the writer to catch up
+QUEUE_CHUNKS = 16
+
+# Tell a writer thread whether to finish the file or give up on it
+_CLOSE = object()
+_ABORT = object()
+
+
+class PublishError(error.ErrorMessage):
+    pass
+
+
+# Writes export files along with precompressed siblings (index.html.gz and
+# so on) and keeps a manifest of their hashes and sizes, so a static server
+# can hand out the precompressed files and ETags without doing any work per
+# request.
+class Publisher(object):
+
+    def __init__(self, out_dir, compress=(), manifest=True):
+        for compression in compress:
+            check_format(compression)
+
+        self.out_dir = out_dir
+        self.compress = tuple(compress)
+        self.manifest = manifest
+        self.entries = dict()
+
+        self._manifest_path = os.path.join(out_dir, MANIFEST_FILE)
+
+        # Entries for files this export doesn't touch are kept as they were
+        if manifest and os.path.isfile(self._manifest_path):
+            with open(self._manifest_path) as fin:
+                self.entries = json.load(fin)
+
+    def write(self, filename, content):
+        changed, entry = write_file(
+            os.path.join(self.out_dir, filename), content, self.compress)
+
+        self.record(filename, entry)
+        return changed
+
+    def open(self, filename):
+        # A file written out as it's produced, see StreamedFile. Its entry is
+        # recorded once it's closed.
+        return StreamedFile(
+            os.path.join(self.out_dir, filename), self.compress,
+            lambda entry: self.record(filename, entry))
+
+    def record(self, filename, entry):
+        self.entries[filename] = entry
+
+    def remove(self, filename):
+        path = os.path.join(self.out_dir, filename)
+
+        for sibling in [path] + [_sibling(path, fmt) for fmt in FORMATS]:
+            if os.path.isfile(sibling):
+                os.remove(sibling)
+
+        self.entries.pop(filename, None)
+
+    def close(self):
+        if not self.manifest:
+            return False
+
+        return write_file(self._manifest_path, json.dumps(
+            self.entries, sort_keys=True, indent=2,
+            separators=(',', ': ')) + '\n')[0]
+
+
+# Time spent on either side of streamed writes, in seconds. Everything the
+# writer threads spent writing was hidden behind rendering apart from the
+# time rendering had to wait for them.
+class WriteTimings(object):
+
+    def __init__(self):
+        self.rendering = 0.0
+        self.writing = 0.0
+        self.waiting = 0.0
+        self.chunks = 0
+
+    @property
+    def hidden(self):
+        return max(0.0, self.writing - self.waiting)
+
+    def add(self, other):
+        self.writing += other.writing
+        self.waiting += other.waiting
+        self.chunks += other.chunks
+
+
+# A file written by its own thread while the content is still being
+# produced. Writes are gathered into chunks of CHUNK_BYTES and handed over
+# through a bounded queue, so a slow disk holds up the producer rather than
+# letting rendered content pile up in memory. Whatever goes wrong in the
+# writer is raised in the producer by its next write or close.
+class StreamedFile(object):
+
+    def __init__(self, path, compress=(), on_close=None,
+                 queue_chunks=QUEUE_CHUNKS):
+        self.path = path
+        self.compress = tuple(compress)
+        self.on_close = on_close
+        self.timings = WriteTimings()
+
+        self._pending = list()
+        self._pending_bytes = 0
+        self._sha1 = hashlib.sha1()
+        self._size = 0
+        self._error = None
+        self._closed = False
+
+        self._outputs = _Outputs(path, self.compress)
+        self._queue = compat.queue.Queue(queue_chunks)
+
+        # The writer's work is measured as the write phase of whatever
+        # profile the producer is running under
+        self._profile = memprofile.current()
+
+        self._thread = threading.Thread(target=self._drain)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, text):
+        self._pending.append(text)
+        self._pending_bytes += len(text)
+
+        if self._pending_bytes >= CHUNK_BYTES:
+            try:
+                self._put(''.join(self._pending))
+            except Exception:
+                self.abort()
+                raise
+
+            self._pending = list()
+            self._pending_bytes = 0
+
+    def close(self):
+        # Waits for the writer to finish and publishes the file the same way
+        # as write_file(). Returns whether anything was written and the
+        # file's manifest entry.
+        if self._closed:
+            raise PublishError('{} is already closed.'.format(self.path))
+
+        try:
+            if self._pending_bytes > 0:
+                self._put(''.join(self._pending))
+
+            self._finish(_CLOSE)
+            self._check()
+
+            changed, entry = self._publish()
+        except Exception:
+            self.abort()
+            raise
+
+        if self.on_close is not None:
+            self.on_close(entry)
+
+        return changed, entry
+
+    def abort(self):
+        # Stops the writer and throws away what it wrote
+        if self._closed:
+            return
+
+        if self._thread.is_alive():
+            self._finish(_ABORT)
+
+        self._closed = True
+        self._outputs.discard()
+
+    def _put(self, item):
+        self._check()
+
+        started = time.time()
+        self._queue.put(item)
+        self.timings.waiting += time.time() - started
+
+    def _finish(self, item):
+        started = time.time()
+        self._queue.put(item)
+        self._thread.join()
+        self.timings.waiting += time.time() - started
+
+    def _check(self):
+        if self._error is not None:
+            raise self._error
+
+    def _drain(self):
+        drained = False
+
+        try:
+            with memprofile.attached(self._profile):
+                with memprofile.phase(memprofile.WRITE):
+                    self._write_chunks()
+                    drained = True
+        except Exception as ex:
+            # e.g. the write phase going over its memory budget
+            if self._error is None:
+                self._error = ex
+
+            if not drained:
+                self._write_chunks()
+
+    def _write_chunks(self):
+        while True:
+            item = self._queue.get()
+
+            if item is _ABORT:
+                return
+
+            # After a failure chunks are still taken off the queue so the
+            # producer never blocks on a writer that's stopped
+            if self._error is not None and item is not _CLOSE:
+                continue
+
+            started = time.time()
+
+            try:
+                if item is _CLOSE:
+                    if self._error is None:
+                        self._outputs.flush()
+                else:
+                    self._sha1.update(item)
+                    self._size += len(item)
+                    self._outputs.write(item)
+                    self.timings.chunks += 1
+            except Exception as ex:
+                self._error = ex
+
+            self.timings.writing += time.time() - started
+
+            if item is _CLOSE:
+                return
+
+    def _publish(self):
+        self._closed = True
+
+        entry = {
+            'sha1': self._sha1.hexdigest(),
+            'size': self._size
+        }
+
+        siblings = [_sibling(self.path, fmt) for fmt in self.compress]
+
+        try:
+            if (_hashes_to(self.path, entry) and
+                    all(os.path.isfile(sibling) for sibling in siblings)):
+                self._outputs.discard()
+
+                for fmt, sibling in zip(self.compress, siblings):
+                    entry[fmt] = {'size': os.path.getsize(sibling)}
+
+                return False, entry
+
+            self._outputs.publish(entry)
+        except Exception:
+            self._outputs.discard()
+            raise
+
+        return True, entry
+
+
+def check_format(compression):
+    if compression not in FORMATS:
+        raise PublishError('No compression format {} available.'.format(
+            compression))
+
+    if compression == XZ and compat.lzma is None:
+        raise PublishError('xz compression needs the lzma module.')
+
+
+def write_file(path, content, compress=()):
+    # Writes content to path and a sibling for each compression format in a
+    # single pass over it. Files that already hold exactly this are left
+    # alone so they keep their mtimes. Returns whether anything was written
+    # and the file's manifest entry.
+    with memprofile.phase(memprofile.WRITE):
+        return _write_file(path, content, compress)
+
+
+def _write_file(path, content, compress):
+    entry = {
+        'sha1': hashlib.sha1(content).hexdigest(),
+        'size': len(content)
+    }
+
+    siblings = [(fmt, _sibling(path, fmt)) for fmt in compress]
+
+    if (_holds(path, content) and
+            all(os.path.isfile(sibling) for fmt, sibling in siblings)):
+        for fmt, sibling in siblings:
+            entry[fmt] = {'size': os.path.getsize(sibling)}
+
+        return False, entry
+
+    outputs = _Outputs(path, compress)
+
+    try:
+        for offset in range(0, len(content), CHUNK_BYTES):
+            outputs.write(content[offset:offset + CHUNK_BYTES])
+
+        outputs.flush()
+        outputs.publish(entry)
+    except Exception:
+        outputs.discard()
+        raise
+
+    return True, entry
+
+
+# The temp files an export file and its compressed siblings are written to,
+# which only replace the real files once every one of them is complete
+class _Outputs(object):
+
+    def __init__(self, path, compress):
+        self.path = path
+        self.compress = compress
+        self.files = list()
+
+        out_dir = os.path.dirname(os.path.abspath(path))
+        targets = [(None, path)] + [(fmt, _sibling(path, fmt))
+                                    for fmt in compress]
+
+        try:
+            for fmt, target in targets:
+                fd, tmp_path = compat.mkstemp(out_dir, '.')
+                self.files.append((fmt, target, tmp_path, os.fdopen(fd, 'wb')))
+        except Exception:
+            self.discard()
+            raise
+
+        self.sinks = [_sink(fmt, fout)
+                      for fmt, target, tmp_path, fout in self.files]
+
+    def write(self, chunk):
+        for write, flush in self.sinks:
+            write(chunk)
+
+    def flush(self):
+        for write, flush in self.sinks:
+            flush()
+
+    def publish(self, entry):
+        for fmt, target, tmp_path, fout in self.files:
+            fout.close()
+
+            if fmt is not None:
+                entry[fmt] = {'size': os.path.getsize(tmp_path)}
+
+        # The plain file goes last as it's what decides whether a later
+        # export can skip all of them
+        for fmt, target, tmp_path, fout in reversed(self.files):
+            os.rename(tmp_path, target)
+
+        # Siblings from an earlier export would no longer match
+        for fmt in FORMATS:
+            sibling = _sibling(self.path, fmt)
+
+            if fmt not in self.compress and os.path.isfile(sibling):
+                os.remove(sibling)
+
+    def discard(self):
+        for fmt, target, tmp_path, fout in self.files:
+            fout.close()
+
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+
+
+def _sibling(path, compression):
+    return '{}.{}'.format(path, compression)
+
+
+def _holds(path, content):
+    if not os.path.isfile(path) or os.path.getsize(path) != len(content):
+        return False
+
+    with open(path, 'rb') as fin:
+        return fin.read() == content
+
+
+def _hashes_to(path, entry):
+    # Whether path already holds content with entry's size and hash, read a
+    # chunk at a time as the content itself was never held whole
+    if not os.path.isfile(path) or os.path.getsize(path) != entry['size']:
+        return False
+
+    sha1 = hashlib.sha1()
+
+    with open(path, 'rb') as fin:
+        for chunk in iter(lambda: fin.read(CHUNK_BYTES), b''):
+            sha1.update(chunk)
+
+    return sha1.hexdigest() == entry['sha1']
+
+
+def _sink(compression, fout):
+    # (write, flush) for one output. Compressed output doesn't record a
+    # time or name so identical content always compresses identically.
+    if compression is None:
+        return fout.write, fout.flush
+
+    if compression == GZIP:
+        gzip_out = gzip.GzipFile('', 'wb', 9, fout, mtime=0)
+        return gzip_out.write, gzip_out.close
+
+    compressor = compat.lzma.LZMACompressor(preset=9)
+
+    def flush():
+        fout.write(compressor.flush())
+
+    return lambda chunk: fout.write(compressor.compress(chunk)), flush
@@ -0,0 +1,89 @@
+import os
+import json
+
+import nurpg.compat as compat
+import nurpg.document as document
+import nurpg.memprofile as memprofile
+
+import nurpg.tools.costs as costs
+
+
+# Output layouts: one JSON document, or one record per line
+JSON = 'json'
+NDJSON = 'ndjson'
+
+# Records are written through a buffer of this size
+WRITE_BUFFER_BYTES = document.MB_IN_BYTES
+
+
+def records(doc, graph=None):
+    # One record per node in document order. Abilities and aspects also
+    # carry their AP total and the nodes their grants resolve to.
+    if graph is None:
+        graph = costs.build(doc)
+
+    stack = [(child, 0) for child in reversed(doc.root.children)]
+
+    while len(stack) > 0:
+        node, depth = stack.pop()
+        parent = node.parent
+
+        record = {
+            'id': node.id,
+            'kind': node.kind,
+            'content': node.content,
+            'parent': parent.id if parent is not doc.root else None,
+            'depth': depth
+        }
+
+        if node.kind in costs.COMPOSITE_KINDS:
+            record['cost'] = graph.cost(node)
+            record['grants'] = [
+                {'id': target.id, 'multiplier': multiplier}
+                for target, multiplier in graph.grants(node)]
+
+        yield record
+
+        stack.extend((child, depth + 1) for child in reversed(node.children))
+
+
+def dump(doc, stream, layout=JSON):
+    # Writes every record as it's produced so memory use doesn't grow with
+    # the output
+    encode = json.JSONEncoder(sort_keys=True, separators=(',', ':')).encode
+
+    if layout == NDJSON:
+        for record in records(doc):
+            stream.write(encode(record))
+            stream.write('\n')
+
+        return
+
+    stream.write('{{"title":{},"authors":{},"nodes":['.format(
+        encode(doc.title), encode(doc.authors)))
+
+    separator = ''
+
+    for record in records(doc):
+        stream.write(separator)
+        stream.write(encode(record))
+        separator = ','
+
+    stream.write(']}\n')
+
+
+def write(doc, filename, layout=JSON):
+    # Written next to the target and renamed over it, as documents are
+    out_dir = os.path.dirname(os.path.abspath(filename))
+    fd, tmp_path = compat.mkstemp(out_dir, '.')
+
+    try:
+        with os.fdopen(fd, 'w', WRITE_BUFFER_BYTES) as fout:
+            # Records are rendered as they're written, so this is one phase
+            with memprofile.phase(memprofile.WRITE):
+                dump(doc, fout, layout)
+
+        os.rename(tmp_path, filename)
+    except Exception:
+        os.remove(tmp_path)
+        raise
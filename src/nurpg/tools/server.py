@@ -0,0 +1,743 @@
+import json
+import bisect
+import logging
+
+import nurpg.about as about
+import nurpg.compat as compat
+import nurpg.document as document
+
+import nurpg.tools.costs as costs
+import nurpg.tools.export as export
+import nurpg.tools.validate as validate
+
+
+_LOG = logging.getLogger(__name__)
+
+# JSON-RPC error codes
+PARSE_ERROR = -32700
+METHOD_NOT_FOUND = -32601
+INTERNAL_ERROR = -32603
+
+# Language server protocol values the server uses
+_SYNC_INCREMENTAL = 2
+_SEVERITY_ERROR = 1
+
+# The one header a message needs, the length of its body
+_CONTENT_LENGTH = 'content-length'
+
+_NEWLINE = document.DIRECTIVE_END_CH
+
+
+# A problem in a buffer, by zero based line and the characters of that line
+# it covers
+class Diagnostic(object):
+
+    def __init__(self, line, character, end, msg):
+        self.line = line
+        self.character = character
+        self.end = end
+        self.msg = msg
+
+    def to_dict(self):
+        return {
+            'range': _range(self.line, self.character, self.end),
+            'severity': _SEVERITY_ERROR,
+            'source': 'ndm',
+            'message': self.msg
+        }
+
+
+# What hovering over an element's line shows, its AP cost
+class Hover(object):
+
+    def __init__(self, line, character, end, text):
+        self.line = line
+        self.character = character
+        self.end = end
+        self.text = text
+
+    def to_dict(self):
+        return {
+            'contents': {'kind': 'plaintext', 'value': self.text},
+            'range': _range(self.line, self.character, self.end)
+        }
+
+
+# One top level section of a buffer, or whatever comes before the first.
+# Chunks are never changed, an edit replaces them with new ones, so what's
+# found in a chunk holds for as long as it's part of the buffer.
+class _Chunk(object):
+
+    def __init__(self, text):
+        self.text = text
+        self.lines = text.count(_NEWLINE)
+        self.scan = validate.scan(text)
+
+        # (name, ability) of every ability grants can lead to
+        self.abilities = list()
+
+        for ability in self.scan.abilities:
+            try:
+                name, subtype = export.parse_name(ability.name)
+                self.abilities.append((name, ability))
+            except export.ExportError:
+                continue
+
+        # (line, character, end, message) of the chunk's own problems and
+        # dangling references, relative to the chunk. None until they've
+        # been looked up again since a name they refer to came or went.
+        self.found = None
+
+        # (first line, diagnostics) last given out for what was found, so
+        # they're only made again once the chunk moves
+        self.shown = None
+
+        # The chunk's top level nodes once costs are needed, none when it
+        # has problems of its own
+        self.nodes = None
+
+    def position(self, offset):
+        # (line, character, end of line) of an offset within the chunk
+        line_start = self.text.rfind(_NEWLINE, 0, offset) + 1
+        line_end = _line_end(self.text, offset)
+
+        return (self.text.count(_NEWLINE, 0, offset),
+                _characters(self.text[line_start:offset]),
+                _characters(self.text[line_start:line_end]))
+
+
+# The text of a document open in an editor along with its diagnostics and
+# costs. Only the sections an edit touches are scanned again, the rest keep
+# what was found in them before. Names, dangling references and grant
+# cycles are then brought up to date across the buffer, and costs are only
+# worked out once they're first asked for and updated from then on.
+class Buffer(object):
+
+    def __init__(self, text, symbols=None):
+        # Names other documents in the workspace define
+        self.symbols = symbols
+
+        self.chunks = [_Chunk(piece) for piece in _split(text)]
+
+        # The first line of every chunk
+        self.starts = list()
+
+        # How many chunks take part in the document, a @halt ends it
+        self.active = 0
+
+        # (kind, name) -> how many chunks define it
+        self.names = dict()
+
+        # (kind, name) -> the chunks with references to it
+        self.referrers = dict()
+
+        # name -> every ability by that name
+        self.abilities = dict()
+
+        # (chunk, offset, message) of every grant cycle
+        self.cycles = list()
+
+        # The document and cost graph of every chunk, built on first use
+        self._doc = None
+        self._graph = None
+        self._next_id = 0
+
+        self._reset()
+
+    def text(self):
+        return ''.join(chunk.text for chunk in self.chunks)
+
+    def edit(self, text, start=None, end=None):
+        # Replaces the text between two (line, character) positions, or the
+        # whole buffer without them
+        if start is None:
+            self._replace(0, len(self.chunks), _split(text))
+            return
+
+        # The chunk before is taken along in case the edit removes the
+        # @section that started the first one
+        first = max(self._chunk_at(start[0]) - 1, 0)
+        last = self._chunk_at(end[0]) + 1
+
+        region = ''.join(chunk.text for chunk in self.chunks[first:last])
+        base = self.starts[first]
+
+        region = (region[:_offset(region, start[0] - base, start[1])] + text +
+                  region[_offset(region, end[0] - base, end[1]):])
+
+        # The next chunk only starts a section while it starts a line
+        while last < len(self.chunks) and not region.endswith(_NEWLINE):
+            region += self.chunks[last].text
+            last += 1
+
+        self._replace(first, last, _split(region))
+
+    def diagnostics(self):
+        # Every chunk's diagnostics come sorted and chunks are in order, so
+        # only those found across chunks need sorting in
+        found = list()
+        others = list()
+        title = None
+
+        for idx in range(self.active):
+            chunk = self.chunks[idx]
+            base = self.starts[idx]
+
+            if chunk.found is None:
+                chunk.found = sorted(chunk.position(offset) + (msg,)
+                                     for offset, msg in chunk.scan.problems +
+                                     validate.dangling(chunk.scan.references,
+                                                       self.names,
+                                                       self.symbols))
+                chunk.shown = None
+
+            if chunk.shown is None or chunk.shown[0] != base:
+                chunk.shown = (base, [
+                    Diagnostic(base + line, character, end, msg)
+                    for line, character, end, msg in chunk.found])
+
+            found.extend(chunk.shown[1])
+
+            for offset, arguments in chunk.scan.titles:
+                if title is not None:
+                    others.append(self._diagnostic(
+                        idx, offset, 'Document has two title nodes.'))
+                else:
+                    title = arguments
+
+        if len(self.cycles) > 0:
+            indexes = dict((id(chunk), idx) for idx, chunk
+                           in enumerate(self.chunks[:self.active]))
+
+            for chunk, offset, msg in self.cycles:
+                others.append(self._diagnostic(indexes[id(chunk)], offset,
+                                               msg))
+
+        if len(others) > 0:
+            found.extend(others)
+            found.sort(key=lambda diagnostic: (diagnostic.line,
+                                               diagnostic.character))
+
+        return found
+
+    def hover(self, line, character):
+        # The AP cost of the element whose directive is on a line, or None
+        idx = self._chunk_at(line)
+
+        if idx >= self.active:
+            return None
+
+        chunk = self.chunks[idx]
+        line_start = _offset(chunk.text, line - self.starts[idx], 0)
+        line_end = _line_end(chunk.text, line_start)
+
+        for kind in costs.INDEXED_KINDS:
+            offsets = list(document.directive_offsets(
+                chunk.text, kind, 0, line_end))
+
+            if len(offsets) == 0 or offsets[-1] < line_start:
+                continue
+
+            graph = self._costs()
+
+            if graph is None:
+                return None
+
+            # Nodes come in the same order as their directives
+            nodes = [node for top in self._nodes(chunk)
+                     for node in document._walk(top, include_root=True)
+                     if node.kind == kind]
+
+            if len(nodes) < len(offsets):
+                return None
+
+            node = nodes[len(offsets) - 1]
+
+            if node not in graph:
+                return None
+
+            line, start, end = chunk.position(offsets[-1])
+
+            return Hover(self.starts[idx] + line, start, end,
+                         '{} {}: {} AP'.format(kind, node.content,
+                                               graph.cost(node)))
+
+        return None
+
+    def _diagnostic(self, idx, offset, msg):
+        line, character, end = self.chunks[idx].position(offset)
+        return Diagnostic(self.starts[idx] + line, character, end, msg)
+
+    def _chunk_at(self, line):
+        return max(bisect.bisect_right(self.starts, line) - 1, 0)
+
+    def _replace(self, first, last, texts):
+        old = self.chunks[first:last]
+
+        # Chunks whose text didn't change are kept as they are
+        unchanged = dict((chunk.text, chunk) for chunk in old)
+        new = list()
+
+        for text in texts:
+            chunk = unchanged.pop(text, None)
+            new.append(chunk if chunk is not None else _Chunk(text))
+
+        halting = self._halting()
+        active = self.active
+
+        self.chunks[first:last] = new
+        self._lines()
+
+        # Nothing after a halt is part of the document, so wherever it moves
+        # everything is counted again
+        if self._halting() is not halting:
+            self._reset()
+            return
+
+        old = old[:max(active - first, 0)]
+        new = new[:max(self.active - first, 0)]
+
+        kept = set(id(chunk) for chunk in new)
+        removed = [chunk for chunk in old if id(chunk) not in kept]
+
+        kept = set(id(chunk) for chunk in old)
+        added = [chunk for chunk in new if id(chunk) not in kept]
+
+        # Added first, so names that only moved never look like they went
+        for chunk in added:
+            self._count(chunk, 1)
+
+        for chunk in removed:
+            self._count(chunk, -1)
+
+        # Any new cycle runs through an ability that was just added, while
+        # there are cycles they're all found again so they're reported just
+        # as a whole document's would be
+        if len(self.cycles) > 0 or self._cyclic(
+                [ability for chunk in added
+                 for name, ability in chunk.abilities]):
+            self._find_cycles()
+
+        if self._graph is not None:
+            self._update_costs(removed, added, first, len(new))
+
+    def _reset(self):
+        self._lines()
+
+        self.names = dict()
+        self.referrers = dict()
+        self.abilities = dict()
+
+        for chunk in self.chunks:
+            chunk.found = None
+
+        for chunk in self.chunks[:self.active]:
+            self._count(chunk, 1)
+
+        self._find_cycles()
+
+        # Rebuilt whenever costs are next asked for
+        self._doc = None
+        self._graph = None
+
+    def _lines(self):
+        self.starts = list()
+        self.active = len(self.chunks)
+        line = 0
+
+        for idx, chunk in enumerate(self.chunks):
+            self.starts.append(line)
+            line += chunk.lines
+
+            if chunk.scan.halted and self.active == len(self.chunks):
+                self.active = idx + 1
+
+    def _halting(self):
+        # The chunk whose @halt ends the document, if any
+        chunk = self.chunks[self.active - 1]
+        return chunk if chunk.scan.halted else None
+
+    def _count(self, chunk, step):
+        names = self.names
+
+        for key in chunk.scan.names:
+            count = names.get(key, 0) + step
+
+            if count == 0:
+                del names[key]
+            else:
+                names[key] = count
+
+            # Only names appearing or going away change what references
+            # resolve to
+            if count == 0 or count == step:
+                for referrer in self.referrers.get(key, ()):
+                    referrer.found = None
+
+        for name, ability in chunk.abilities:
+            if step > 0:
+                self.abilities.setdefault(name, list()).append(ability)
+            else:
+                self.abilities[name].remove(ability)
+
+                if len(self.abilities[name]) == 0:
+                    del self.abilities[name]
+
+        for kind, key, offset in chunk.scan.references:
+            referrers = self.referrers.setdefault(key, set())
+
+            if step > 0:
+                referrers.add(chunk)
+            else:
+                referrers.discard(chunk)
+
+                if len(referrers) == 0:
+                    del self.referrers[key]
+
+    def _cyclic(self, abilities):
+        # Whether any of abilities can be reached again through its grants
+        for start in abilities:
+            seen = set()
+            pending = [start]
+
+            while len(pending) > 0:
+                for kind, name in pending.pop().grants:
+                    if kind != document.D_ABILITY:
+                        continue
+
+                    for target in self.abilities.get(name, ()):
+                        if target is start:
+                            return True
+
+                        if id(target) not in seen:
+                            seen.add(id(target))
+                            pending.append(target)
+
+        return False
+
+    def _find_cycles(self):
+        owners = dict()
+        abilities = list()
+
+        for chunk in self.chunks[:self.active]:
+            for ability in chunk.scan.abilities:
+                owners[id(ability)] = chunk
+                abilities.append(ability)
+
+        self.cycles = [(owners[id(ability)], ability.offset, msg)
+                       for ability, msg in validate.cycles(abilities)]
+
+        # Costs can't be worked out around a cycle
+        if len(self.cycles) > 0:
+            self._doc = None
+            self._graph = None
+
+    def _costs(self):
+        if self._graph is None and len(self.cycles) == 0:
+            doc = document.Document()
+
+            for chunk in self.chunks[:self.active]:
+                for node in self._nodes(chunk):
+                    doc.root.append(node)
+
+            try:
+                self._graph = costs.build(doc)
+                self._doc = doc
+            except costs.CostGraphError:
+                return None
+
+        return self._graph
+
+    def _update_costs(self, removed, added, first, count):
+        root = self._doc.root
+        added = set(id(chunk) for chunk in added)
+
+        try:
+            nodes = [node for chunk in removed for node in self._nodes(chunk)]
+            self._graph.remove(nodes)
+
+            for node in nodes:
+                root.remove(node)
+
+            # Inserted last to first, so whatever follows is already in place
+            nodes = list()
+
+            for idx in reversed(range(first, first + count)):
+                if idx >= self.active or id(self.chunks[idx]) not in added:
+                    continue
+
+                position = self._position(idx + 1)
+
+                for node in reversed(self._nodes(self.chunks[idx])):
+                    root.insert(position, node)
+                    nodes.append(node)
+
+            self._graph.update(nodes)
+        except costs.CostGraphError:
+            self._doc = None
+            self._graph = None
+
+    def _position(self, idx):
+        # Where the nodes of the chunk at idx or the first after it with any
+        # begin among the document's nodes
+        for chunk in self.chunks[idx:self.active]:
+            nodes = self._nodes(chunk)
+
+            if len(nodes) > 0:
+                return self._doc.root.children.index(nodes[0])
+
+        return len(self._doc.root.children)
+
+    def _nodes(self, chunk):
+        if chunk.nodes is not None:
+            return chunk.nodes
+
+        chunk.nodes = list()
+
+        # The costs of chunks with problems would only be guesses
+        if len(chunk.scan.problems) > 0:
+            return chunk.nodes
+
+        try:
+            chunk.nodes = list(document.parse(chunk.text).root.children)
+        except document.DocumentError:
+            return chunk.nodes
+
+        # Ids only need to tell nodes apart within the buffer
+        for top in chunk.nodes:
+            for node in document._walk(top, include_root=True):
+                node.id = str(self._next_id)
+                self._next_id += 1
+
+        return chunk.nodes
+
+
+# Speaks the language server protocol over a pair of streams, keeping a
+# Buffer for every document the editor has open and publishing its
+# diagnostics whenever it changes.
+class Server(object):
+
+    def __init__(self, fin, fout, symbols=None):
+        self.fin = fin
+        self.fout = fout
+        self.symbols = symbols
+
+        # uri -> Buffer of every open document
+        self.buffers = dict()
+
+        # Whether the client asked for a shutdown before exiting
+        self.shutdown = False
+
+        self._handlers = {
+            'initialize': self._initialize,
+            'initialized': self._ignore,
+            'shutdown': self._shutdown,
+            'textDocument/didOpen': self._did_open,
+            'textDocument/didChange': self._did_change,
+            'textDocument/didClose': self._did_close,
+            'textDocument/hover': self._hover
+        }
+
+    def run(self):
+        # Serves the client until it exits, returning whether it shut the
+        # server down first
+        while True:
+            try:
+                message = self._read()
+            except ValueError as ex:
+                self._error(None, PARSE_ERROR, str(ex))
+                continue
+
+            if message is None or message.get('method') == 'exit':
+                return self.shutdown
+
+            self._dispatch(message)
+
+    def _dispatch(self, message):
+        method = compat.to_native(message.get('method'))
+        handler = self._handlers.get(method)
+        request = 'id' in message
+
+        if handler is None:
+            if request:
+                self._error(message['id'], METHOD_NOT_FOUND,
+                            'Unknown method: {}'.format(method))
+            return
+
+        try:
+            result = handler(message.get('params') or dict())
+        except Exception as ex:
+            _LOG.exception(ex)
+
+            if request:
+                self._error(message['id'], INTERNAL_ERROR,
+                            getattr(ex, 'msg', None) or str(ex))
+            return
+
+        if request:
+            self._send({'jsonrpc': '2.0', 'id': message['id'],
+                        'result': result})
+
+    def _initialize(self, params):
+        return {
+            'capabilities': {
+                'textDocumentSync': {
+                    'openClose': True,
+                    'change': _SYNC_INCREMENTAL
+                },
+                'hoverProvider': True
+            },
+            'serverInfo': {'name': 'ndm', 'version': about.VERSION}
+        }
+
+    def _ignore(self, params):
+        return None
+
+    def _shutdown(self, params):
+        self.shutdown = True
+        return None
+
+    def _did_open(self, params):
+        opened = params['textDocument']
+
+        self.buffers[opened['uri']] = Buffer(
+            compat.to_native(opened['text']), self.symbols)
+        self._publish(opened['uri'], opened.get('version'))
+
+    def _did_change(self, params):
+        changed = params['textDocument']
+        buf = self.buffers[changed['uri']]
+
+        for change in params['contentChanges']:
+            text = compat.to_native(change['text'])
+
+            if 'range' in change:
+                buf.edit(text, _position(change['range']['start']),
+                         _position(change['range']['end']))
+            else:
+                buf.edit(text)
+
+        self._publish(changed['uri'], changed.get('version'))
+
+    def _did_close(self, params):
+        uri = params['textDocument']['uri']
+        self.buffers.pop(uri, None)
+
+        # Problems of a closed document are no longer shown
+        self._notify('textDocument/publishDiagnostics', {
+            'uri': uri, 'diagnostics': []})
+
+    def _hover(self, params):
+        buf = self.buffers.get(params['textDocument']['uri'])
+
+        if buf is None:
+            return None
+
+        position = _position(params['position'])
+        hover = buf.hover(*position)
+
+        return hover.to_dict() if hover is not None else None
+
+    def _publish(self, uri, version):
+        diagnostics = self.buffers[uri].diagnostics()
+
+        self._notify('textDocument/publishDiagnostics', {
+            'uri': uri,
+            'version': version,
+            'diagnostics': [diagnostic.to_dict() for diagnostic in diagnostics]
+        })
+
+    def _read(self):
+        # The next message, or None once the client has gone
+        length = None
+
+        while True:
+            line = self.fin.readline()
+
+            if len(line) == 0:
+                return None
+
+            line = compat.to_str(line).strip()
+
+            if len(line) == 0 and length is not None:
+                break
+
+            name, separator, value = line.partition(':')
+
+            if name.strip().lower() == _CONTENT_LENGTH:
+                length = int(value)
+
+        return json.loads(compat.to_str(self.fin.read(length)))
+
+    def _notify(self, method, params):
+        self._send({'jsonrpc': '2.0', 'method': method, 'params': params})
+
+    def _error(self, message_id, code, msg):
+        self._send({'jsonrpc': '2.0', 'id': message_id,
+                    'error': {'code': code, 'message': msg}})
+
+    def _send(self, message):
+        body = json.dumps(message)
+
+        self.fout.write(compat.to_bytes('Content-Length: {}\r\n\r\n{}'.format(
+            len(body), body)))
+        self.fout.flush()
+
+
+def _split(text):
+    # The text of every chunk, a new one starting with every @section that
+    # starts a line
+    starts = [0] + [offset for offset in document.directive_offsets(
+        text, document.D_SECTION)
+        if offset > 0 and text[offset - 1] == _NEWLINE]
+
+    return [text[start:end] for start, end
+            in zip(starts, starts[1:] + [len(text)])]
+
+
+def _offset(text, line, character):
+    # Where a (line, character) position falls in text, clamped to its end
+    offset = 0
+
+    for count in range(line):
+        offset = text.find(_NEWLINE, offset) + 1
+
+        if offset == 0:
+            return len(text)
+
+    return offset + _length(text[offset:_line_end(text, offset)], character)
+
+
+def _line_end(text, offset):
+    line_end = text.find(_NEWLINE, offset)
+    return line_end if line_end >= 0 else len(text)
+
+
+# Editors count characters where 2.7.x strings hold UTF-8 bytes. Positions
+# are taken as code points, which only differs from the protocol's UTF-16
+# units past the basic multilingual plane.
+def _characters(text):
+    if isinstance(text, bytes):
+        return len(text.decode('utf-8', 'replace'))
+
+    return len(text)
+
+
+def _length(line, characters):
+    # How much of a line its first few characters take up
+    if isinstance(line, bytes):
+        return len(line.decode('utf-8', 'replace')[:characters].encode(
+            'utf-8'))
+
+    return min(characters, len(line))
+
+
+def _position(position):
+    return (position['line'], position['character'])
+
+
+def _range(line, character, end):
+    return {
+        'start': {'line': line, 'character': character},
+        'end': {'line': line, 'character': end}
+    }
@@ -0,0 +1,306 @@
+import os
+import re
+import errno
+import multiprocessing
+
+import nurpg.html as html
+import nurpg.document as document
+import nurpg.memprofile as memprofile
+
+import nurpg.tools.publish as publish
+import nurpg.tools.pipeline as pipeline
+
+
+INDEX_FILE = 'index.html'
+
+# Every section is written to its own fragment named after its id, e.g.
+# section-combat.html
+SHARD_SUFFIX = '.html'
+
+# The shards written to a directory, one name per line, so that later
+# exports only ever remove files an export wrote
+SHARDS_FILE = '.shards'
+
+# Links the renderers produce to ids on the same page
+_LOCAL_HREF_REGEX = re.compile('href="#([^"]*)"')
+
+# Characters that can't appear in a shard's file name
+_FILE_UNSAFE_REGEX = re.compile('[^a-zA-Z0-9_.-]+')
+
+# Fills in a section placeholder with its fragment as it nears the viewport,
+# or when a link leads into it. Without scripts the placeholders still link
+# to the fragments themselves.
+_LOADER_SCRIPT = """
+(function () {
+  // Callbacks waiting on each shard, or true once it's in the page
+  var shards = {};
+
+  function load(section, then) {
+    var shard = section.getAttribute('data-shard');
+    var state = shards[shard];
+
+    if (state === true) {
+      if (then) { then(); }
+      return;
+    }
+
+    if (state) {
+      if (then) { state.push(then); }
+      return;
+    }
+
+    shards[shard] = then ? [then] : [];
+
+    var request = new XMLHttpRequest();
+    request.open('GET', shard);
+    request.onload = function () {
+      var waiting = shards[shard];
+
+      section.innerHTML = request.responseText;
+      shards[shard] = true;
+
+      for (var i = 0; i < waiting.length; i++) { waiting[i](); }
+    };
+    request.send();
+  }
+
+  function shardOf(href) {
+    var hash = href.indexOf('#');
+    return hash < 0 ? href : href.substring(0, hash);
+  }
+
+  function reveal(href) {
+    var target = href.substring(href.indexOf('#') + 1);
+    var section = document.querySelector(
+      'section[data-shard="' + shardOf(href) + '"]');
+
+    if (!section) { return false; }
+
+    load(section, function () {
+      var node = document.getElementById(target) || section;
+      node.scrollIntoView();
+    });
+    return true;
+  }
+
+  document.addEventListener('click', function (event) {
+    var link = event.target.closest ? event.target.closest('a') : null;
+    var href = link ? link.getAttribute('href') : null;
+
+    if (href && href.indexOf('#') > 0 && reveal(href)) {
+      event.preventDefault();
+      history.pushState(null, '', '#' + href.split('#')[1]);
+    }
+  });
+
+  var sections = document.querySelectorAll('section[data-shard]');
+
+  if (!('IntersectionObserver' in window)) {
+    for (var i = 0; i < sections.length; i++) { load(sections[i]); }
+    return;
+  }
+
+  var observer = new IntersectionObserver(function (entries) {
+    entries.forEach(function (entry) {
+      if (entry.isIntersecting) {
+        observer.unobserve(entry.target);
+        load(entry.target);
+      }
+    });
+  }, {rootMargin: '500px'});
+
+  for (var j = 0; j < sections.length; j++) { observer.observe(sections[j]); }
+})();
+"""
+
+# What resolves the document's costs and references, where its ids live and
+# how shards are written, for each shard worker
+_worker_state = None
+
+
+class Shard(object):
+
+    def __init__(self, section, filename):
+        self.section = section
+        self.filename = filename
+
+
+def shard_name(section):
+    return _FILE_UNSAFE_REGEX.sub('-', section.id) + SHARD_SUFFIX
+
+
+def is_shard_name(filename):
+    kind = filename.split('-', 1)[0]
+    return kind in document.TOP_LEVEL and filename.endswith(SHARD_SUFFIX)
+
+
+def plan(doc):
+    # One shard per section, and the shard each id can be found in
+    shards = list()
+    locations = dict()
+
+    for section in doc.sections:
+        shard = Shard(section, shard_name(section))
+        shards.append(shard)
+
+        locations[section.id] = shard.filename
+
+        for node in document._walk(section):
+            locations[node.id] = shard.filename
+
+    return shards, locations
+
+
+def render_shard(resolver, shard, locations):
+    fragment = pipeline.render_section(resolver, shard.section)
+    return rewrite_links(fragment, shard.filename, locations)
+
+
+def rewrite_links(fragment, filename, locations):
+    # Links into other sections point at the shard that holds their target
+    def rewrite(match):
+        target = locations.get(match.group(1))
+
+        if target is None or target == filename:
+            return match.group(0)
+
+        return 'href="{}#{}"'.format(target, match.group(1))
+
+    return _LOCAL_HREF_REGEX.sub(rewrite, fragment)
+
+
+def render_index(doc, shards):
+    return html.html(
+        html.head(
+            html.title(doc.title),
+            html.script(_LOADER_SCRIPT)),
+
+        html.body(
+            html.div(
+                html.style_attr('max-width: 1000px; margin-left: 50px;'),
+
+                html.div(
+                    html.style_attr('margin-left: 25px; padding-bottom: 5px;'),
+                    html.h1(doc.title)),
+
+                html.nav(html.ul([
+                    html.li(html.a(
+                        html.attribute('href', '{}#{}'.format(
+                            shard.filename, shard.section.id)),
+                        shard.section.content))
+                    for shard in shards])),
+
+                [html.section(
+                    html.id_attr(shard.section.id),
+                    html.attribute('data-shard', shard.filename),
+                    html.h3(html.a(
+                        html.attribute('href', shard.filename),
+                        shard.section.content)))
+                 for shard in shards])))()
+
+
+def export_shards(doc, out_dir, jobs=1, compress=(), minify=False,
+                  manifest=False, symbols=None):
+    # Writes the index and every shard that changed beneath out_dir, along
+    # with any compressed siblings and the manifest, and returns the names
+    # of the files written. Shards an earlier export wrote for sections that
+    # no longer exist are removed.
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    publisher = publish.Publisher(out_dir, compress, manifest)
+    shards, locations = plan(doc)
+    options = (out_dir, tuple(compress), minify)
+
+    current = set(shard.filename for shard in shards)
+    previous = _read_shards(out_dir) | set(
+        filename for filename in publisher.entries if is_shard_name(filename))
+
+    # Recorded before they're written so that an export that fails partway
+    # leaves nothing behind a later one doesn't know about
+    _write_shards(out_dir, previous | current)
+
+    # Shared by every shard, and built before any workers fork
+    resolver = pipeline.Resolver(doc, symbols)
+    resolver.prepare()
+
+    if jobs is None or jobs > 1:
+        results = _write_parallel(resolver, shards, locations, options, jobs)
+    else:
+        results = [_write_shard(resolver, shard, locations, options)
+                   for shard in shards]
+
+    written = list()
+
+    for shard, (changed, entry) in zip(shards, results):
+        publisher.record(shard.filename, entry)
+
+        if changed:
+            written.append(shard.filename)
+
+    with memprofile.phase(memprofile.RENDER), html.minified(minify):
+        index = render_index(doc, shards)
+
+    if publisher.write(INDEX_FILE, index):
+        written.append(INDEX_FILE)
+
+    for filename in previous - current:
+        publisher.remove(filename)
+
+    _write_shards(out_dir, current)
+
+    if publisher.close():
+        written.append(publish.MANIFEST_FILE)
+
+    return written
+
+
+def _read_shards(out_dir):
+    try:
+        with open(os.path.join(out_dir, SHARDS_FILE)) as fin:
+            return set(line.strip() for line in fin if line.strip())
+    except IOError as ex:
+        if ex.errno != errno.ENOENT:
+            raise
+
+    return set()
+
+
+def _write_shards(out_dir, filenames):
+    publish.write_file(os.path.join(out_dir, SHARDS_FILE), ''.join(
+        filename + '\n' for filename in sorted(filenames)))
+
+
+def _write_shard(resolver, shard, locations, options):
+    out_dir, compress, minify = options
+
+    with memprofile.phase(memprofile.RENDER), html.minified(minify):
+        content = render_shard(resolver, shard, locations)
+
+    return publish.write_file(
+        os.path.join(out_dir, shard.filename), content, compress)
+
+
+def _write_parallel(resolver, shards, locations, options, jobs):
+    # Workers fork with the document already in memory and render and write
+    # shards by their position
+    pool = multiprocessing.Pool(
+        jobs, _init_shard_worker, (resolver, shards, locations, options))
+
+    try:
+        return pool.map(_write_shard_at, range(len(shards)))
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _init_shard_worker(resolver, shards, locations, options):
+    global _worker_state
+    _worker_state = (resolver, shards, locations, options)
+
+    memprofile.detach()
+
+
+def _write_shard_at(index):
+    resolver, shards, locations, options = _worker_state
+    return _write_shard(resolver, shards[index], locations, options)
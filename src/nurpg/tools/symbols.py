@@ -0,0 +1,217 @@
+import os
+import json
+import hashlib
+import tempfile
+
+import nurpg.config as config
+import nurpg.compat as compat
+import nurpg.document as document
+
+import nurpg.tools.costs as costs
+import nurpg.tools.export as export
+
+
+# Every file with this suffix beneath the workspace is part of it
+DOCUMENT_SUFFIX = '.nd'
+
+# Bumped whenever the cached layout changes so stale caches are rebuilt
+INDEX_VERSION = 2
+
+
+# Something another document defines that can be granted, required or
+# referred to by name
+class Symbol(object):
+
+    def __init__(self, path, title, kind, name, node_id, content):
+        self.path = compat.to_native(path)
+        self.title = compat.to_native(title)
+        self.kind = compat.to_native(kind)
+        self.name = compat.to_native(name)
+        self.id = compat.to_native(node_id)
+        self.content = compat.to_native(content)
+
+    def href(self, extension):
+        # Where the symbol lives once its document is exported in this format
+        return '{}.{}#{}'.format(self.title, extension, self.id)
+
+
+# The (kind, name) pairs every document in the workspace defines. Documents
+# are only parsed again when their content hash changes, so one edited
+# document doesn't mean re-reading the whole workspace.
+class SymbolIndex(object):
+
+    def __init__(self, documents=None):
+        # path -> {'sha1': ..., 'title': ..., 'symbols': [[kind, name, id,
+        # content], ...]} with symbols in document order
+        self.documents = documents or dict()
+
+        # (kind, name) -> list of Symbols, built on first lookup
+        self._names = None
+
+    @classmethod
+    def from_json(cls, source_str):
+        source = json.loads(source_str)
+
+        if source.get('version') != INDEX_VERSION:
+            return SymbolIndex()
+
+        return SymbolIndex(source['documents'])
+
+    def to_json(self):
+        return json.dumps({
+            'version': INDEX_VERSION,
+            'documents': self.documents
+        }, sort_keys=True)
+
+    def refresh(self, paths):
+        # Indexes any document that's new or has changed and forgets ones
+        # that are gone, returning the paths that were parsed
+        paths = [os.path.normpath(path) for path in paths]
+        parsed = list()
+
+        for path in paths:
+            content = document.read_source(path)
+            sha1 = hashlib.sha1(content).hexdigest()
+            entry = self.documents.get(path)
+
+            if entry is not None and entry['sha1'] == sha1:
+                continue
+
+            try:
+                title, symbols = index_document(content)
+            except document.DocumentError:
+                # Another document that doesn't parse defines nothing until
+                # it's fixed, it's only its own status that reports why
+                title, symbols = None, list()
+
+            self.documents[path] = {
+                'sha1': sha1,
+                'title': title,
+                'symbols': symbols
+            }
+
+            parsed.append(path)
+
+        removed = set(self.documents) - set(paths)
+
+        for path in removed:
+            del self.documents[path]
+
+        if len(parsed) > 0 or len(removed) > 0:
+            self._names = None
+
+        return parsed
+
+    def lookup(self, kind, name):
+        # The first definition of kind and name, taking documents in path
+        # order, or None
+        symbols = self._by_name().get((kind, name))
+        return symbols[0] if symbols is not None else None
+
+    def __contains__(self, key):
+        return key in self._by_name()
+
+    def _by_name(self):
+        if self._names is None:
+            names = dict()
+
+            for path in sorted(self.documents):
+                entry = self.documents[path]
+
+                # Files without a title are parts of a document that
+                # includes them, there's nothing they could be linked as
+                if entry['title'] is None:
+                    continue
+
+                for fields in entry['symbols']:
+                    symbol = Symbol(path, entry['title'], *fields)
+                    names.setdefault((symbol.kind, symbol.name),
+                                     list()).append(symbol)
+
+            self._names = names
+
+        return self._names
+
+
+def index_document(content):
+    # The title and the first definition of every (kind, name) a document
+    # holds, and of each of its subtypes, as [kind, name, id, content] lists.
+    # Lookups by name find the first.
+    doc = document.parse(content)
+
+    symbols = list()
+    seen = set()
+
+    for node in document._walk(doc.root):
+        if node.kind not in costs.INDEXED_KINDS:
+            continue
+
+        try:
+            name, subtype = export.parse_name(node.content or '')
+        except export.ExportError:
+            # Grants can't name these either
+            continue
+
+        if (node.kind, name, subtype) not in seen:
+            seen.add((node.kind, name, subtype))
+            symbols.append([node.kind, name, node.id, node.content])
+
+    return doc.title, symbols
+
+
+def workspace_documents(root='.'):
+    # Every document beneath root, skipping hidden directories such as .nds
+    paths = list()
+
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [name for name in dirnames if not name.startswith('.')]
+
+        paths.extend(os.path.normpath(os.path.join(dirpath, name))
+                     for name in filenames if name.endswith(DOCUMENT_SUFFIX))
+
+    return sorted(paths)
+
+
+def read_index():
+    if not os.path.isfile(config.SYMBOLS_FILE):
+        return SymbolIndex()
+
+    with open(config.SYMBOLS_FILE, 'r') as fin:
+        try:
+            return SymbolIndex.from_json(fin.read())
+        except ValueError:
+            # The index is only a cache, so a damaged one is rebuilt
+            return SymbolIndex()
+
+
+def write_index(index):
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(config.SYMBOLS_FILE), prefix='.symbols-')
+
+    try:
+        with os.fdopen(fd, 'w') as fout:
+            fout.write(index.to_json())
+
+        os.rename(tmp_path, config.SYMBOLS_FILE)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def workspace_index(cfg):
+    # The index of every document in the workspace other than the configured
+    # one and the files it includes, whose names are always resolved from
+    # the document itself
+    own_paths = set([os.path.normpath(cfg.document_file)])
+    own_paths.update(document.included_files(cfg.document_file))
+
+    with config.WorkspaceLock(exclusive=True):
+        index = read_index()
+        indexed = set(index.documents)
+        paths = [path for path in workspace_documents()
+                 if path not in own_paths]
+
+        if len(index.refresh(paths)) > 0 or indexed != set(paths):
+            write_index(index)
+
+        return index
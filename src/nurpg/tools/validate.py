@@ -0,0 +1,449 @@
+import re
+import bisect
+
+import nurpg.document as document
+import nurpg.memprofile as memprofile
+
+import nurpg.tools.export as export
+
+
+# Directive words that are reserved for the parser itself
+_RESERVED = frozenset([
+    document.D_ROOT,
+    document.D_CONTENT
+])
+
+# Kinds that grants and requires may refer to by name
+_NAMED_KINDS = frozenset([
+    document.D_SECTION,
+    document.D_FEATURE,
+    document.D_MECHANIC,
+    document.D_EFFECT,
+    document.D_ABILITY,
+    document.D_ASPECT
+])
+
+# Directives that refer to another element by name
+_REFERENCES = frozenset([
+    document.D_GRANTS,
+    document.D_REQUIRES,
+    document.D_REF
+])
+
+# Directives whose argument must be an integer
+_INTEGER_ARGUMENTS = frozenset([
+    document.D_COST,
+    document.D_DIFFICULTY
+])
+
+# Anything that makes a run of text between directives a content node
+_NON_SPACE_REGEX = re.compile('\\S')
+
+
+class Problem(object):
+
+    def __init__(self, line, msg, filename=None):
+        self.line = line
+        self.msg = msg
+
+        # Which file of a composed document the line is in
+        self.filename = filename
+
+    def __str__(self):
+        if self.filename is not None:
+            return '{}, line {}: {}'.format(self.filename, self.line, self.msg)
+
+        return 'Line {}: {}'.format(self.line, self.msg)
+
+
+class ValidationReport(object):
+
+    def __init__(self):
+        self.title = None
+        self.authors = list()
+        self.node_count = 0
+        self.problems = list()
+
+    @property
+    def valid(self):
+        return len(self.problems) == 0
+
+
+# The source of a composed document with every @include replaced by the
+# file it names, and where each piece of it came from
+class _Expansion(object):
+
+    def __init__(self, sources):
+        self.sources = sources
+        self.parts = list()
+        self.length = 0
+
+        # (offset here, path, offset in the file) where each piece starts
+        self.segments = list()
+
+    def expand(self, path):
+        content = self.sources[path]
+        halt = next(document.directive_offsets(content, document.D_HALT),
+                    len(content))
+        position = 0
+
+        # Files end at their own halt, the including file carries on
+        for offset in document.directive_offsets(
+                content, document.D_INCLUDE, 0, halt):
+            self._append(path, content, position, offset)
+
+            line_end = content.find(document.DIRECTIVE_END_CH, offset)
+            kind, separator, arguments = content[
+                offset + 1:line_end].partition(' ')
+
+            self.expand(document.include_path(path, arguments))
+            position = line_end + 1
+
+        self._append(path, content, position, halt)
+
+    def text(self):
+        return ''.join(self.parts)
+
+    def locate(self, offset):
+        # The path and line an offset into the text comes from
+        idx = bisect.bisect_right(
+            [segment[0] for segment in self.segments], offset) - 1
+        start, path, file_offset = self.segments[idx]
+
+        file_offset += offset - start
+        line = self.sources[path].count(
+            document.DIRECTIVE_END_CH, 0, file_offset) + 1
+
+        return path, line
+
+    def _append(self, path, content, start, end):
+        if end <= start:
+            return
+
+        self.segments.append((self.length, path, start))
+        self._write(content[start:end])
+
+        # Included text always starts on a line of its own
+        if content[end - 1] != document.DIRECTIVE_END_CH:
+            self._write(document.DIRECTIVE_END_CH)
+
+    def _write(self, text):
+        self.parts.append(text)
+        self.length += len(text)
+
+
+# What a stretch of a document holds, found without building it. Sections
+# always start back at the root, so a stretch starting at a @section (or at
+# the start of the document) can be scanned on its own and its names and
+# references checked against the rest of the document afterwards.
+class Scan(object):
+
+    def __init__(self):
+        # (offset, message) of every problem found within the stretch
+        self.problems = list()
+
+        # (kind, name) of every named element
+        self.names = set()
+
+        # (directive, (kind, name), offset) of every grant, requires and ref
+        self.references = list()
+        self.abilities = list()
+
+        # (offset, arguments) of every title
+        self.titles = list()
+        self.authors = list()
+
+        self.node_count = 0
+
+        # Whether a @halt ends the document within the stretch
+        self.halted = False
+
+
+class _Element(object):
+
+    def __init__(self, kind, name, offset):
+        self.kind = kind
+        self.name = name
+        self.offset = offset
+        self.grants = list()
+
+
+def check(doc_filename, symbols=None):
+    with memprofile.phase(memprofile.READ):
+        content = document.read_source(doc_filename)
+
+    if not document.has_includes(content):
+        return validate(content, symbols)
+
+    # Composed documents are checked as the text they stand for, so scopes
+    # carry on across files. Missing files and include cycles stop the
+    # document being read at all.
+    doc = document.read(doc_filename)
+
+    with memprofile.phase(memprofile.READ):
+        expansion = _Expansion(dict((path, document.read_source(path))
+                                    for path in doc.files))
+    expansion.expand(doc.files[0])
+
+    report, problems = _scan(expansion.text(), symbols)
+    report.problems = list()
+
+    for offset, msg in sorted(problems, key=lambda problem: problem[0]):
+        path, line = expansion.locate(offset)
+        report.problems.append(Problem(line, msg, path))
+
+    return report
+
+
+def validate(content, symbols=None):
+    report, problems = _scan(content, symbols)
+    report.problems = _resolve_lines(content, problems)
+    return report
+
+
+def scan(content):
+    # Everything the checks need from content, in a single pass
+    result = Scan()
+
+    # Every directive word a document may use and where it may go, including
+    # house rules
+    known_words = document.DIRECTIVES - _RESERVED
+    dispatch = document._DISPATCH
+    placement = document.PLACEMENT
+
+    # Problems are recorded by offset and resolved to line numbers in a
+    # single pass at the end so the scan never has to count lines
+    problems = result.problems
+
+    # The scope stack mirrors what DocumentBuilder does with each node
+    scope = [document.D_ROOT]
+    owner = None
+
+    names = result.names
+    references = result.references
+    abilities = result.abilities
+
+    node_count = 0
+    last_end = 0
+    has_content = False
+
+    # Scanning with str.find keeps the hot loop in C. Escapes only need
+    # checking when the document contains the escape character at all.
+    find = content.find
+    non_space = _NON_SPACE_REGEX.search
+    check_escapes = document.ESCAPE_CH in content
+    position = 0
+
+    while True:
+        start = find(document.DIRECTIVE_CH, position)
+
+        if start < 0:
+            break
+
+        position = start + 1
+
+        if check_escapes and document.is_escaped(content, start, last_end):
+            has_content = True
+            continue
+
+        # Count the content run that preceded this directive
+        if has_content or non_space(content, last_end, start) is not None:
+            node_count += 1
+
+        has_content = False
+        line_end = find(document.DIRECTIVE_END_CH, position)
+
+        if line_end < 0:
+            problems.append((start, 'Directive is missing its end of line.'))
+            last_end = len(content)
+            break
+
+        kind, separator, arguments = content[position:line_end].partition(' ')
+        last_end = position = line_end + 1
+
+        if kind == document.D_HALT:
+            result.halted = True
+            last_end = len(content)
+            break
+
+        if kind not in known_words:
+            problems.append((start, 'Unknown directive: {}'.format(kind)))
+            continue
+
+        node_count += 1
+        rule = dispatch.get(kind)
+
+        if rule is not None:
+            exits_to, closes, opens, header = rule
+
+            if header:
+                if kind == document.D_TITLE:
+                    result.titles.append((start, arguments))
+                elif kind == document.D_AUTHOR:
+                    result.authors.append(arguments)
+
+            elif exits_to is not None:
+                if exits_to not in scope:
+                    problems.append((start, '@{} must be inside a @{}.'.format(
+                        kind, exits_to)))
+                    scope = [document.D_ROOT]
+                else:
+                    del scope[len(scope) - scope[::-1].index(exits_to):]
+
+                # Elements own the grants that follow them
+                if exits_to == document.D_ROOT:
+                    owner = None
+                elif opens:
+                    owner = _Element(kind, arguments, start)
+
+                    if kind == document.D_ABILITY:
+                        abilities.append(owner)
+
+            if closes and scope[-1] in closes:
+                scope.pop()
+
+        if kind in placement and scope[-1] not in placement[kind]:
+            problems.append((start, '@{} may not be placed inside '
+                                    '@{}.'.format(kind, scope[-1])))
+
+        if rule is not None and rule[2]:
+            scope.append(kind)
+
+        if kind in _NAMED_KINDS:
+            try:
+                name, subtype = export.parse_name(arguments)
+                names.add((kind, name))
+            except export.ExportError as ex:
+                problems.append((start, ex.msg))
+
+        elif kind in _INTEGER_ARGUMENTS:
+            try:
+                int(arguments)
+            except ValueError:
+                problems.append((start, '@{} requires an integer value, not '
+                                        '"{}".'.format(kind, arguments)))
+
+        elif kind in _REFERENCES:
+            try:
+                ref_kind, name, subtype, multiplier = export.parse_grant_spec(
+                    arguments)
+                references.append((kind, (ref_kind, name), start))
+
+                if kind == document.D_GRANTS and owner is not None:
+                    owner.grants.append((ref_kind, name))
+            except export.ExportError as ex:
+                problems.append((start, ex.msg))
+
+    if has_content or non_space(content, last_end) is not None:
+        node_count += 1
+
+    result.node_count = node_count
+    return result
+
+
+def dangling(references, names, symbols=None):
+    # (offset, message) for every grant, requires and ref that doesn't
+    # resolve to a named element. Names that aren't defined here may still
+    # be defined by another document in the workspace's symbols.
+    return [(offset, 'Dangling @{}: {} {} not found.'.format(
+        kind, key[0], key[1])) for kind, key, offset in references
+        if key not in names and (symbols is None or key not in symbols)]
+
+
+def cycles(abilities):
+    # (ability, message) for every ability whose grants lead back to it.
+    # Only abilities are costed recursively so only they can form cycles.
+    return [(ability, 'Grant cycle detected: {}'.format(' -> '.join(cycle)))
+            for ability, cycle in _ability_cycles(abilities)]
+
+
+def _scan(content, symbols=None):
+    # The report and (offset, message) for every problem
+    with memprofile.phase(memprofile.VALIDATE):
+        result = scan(content)
+    problems = list(result.problems)
+
+    report = ValidationReport()
+    report.authors = result.authors
+    report.node_count = result.node_count
+
+    for offset, title in result.titles:
+        if report.title is not None:
+            problems.append((offset, 'Document has two title nodes.'))
+        else:
+            report.title = title
+
+    problems.extend(dangling(result.references, result.names, symbols))
+    problems.extend((ability.offset, msg)
+                    for ability, msg in cycles(result.abilities))
+
+    return report, problems
+
+
+def _resolve_lines(content, problems):
+    resolved = list()
+
+    line = 1
+    last_offset = 0
+
+    for offset, msg in sorted(problems, key=lambda problem: problem[0]):
+        line += content.count(document.DIRECTIVE_END_CH, last_offset, offset)
+        last_offset = offset
+
+        resolved.append(Problem(line, msg))
+
+    return resolved
+
+
+def _ability_cycles(abilities):
+    by_name = dict()
+
+    for ability in abilities:
+        try:
+            name, subtype = export.parse_name(ability.name)
+        except export.ExportError:
+            continue
+
+        by_name.setdefault(name, list()).append(ability)
+
+    # Iterative three-colour depth first search over ability grants
+    visiting = 1
+    done = 2
+    state = dict()
+
+    for start in abilities:
+        if start in state:
+            continue
+
+        path = [start]
+        stack = [(start, _granted_abilities(start, by_name))]
+        state[start] = visiting
+
+        while len(stack) > 0:
+            ability, pending = stack[-1]
+
+            if len(pending) == 0:
+                state[ability] = done
+                stack.pop()
+                path.pop()
+                continue
+
+            target = pending.pop()
+
+            if state.get(target) == visiting:
+                cycle = path[path.index(target):] + [target]
+                yield target, [element.name for element in cycle]
+            elif target not in state:
+                state[target] = visiting
+                path.append(target)
+                stack.append((target, _granted_abilities(target, by_name)))
+
+
+def _granted_abilities(ability, by_name):
+    granted = list()
+
+    for kind, name in ability.grants:
+        if kind == document.D_ABILITY:
+            granted.extend(by_name.get(name, ()))
+
+    return granted
@@ -0,0 +1,142 @@
+import os
+import sys
+import shutil
+import tempfile
+import timeit
+import multiprocessing
+
+import nurpg.document as document
+import nurpg.memprofile as memprofile
+
+import nurpg.tools.server as server
+import nurpg.tools.complete as complete
+
+import tests.synthetic as synthetic
+
+
+# Sections in the benchmark document, roughly 1 KB each
+_SECTIONS = 4000
+
+_REPEAT = 3
+
+# Prefixes completed as though typed one character at a time
+_TYPED = 'nimble'
+
+
+def benchmark(name, func, size):
+    seconds = min(timeit.repeat(func, number=1, repeat=_REPEAT))
+    print('{:<24} {:>8.3f} s {:>8.1f} MB/s'.format(
+        name, seconds, size / seconds / document.MB_IN_BYTES))
+
+
+def serialize_benchmarks(doc, size):
+    work_dir = tempfile.mkdtemp()
+
+    try:
+        doc_file = os.path.join(work_dir, 'bench.nd')
+
+        benchmark('serialize (dumps)', lambda: document.dumps(doc), size)
+        benchmark('serialize (write)',
+                  lambda: document.write(doc, doc_file), size)
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def sharing_benchmarks(content):
+    # Memory is measured in a fresh worker for each setting, before this
+    # process has parsed anything and left freed memory for it to reuse
+    for share in (False, True):
+        pool = multiprocessing.Pool(1)
+
+        try:
+            grown = pool.apply(_parse_growth, (content, share))
+        finally:
+            pool.terminate()
+
+        document.SHARE_STRINGS = share
+        doc = document.parse(content)
+
+        find = min(timeit.repeat(
+            lambda: sum(1 for node in document.find(doc.root, 'cost')),
+            number=1, repeat=_REPEAT))
+
+        print('{:<24} {:>8.1f} MB parsed {:>8.3f} s find'.format(
+            'shared strings' if share else 'unshared strings',
+            float(grown) / document.MB_IN_BYTES, find))
+
+        if doc.strings is not None:
+            print('{:<24} {:>8} {:>8.1f} MB saved'.format(
+                'strings shared', doc.strings.shared,
+                float(doc.strings.saved_bytes) / document.MB_IN_BYTES))
+
+    document.SHARE_STRINGS = True
+
+
+def completion_benchmarks(content):
+    doc = document.parse(content, lazy=True)
+
+    def build():
+        return complete.CompletionIndex.build(
+            [definition + (doc.title,) for definition
+             in complete.document_definitions(doc)], [], {})
+
+    index = min(timeit.repeat(build, number=1, repeat=_REPEAT))
+    built = build()
+
+    prefixes = [_TYPED[:size] for size in range(len(_TYPED) + 1)]
+    queries = min(timeit.repeat(lambda: [
+        built.complete(document.D_ABILITY, prefix) for prefix in prefixes],
+        number=100, repeat=_REPEAT))
+
+    print('{:<24} {:>8.3f} s {:>8.1f} us/query'.format(
+        'completion index', index,
+        queries * 1000000 / (100 * len(prefixes))))
+
+
+def editing_benchmarks(content):
+    # A character typed into an ability halfway through the document, with
+    # its diagnostics and cost worked out again after every one
+    buf = server.Buffer(content)
+    lines = content.split('\n')
+    line = len(lines) // 2
+
+    while not lines[line].startswith('@ability'):
+        line += 1
+
+    def keystroke():
+        buf.edit('x', (line, 9), (line, 9))
+        buf.diagnostics()
+        buf.hover(line, 0)
+
+    keystroke()
+    seconds = min(timeit.repeat(keystroke, number=100, repeat=_REPEAT))
+
+    print('{:<24} {:>8.3f} ms per keystroke'.format(
+        'editing', seconds * 10))
+
+
+def _parse_growth(content, share):
+    document.SHARE_STRINGS = share
+
+    before = memprofile._resident_bytes()
+    doc = document.parse(content)
+
+    return memprofile._resident_bytes() - before
+
+
+def main(sections=_SECTIONS):
+    content = synthetic.document_source(sections)
+    size = len(content)
+
+    print('Synthetic document: {} sections, {:.1f} MB'.format(
+        sections, float(size) / document.MB_IN_BYTES))
+
+    sharing_benchmarks(content)
+    completion_benchmarks(content)
+    editing_benchmarks(content)
+    benchmark('parse', lambda: document.parse(content), size)
+    serialize_benchmarks(document.parse(content), size)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
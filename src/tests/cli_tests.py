@@ -0,0 +1,82 @@
+import io
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import unittest
+
+import nurpg.config as config
+
+import nurpg.tools.cli as cli
+
+
+_DOC = """@title Export Test
+@section Abilities
+@ability Dodge
+@difficulty 10
+"""
+
+
+def _export(formats, output, **kwargs):
+    # Returns what the export printed
+    stdout = sys.stdout
+    sys.stdout = io.BytesIO()
+
+    try:
+        cli.export_tool(argparse.Namespace(
+            format=formats, output=output, **kwargs))
+        return sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout
+
+
+class TestExport(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.work_dir = tempfile.mkdtemp()
+
+        os.chdir(self.work_dir)
+        config.init_config('doc.nd')
+
+        with open('doc.nd', 'w') as fout:
+            fout.write(_DOC)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.work_dir)
+
+    def test_output_directory(self):
+        # Every format lands in the output directory, none overwrites another
+        _export('html,md,json,ndjson', 'out')
+
+        self.assertEqual(['Export Test.html', 'Export Test.json',
+                          'Export Test.md', 'Export Test.ndjson'],
+                         sorted(os.listdir('out')))
+
+        with open(os.path.join('out', 'Export Test.json')) as fin:
+            self.assertEqual('Export Test', json.load(fin)['title'])
+
+    def test_sharded_output_directory(self):
+        _export('html,txt', 'out', sharded=True)
+
+        self.assertEqual(['.shards', 'Export Test.txt', 'index.html',
+                          'section-abilities.html'],
+                         sorted(os.listdir('out')))
+
+    def test_stdout(self):
+        printed = _export('json', '-')
+        self.assertEqual('Export Test', json.loads(printed)['title'])
+
+        for formats, kwargs in [('json,ndjson', {}), ('txt', {}),
+                                ('html,json', {'sharded': True})]:
+            with self.assertRaises(cli.ToolError):
+                _export(formats, '-', **kwargs)
+
+        self.assertEqual(['.nds', 'doc.nd'], sorted(os.listdir('.')))
+
+
+if __name__ == '__main__':
+    unittest.main()
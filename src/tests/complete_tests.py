@@ -0,0 +1,132 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import nurpg.config as config
+import nurpg.document as document
+
+import nurpg.tools.complete as complete
+
+
+_CORE = """@title Core Rules
+@section Abilities
+@ability Dodge
+@difficulty 10
+@ability dodge roll
+@difficulty 15
+@feature Weapon Proficiency (Sword)
+@mechanic Weapon Proficiency (Bow)
+@cost 2
+"""
+
+_BESTIARY = """@title Bestiary
+@section Beasts
+@ability Dodge
+@ability Bite
+@mechanic Weapon Proficiency (Claw)
+"""
+
+
+def _write(filename, content):
+    with open(filename, 'w') as fout:
+        fout.write(content)
+
+
+def _texts(completions):
+    return [completion.text() for completion in completions]
+
+
+class TestCompletionIndex(unittest.TestCase):
+
+    def setUp(self):
+        definitions = [(kind, name, subtype, 'Core Rules') for
+                       kind, name, subtype in complete.document_definitions(
+                           document.parse(_CORE, lazy=True))]
+
+        self.index = complete.CompletionIndex.build(definitions, [], {})
+
+    def test_prefixes_ignore_case(self):
+        self.assertEqual(['Dodge', 'dodge roll'], _texts(
+            self.index.complete(document.D_ABILITY, 'DOD')))
+        self.assertEqual(['dodge roll'], _texts(
+            self.index.complete('Ability', 'dodge r')))
+        self.assertEqual([], _texts(
+            self.index.complete(document.D_ABILITY, 'roll')))
+
+    def test_subtypes(self):
+        self.assertEqual(['Weapon Proficiency (Bow)'], _texts(
+            self.index.complete(document.D_MECHANIC, 'weapon proficiency (')))
+        self.assertEqual(['Weapon Proficiency (Sword)'], _texts(
+            self.index.complete(document.D_FEATURE,
+                                'Weapon Proficiency(sw')))
+        self.assertEqual([], _texts(
+            self.index.complete(document.D_FEATURE, 'Weapon Proficiency (b')))
+
+    def test_limit(self):
+        self.assertEqual(['Abilities'], _texts(
+            self.index.complete(document.D_SECTION, '')))
+        self.assertEqual(['Dodge'], _texts(
+            self.index.complete(document.D_ABILITY, '', limit=1)))
+
+        with self.assertRaises(complete.CompletionError):
+            self.index.complete(document.D_COST, '')
+
+
+class TestWorkspaceCompletions(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.work_dir = tempfile.mkdtemp()
+
+        os.chdir(self.work_dir)
+        config.init_config('core.nd')
+
+        _write('core.nd', _CORE)
+        _write('bestiary.nd', _BESTIARY)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.work_dir)
+
+    def test_workspace_names(self):
+        index = complete.workspace_completions(config.read_config())
+
+        # The document's own definition comes before the same name elsewhere
+        self.assertEqual([('Bite', 'Bestiary'), ('Dodge', 'Core Rules')], [
+            (completion.text(), completion.title) for completion in
+            index.complete(document.D_ABILITY, 'b') +
+            index.complete(document.D_ABILITY, 'dodge', limit=1)])
+
+        self.assertEqual(['Weapon Proficiency (Bow)',
+                          'Weapon Proficiency (Claw)'], _texts(
+            index.complete(document.D_MECHANIC, 'w')))
+
+    def test_cached_until_changed(self):
+        cfg = config.read_config()
+        complete.workspace_completions(cfg)
+
+        read = document.read
+        document.read = None
+
+        try:
+            cached = complete.workspace_completions(cfg)
+        finally:
+            document.read = read
+
+        self.assertEqual(['Bite'], _texts(
+            cached.complete(document.D_ABILITY, 'bi')))
+
+        _write('core.nd', _CORE + '@ability Bind\n')
+        self.assertEqual(['Bind', 'Bite'], _texts(
+            complete.workspace_completions(cfg).complete(
+                document.D_ABILITY, 'bi')))
+
+        os.remove('bestiary.nd')
+        self.assertEqual(['Bind'], _texts(
+            complete.workspace_completions(cfg).complete(
+                document.D_ABILITY, 'bi')))
+
+
+if __name__ == '__main__':
+    unittest.main()
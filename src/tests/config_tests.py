@@ -0,0 +1,147 @@
+import os
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+
+import nurpg.config as config
+
+
+_PROCESSES = 32
+_PUSHES = 4
+
+
+def _push_and_read(worker):
+    # Every push must survive the other writers and every read must see a
+    # whole configuration
+    doc_file = 'worker-{}.nd'.format(worker)
+
+    for push in range(_PUSHES):
+        with open(doc_file, 'w') as fout:
+            fout.write('@title Worker {} push {}\n'.format(worker, push))
+
+        config.stash_push(doc_file)
+        config.read_config()
+
+
+def _fail(fd):
+    raise OSError(5, 'Input/output error')
+
+
+def _try_lock(exclusive, result):
+    lock_file = open(config._NDS_LOCK_FILE, 'a')
+
+    try:
+        config.fcntl.flock(lock_file.fileno(), (
+            config.fcntl.LOCK_EX if exclusive else config.fcntl.LOCK_SH) |
+            config.fcntl.LOCK_NB)
+        result.value = 1
+    except IOError:
+        result.value = 0
+    finally:
+        lock_file.close()
+
+
+@unittest.skipIf(config.fcntl is None, 'File locking is not available.')
+class TestWorkspaceLocking(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.work_dir = tempfile.mkdtemp()
+
+        os.chdir(self.work_dir)
+        config.init_config('document.nd')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.work_dir)
+
+    def _lock_available(self, exclusive):
+        result = multiprocessing.Value('i', -1)
+        process = multiprocessing.Process(
+            target=_try_lock, args=(exclusive, result))
+
+        process.start()
+        process.join()
+        return result.value == 1
+
+    def test_readers_share_the_lock(self):
+        with config.WorkspaceLock():
+            self.assertTrue(self._lock_available(exclusive=False))
+            self.assertFalse(self._lock_available(exclusive=True))
+
+        with config.WorkspaceLock(exclusive=True):
+            self.assertFalse(self._lock_available(exclusive=False))
+
+    def test_shared_locks_are_not_upgraded(self):
+        with config.WorkspaceLock():
+            with self.assertRaises(config.ConfigurationError):
+                with config.WorkspaceLock(exclusive=True):
+                    pass
+
+    def test_pop_restores_before_dropping(self):
+        with open('document.nd', 'w') as fout:
+            fout.write('@title Stashed\n')
+
+        stash_id = config.stash_push('document.nd')
+        os.mkdir('unwritable.nd')
+
+        # An entry that can't be restored is kept
+        with self.assertRaises(EnvironmentError):
+            config.stash_pop('unwritable.nd')
+
+        self.assertEqual([stash_id], config.read_config().stash_stack)
+
+        # A restore that fails partway leaves the document whole
+        with open('restored.nd', 'w') as fout:
+            fout.write('@title Current\n')
+
+        fsync = os.fsync
+        os.fsync = _fail
+
+        try:
+            with self.assertRaises(OSError):
+                config.stash_pop('restored.nd')
+        finally:
+            os.fsync = fsync
+
+        self.assertEqual([stash_id], config.read_config().stash_stack)
+        self.assertEqual([], [name for name in os.listdir('.')
+                              if name.startswith('.nd-')])
+
+        with open('restored.nd', 'r') as fin:
+            self.assertEqual('@title Current\n', fin.read())
+
+        self.assertEqual(stash_id, config.stash_pop('restored.nd'))
+        self.assertEqual([], config.read_config().stash_stack)
+
+        with open('restored.nd', 'r') as fin:
+            self.assertEqual('@title Stashed\n', fin.read())
+
+        self.assertIsNone(config.stash_pop('restored.nd'))
+
+    def test_concurrent_pushes_are_not_lost(self):
+        processes = [multiprocessing.Process(target=_push_and_read,
+                                             args=(worker,))
+                     for worker in range(_PROCESSES)]
+
+        for process in processes:
+            process.start()
+
+        for process in processes:
+            process.join()
+
+        self.assertEqual([0] * _PROCESSES,
+                         [process.exitcode for process in processes])
+
+        cfg = config.read_config()
+
+        self.assertEqual(_PROCESSES * _PUSHES, len(cfg.stash_stack))
+        self.assertEqual(_PROCESSES * _PUSHES, len(set(cfg.stash_stack)))
+
+        for stash_id in cfg.stash_stack:
+            self.assertTrue(config.stash_read(stash_id).startswith('@title'))
+
+
+if __name__ == '__main__':
+    unittest.main()
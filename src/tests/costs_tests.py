@@ -0,0 +1,113 @@
+import os
+import unittest
+
+import nurpg.document as document
+
+import nurpg.tools.costs as costs
+import nurpg.tools.export as export
+
+
+_EXAMPLE_DOC = os.path.join(
+    os.path.dirname(__file__), '..', '..', 'examples', 'nurpg.nd')
+
+_SMALL_DOC = """@title Cost Test
+@section Mechanics
+@feature Proficiency
+@mechanic Ability Proficiency
+@cost 1
+@mechanic Dodge Proficiency
+@cost 2
+@section Abilities
+@ability Dodge
+@difficulty 10
+@grants mechanic Dodge Proficiency
+@ability Tumble
+@difficulty 15
+@grants ability Dodge
+@grants mechanic Ability Proficiency, 3
+@section Aspects
+@aspect Acrobat
+@grants ability Tumble
+@grants mechanic Dodge Proficiency, 2
+"""
+
+
+def _node(doc, kind, content):
+    return next(document.find(doc.root, kind, content))
+
+
+class TestCostGraph(unittest.TestCase):
+
+    def setUp(self):
+        self.doc = document._parse(_SMALL_DOC)
+        self.graph = costs.build(self.doc)
+
+    def test_matches_export_costs(self):
+        doc = document.read(_EXAMPLE_DOC)
+        graph = costs.build(doc)
+
+        for ability in document.find(doc.root, document.D_ABILITY):
+            self.assertEqual(
+                export.ability_cost(doc, ability), graph.cost(ability))
+
+        for aspect in document.find(doc.root, document.D_ASPECT):
+            expected = sum(export.grant_cost(doc, grant)
+                           for grant in aspect.find(document.D_GRANTS))
+            self.assertEqual(expected, graph.cost(aspect))
+
+    def test_totals(self):
+        self.assertEqual(3, self.graph.cost(_node(self.doc, 'ability', 'Dodge')))
+        self.assertEqual(6, self.graph.cost(_node(self.doc, 'ability', 'Tumble')))
+        self.assertEqual(10, self.graph.cost(_node(self.doc, 'aspect', 'Acrobat')))
+
+    def test_update_recomputes_dependents(self):
+        mechanic = _node(self.doc, 'mechanic', 'Dodge Proficiency')
+        cost = mechanic.children[0]
+        cost.content = '4'
+
+        changed = self.graph.update([cost])
+        dodge = _node(self.doc, 'ability', 'Dodge')
+        tumble = _node(self.doc, 'ability', 'Tumble')
+        acrobat = _node(self.doc, 'aspect', 'Acrobat')
+
+        self.assertEqual({dodge.id: 2, tumble.id: 2, acrobat.id: 6}, changed)
+        self.assertEqual(16, self.graph.cost(acrobat))
+
+    def test_update_leaves_unrelated_totals(self):
+        mechanic = _node(self.doc, 'mechanic', 'Ability Proficiency')
+        mechanic.children[0].content = '2'
+
+        changed = self.graph.update([mechanic])
+        tumble = _node(self.doc, 'ability', 'Tumble')
+        acrobat = _node(self.doc, 'aspect', 'Acrobat')
+
+        self.assertEqual({tumble.id: 3, acrobat.id: 3}, changed)
+        self.assertEqual(
+            set([tumble, acrobat]), set(self.graph.dependents(mechanic)))
+
+    def test_what_if_does_not_modify(self):
+        cost = _node(self.doc, 'mechanic', 'Dodge Proficiency').children[0]
+        acrobat = _node(self.doc, 'aspect', 'Acrobat')
+
+        deltas = self.graph.what_if({cost: 0})
+
+        self.assertEqual(-6, deltas[acrobat.id])
+        self.assertEqual('2', cost.content)
+        self.assertEqual(10, self.graph.cost(acrobat))
+
+    def test_what_if_difficulty(self):
+        difficulty = _node(self.doc, 'ability', 'Tumble').children[0]
+        deltas = self.graph.what_if({difficulty: 5})
+
+        self.assertEqual(set([2]), set(deltas.values()))
+
+    def test_grant_cycles_are_reported(self):
+        doc = document._parse('@section S\n'
+                              '@ability A\n@grants ability B\n'
+                              '@ability B\n@grants ability A\n')
+
+        self.assertRaises(costs.CostGraphError, costs.build, doc)
+
+
+if __name__ == '__main__':
+    unittest.main()
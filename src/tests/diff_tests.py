@@ -0,0 +1,103 @@
+import unittest
+
+import nurpg.document as document
+
+import nurpg.tools.diff as diff
+import nurpg.tools.costs as costs
+
+
+_OLD_DOC = """@title Diff
+@section Mechanics
+@feature Proficiency
+@mechanic Dodge Proficiency
+@cost 2
+Dodge bonuses.
+@section Abilities
+@ability Dodge
+@difficulty 10
+@grants mechanic Dodge Proficiency
+"""
+
+
+class TestDiff(unittest.TestCase):
+
+    def test_identical_documents(self):
+        self.assertEqual([], diff.diff(document.parse(_OLD_DOC),
+                                       document.parse(_OLD_DOC)))
+
+    def test_reports_changes_and_costs(self):
+        new_doc = _OLD_DOC.replace('@cost 2', '@cost 4').replace(
+            'Dodge bonuses.\n', '') + '@ability Parry\n'
+
+        old = document.parse(_OLD_DOC)
+        new = document.parse(new_doc)
+
+        changes = [(change.change, change.node.id)
+                   for change in diff.diff(old, new)]
+
+        self.assertEqual([
+            (diff.ADDED, 'section/ability/parry'),
+            (diff.MODIFIED, 'section/feature/mechanic/dodge-proficiency/cost-1'),
+            (diff.REMOVED,
+             'section/feature/mechanic/dodge-proficiency/content-1')
+        ], sorted(changes))
+
+        cost_changes = [(change.node.id, change.before, change.after)
+                        for change in diff.cost_changes(old, new)]
+
+        self.assertEqual([('section/ability/dodge', 3, 5)], cost_changes)
+
+    def test_costs_follow_only_the_changes(self):
+        old = document.parse(_OLD_DOC + '@ability Roll\n@difficulty 15\n'
+                             '@grants ability Dodge\n')
+
+        for new_doc in [
+                # A grant and a difficulty removed from under their ability
+                _OLD_DOC.replace('@grants mechanic Dodge Proficiency\n', '') +
+                '@ability Roll\n@grants ability Dodge\n',
+                # A feature taken away from what grants its mechanic
+                _OLD_DOC[_OLD_DOC.index('@section Abilities'):] +
+                '@ability Roll\n@difficulty 15\n@grants ability Dodge\n',
+                # A second ability of the same name moves the first's id
+                _OLD_DOC.replace('@section Abilities\n',
+                                 '@section Abilities\n@ability Roll\n') +
+                '@ability Roll\n@difficulty 15\n@grants ability Dodge\n']:
+            new = document.parse(new_doc)
+
+            expected = diff._rebuilt_cost_changes(costs.build(old), new)
+            found = diff.cost_changes(old, new)
+
+            self.assertNotEqual([], expected)
+            self.assertEqual(
+                [(change.node.id, change.before, change.after)
+                 for change in expected],
+                [(change.node.id, change.before, change.after)
+                 for change in found])
+
+    def test_costs_are_only_updated(self):
+        old = document.parse(_OLD_DOC)
+        new = document.parse(_OLD_DOC.replace('@difficulty 10',
+                                              '@difficulty 20'))
+
+        build = costs.build
+        built = list()
+
+        def counting(doc):
+            built.append(doc)
+            return build(doc)
+
+        costs.build = counting
+
+        try:
+            changes = diff.cost_changes(old, new)
+        finally:
+            costs.build = build
+
+        self.assertEqual([old], built)
+        self.assertEqual([('section/ability/dodge', 3, 1)],
+                         [(change.node.id, change.before, change.after)
+                          for change in changes])
+
+
+if __name__ == '__main__':
+    unittest.main()
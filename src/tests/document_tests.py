@@ -0,0 +1,390 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import nurpg.config as config
+import nurpg.document as document
+
+import tests.synthetic as synthetic
+
+
+_DOC = """@title Ids
+@section Abilities
+Intro text.
+@ability Lock Pick
+@difficulty 10
+@ability Lock Pick
+@section Other
+@feature Lock Pick
+@mechanic Tension Wrench
+@cost 1
+"""
+
+
+def _ids(doc):
+    return [node.id for node in _walk(doc.root)]
+
+
+def _walk(root):
+    for child in root.children:
+        yield child
+
+        for node in _walk(child):
+            yield node
+
+
+class TestNodeIds(unittest.TestCase):
+
+    def test_ids_are_path_derived(self):
+        self.assertEqual([
+            'title-1',
+            'section/abilities',
+            'section/abilities/content-1',
+            'section/ability/lock-pick',
+            'section/ability/lock-pick/difficulty-1',
+            'section/ability/lock-pick-2',
+            'section/other',
+            'section/feature/lock-pick',
+            'section/feature/mechanic/tension-wrench',
+            'section/feature/mechanic/tension-wrench/cost-1'
+        ], _ids(document._parse(_DOC)))
+
+    def test_ids_are_stable_across_reparses(self):
+        self.assertEqual(_ids(document._parse(_DOC)),
+                         _ids(document._parse(_DOC)))
+
+    def test_unrelated_edits_keep_ids(self):
+        edited = _DOC.replace('Intro text.', '@section Added\nMore text.')
+        before = document._parse(_DOC)
+        after = document._parse(edited)
+
+        feature = next(before.root.find(document.D_FEATURE))
+        edited_feature = next(after.root.find(document.D_FEATURE))
+
+        self.assertEqual(feature.id, edited_feature.id)
+
+
+class TestNodeHashes(unittest.TestCase):
+
+    def test_identical_subtrees_share_hashes(self):
+        self.assertEqual(document._parse(_DOC).root.hash,
+                         document._parse(_DOC).root.hash)
+
+    def test_edits_invalidate_ancestors(self):
+        doc = document._parse(_DOC)
+        mechanic = next(doc.root.find(document.D_MECHANIC))
+        section_hash = mechanic.parent.parent.hash
+        root_hash = doc.root.hash
+
+        mechanic.children[0].content = '2'
+
+        self.assertNotEqual(section_hash, mechanic.parent.parent.hash)
+        self.assertNotEqual(root_hash, doc.root.hash)
+
+
+class TestGrammar(unittest.TestCase):
+
+    def tearDown(self):
+        # House rules are global so drop the one registered by a test
+        if 'sidebar' in document.D_WORDS:
+            document.D_WORDS.remove('sidebar')
+            document.GRAMMAR.pop('sidebar', None)
+            document._compile_grammar()
+
+    def test_nesting(self):
+        doc = document.parse('@section S\n@feature F\n@mechanic A\n'
+                             '@cost 1\n@mechanic B\n@ability X\n')
+        section = doc.root.children[0]
+        feature = section.children[0]
+
+        self.assertEqual(['feature', 'ability'],
+                         [child.kind for child in section.children])
+        self.assertEqual(['A', 'B'],
+                         [child.content for child in feature.children])
+
+    def test_elements_outside_their_scope(self):
+        self.assertRaises(document.DocumentParsingError, document.parse,
+                          '@feature Orphan\n')
+
+    def test_house_rule_directives(self):
+        self.assertRaises(document.DocumentParsingError, document.parse,
+                          '@section S\n@sidebar Aside\n')
+
+        document.register_directive('sidebar', exits_to=document.D_SECTION,
+                                    opens=True)
+        doc = document.parse('@section S\n@sidebar Aside\nText.\n'
+                             '@ability X\n')
+        section = doc.root.children[0]
+
+        self.assertEqual(['sidebar', 'ability'],
+                         [child.kind for child in section.children])
+        self.assertEqual('section/sidebar/aside', section.children[0].id)
+        self.assertEqual('Text.', section.children[0].children[0].content)
+
+    def test_invalid_house_rules(self):
+        self.assertRaises(document.DocumentError,
+                          document.register_directive, 'section')
+        self.assertRaises(document.DocumentError,
+                          document.register_directive, 'side bar')
+        self.assertRaises(document.DocumentError,
+                          document.register_directive, 'sidebar',
+                          exits_to=document.D_COST)
+        self.assertRaises(document.DocumentError,
+                          document.register_directive, 'sidebar',
+                          accepts=['bogus'])
+
+
+class TestLazyDocuments(unittest.TestCase):
+
+    def test_matches_full_parse(self):
+        source = synthetic.document_source(50)
+        full = document.parse(source)
+        lazy = document.parse(source, lazy=True)
+
+        self.assertEqual(full.title, lazy.title)
+        self.assertEqual(full.authors, lazy.authors)
+
+        # Touching a late section first must not change any ids
+        list(lazy.sections)[-1].children
+
+        self.assertEqual(_ids(full), _ids(lazy))
+        self.assertEqual(full.root.hash, lazy.root.hash)
+        self.assertEqual(sorted(full.source_map.sections.values()),
+                         sorted(lazy.source_map.sections.values()))
+
+    def test_sections_are_built_on_first_access(self):
+        doc = document.parse('@title Lazy\n@section A\nText.\n'
+                             '@section B\n@bogus\n', lazy=True)
+        sections = list(doc.sections)
+
+        self.assertEqual('Lazy', doc.title)
+        self.assertEqual(['A', 'B'], [section.content for section in sections])
+        self.assertEqual('Text.', sections[0].children[0].content)
+        self.assertRaises(document.DocumentParsingError,
+                          lambda: sections[1].children)
+
+    def test_only_real_directives_split_sections(self):
+        doc = document.parse('@section A\n\\@section Escaped\n'
+                             '@note see @section Argument\n'
+                             '@ability X\n@title Late\nMore.\n', lazy=True)
+
+        self.assertEqual(['section', 'title'],
+                         [node.kind for node in doc.root.children])
+        self.assertEqual('Late', doc.title)
+
+        section = doc.root.children[0]
+
+        self.assertEqual(['content', 'note', 'ability'],
+                         [node.kind for node in section.children])
+        self.assertEqual('More.', section.children[2].children[0].content)
+
+
+class TestContentViews(unittest.TestCase):
+
+    def test_matches_full_parse(self):
+        source = synthetic.document_source(50)
+        full = document.parse(source)
+
+        for lazy in (False, True):
+            viewed = document.parse(source, lazy=lazy, views=True)
+
+            self.assertEqual(_ids(full), _ids(viewed))
+            self.assertEqual(full.root.hash, viewed.root.hash)
+            self.assertEqual(document.dumps(full), document.dumps(viewed))
+
+    def test_views_resolve_escapes(self):
+        doc = document.parse('@section A\\@b\n  Costs 2\\@ AP.  \n'
+                             '@section B\n\\ \n', views=True)
+        sections = list(doc.sections)
+
+        self.assertEqual('A\\@b', sections[0].content)
+        self.assertEqual('Costs 2@ AP.', sections[0].children[0].content)
+
+        # Escaped whitespace alone never becomes a content node
+        self.assertEqual(0, len(sections[1].children))
+
+    def test_edits_replace_views(self):
+        doc = document.parse('@section A\nOld.\n', views=True)
+        node = list(doc.sections)[0].children[0]
+
+        node.content = 'New.'
+        self.assertEqual('New.', node.content)
+        self.assertEqual('@section A\nNew.\n\n', document.dumps(doc))
+
+
+class TestParallelParse(unittest.TestCase):
+
+    def setUp(self):
+        self.min_bytes = document.PARALLEL_MIN_BYTES
+        document.PARALLEL_MIN_BYTES = 0
+
+    def tearDown(self):
+        document.PARALLEL_MIN_BYTES = self.min_bytes
+
+    def _assert_matches(self, source, **kwargs):
+        serial = document.parse(source)
+        parallel = document.parse(source, jobs=2, **kwargs)
+
+        self.assertEqual(_ids(serial), _ids(parallel))
+        self.assertEqual(serial.root.hash, parallel.root.hash)
+        self.assertEqual(document.dumps(serial), document.dumps(parallel))
+        self.assertEqual(sorted(serial.source_map.sections.values()),
+                         sorted(parallel.source_map.sections.values()))
+
+    def test_matches_serial_parse(self):
+        source = synthetic.document_source(200)
+
+        self._assert_matches(source)
+        self._assert_matches(source, views=True)
+
+    def test_colliding_names(self):
+        # Element ids only include the kinds they're nested in, so the same
+        # name in different sections collides and is suffixed in order
+        self._assert_matches(
+            '@section A\n@ability Same\nOne.\n@ability Same-2\nTwo.\n'
+            '@section B\n@ability Same\nThree.\n@mechanic Same\nFour.\n'
+            '@section A\n@ability Same\n@mechanic Same\nFive.\n')
+
+    def test_errors(self):
+        source = '@section A\nText.\n@section B\n@bogus\n@section C\n'
+
+        with self.assertRaises(document.DocumentParsingError) as serial:
+            document.parse(source, jobs=1)
+
+        with self.assertRaises(document.DocumentParsingError) as parallel:
+            document.parse(source, jobs=2)
+
+        self.assertEqual(serial.exception.msg, parallel.exception.msg)
+
+
+class TestSharedStrings(unittest.TestCase):
+
+    _SOURCE = ('@section A\n@mechanic Dodge\n@cost 12\nSame note.\n'
+               '@section B\n@mechanic Dodge\n@cost 12\nSame note.\n')
+
+    def _assert_shared(self, doc):
+        first, second = [list(document._walk(section))
+                         for section in doc.sections]
+
+        for node, other in zip(first, second):
+            self.assertIs(node.content, other.content)
+
+        # Kinds are the grammar's own constants
+        self.assertIs(document.D_MECHANIC, first[0].kind)
+        self.assertGreaterEqual(doc.strings.shared, 3)
+        self.assertGreater(doc.strings.saved_bytes, 0)
+
+    def test_repeats_are_shared(self):
+        self._assert_shared(document.parse(self._SOURCE))
+
+        doc = document.parse(self._SOURCE, lazy=True)
+        self.assertIsNone(doc.strings)
+
+        list(document.find(doc.root, document.D_COST))
+        self._assert_shared(doc)
+
+    def test_parallel_repeats_are_shared(self):
+        min_bytes = document.PARALLEL_MIN_BYTES
+        document.PARALLEL_MIN_BYTES = 0
+
+        try:
+            self._assert_shared(document.parse(self._SOURCE, jobs=2))
+        finally:
+            document.PARALLEL_MIN_BYTES = min_bytes
+
+
+class TestIncludes(unittest.TestCase):
+
+    _FILES = {
+        'book.nd': '@title Book\n@include parts/mechanics.nd\n'
+                   '@section Abilities\n@ability Dodge\n@difficulty 10\n',
+        'parts/mechanics.nd': '@section Mechanics\n@feature Proficiency\n'
+                              '@include proficiencies.nd\nAfter the part.\n',
+        'parts/proficiencies.nd': '@mechanic Dodge Proficiency\n@cost 2\n'
+                                  '@halt\nLeft out.\n'
+    }
+
+    # What the files stand for, with every @include written out in place
+    _INLINE = ('@title Book\n@section Mechanics\n@feature Proficiency\n'
+               '@mechanic Dodge Proficiency\n@cost 2\nAfter the part.\n'
+               '@section Abilities\n@ability Dodge\n@difficulty 10\n')
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.work_dir = tempfile.mkdtemp()
+
+        os.chdir(self.work_dir)
+        os.mkdir('parts')
+        config.init_config('book.nd')
+
+        for filename, content in self._FILES.items():
+            self._write(filename, content)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.work_dir)
+
+    def _write(self, filename, content):
+        with open(filename, 'w') as fout:
+            fout.write(content)
+
+    def test_matches_inline_document(self):
+        inline = document.parse(self._INLINE)
+        doc = document.read('book.nd')
+
+        # Scopes carry on across files, a halt only ends its own file
+        self.assertEqual(_ids(inline), _ids(doc))
+        self.assertEqual(inline.root.hash, doc.root.hash)
+        self.assertEqual('Book', doc.title)
+        self.assertEqual(['book.nd', os.path.join('parts', 'mechanics.nd'),
+                          os.path.join('parts', 'proficiencies.nd')],
+                         doc.files)
+
+        with self.assertRaises(document.DocumentError):
+            document.edit('book.nd').__enter__()
+
+    def test_only_changed_files_are_tokenized(self):
+        document.read('book.nd')
+        self.assertEqual(3, len(os.listdir(config.TOKENS_DIR)))
+
+        tokenized = list()
+        tokenize_file = document._tokenize_file
+
+        def counting(content):
+            tokenized.append(content)
+            return tokenize_file(content)
+
+        document._tokenize_file = counting
+
+        try:
+            self._write('book.nd', self._FILES['book.nd'] + 'More.\n')
+            doc = document.read('book.nd')
+        finally:
+            document._tokenize_file = tokenize_file
+
+        self.assertEqual([self._FILES['book.nd'] + 'More.\n'], tokenized)
+        self.assertEqual(document.parse(self._INLINE + 'More.\n').root.hash,
+                         doc.root.hash)
+
+    def test_parallel_tokenizing(self):
+        min_bytes = document.PARALLEL_MIN_BYTES
+        document.PARALLEL_MIN_BYTES = 0
+
+        try:
+            shutil.rmtree(config.TOKENS_DIR, ignore_errors=True)
+            doc = document.read('book.nd', jobs=2)
+        finally:
+            document.PARALLEL_MIN_BYTES = min_bytes
+
+        self.assertEqual(document.parse(self._INLINE).root.hash, doc.root.hash)
+
+    def test_include_cycles(self):
+        self._write('parts/proficiencies.nd', '@include ../book.nd\n')
+
+        with self.assertRaises(document.DocumentParsingError):
+            document.read('book.nd')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,163 @@
+import os
+import stat
+import shutil
+import tempfile
+import unittest
+
+import nurpg.journal as journal
+import nurpg.document as document
+
+
+_DOC = """@title Edits
+@author Someone
+
+@section First
+First section text.
+
+@section Second
+@ability Dodge
+@difficulty 10
+
+@section Third
+Third section text.
+@halt
+Notes after the halt.
+"""
+
+
+class TestEditSessions(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.doc_file = os.path.join(self.work_dir, 'test.nd')
+        self.journal_file = os.path.join(self.work_dir, '.nds', 'journal')
+
+        with open(self.doc_file, 'w') as fout:
+            fout.write(_DOC)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def _edit(self):
+        return document.edit(self.doc_file, self.journal_file)
+
+    def _source(self):
+        with open(self.doc_file, 'r') as fin:
+            return fin.read()
+
+    def test_patches_only_the_touched_section(self):
+        with self._edit() as session:
+            difficulty = session.node('section/ability/dodge/difficulty-1')
+            session.set_content(difficulty, '15')
+
+        source = self._source()
+
+        self.assertTrue(source.startswith(_DOC[:_DOC.index('@section Second')]))
+        self.assertTrue(source.endswith(_DOC[_DOC.index('@section Third'):]))
+        self.assertIn('@difficulty 15\n', source)
+
+    def test_session_round_trips(self):
+        with self._edit() as session:
+            section = session.node('section/first')
+            session.append(section, document.DocumentNode(
+                document.D_CONTENT, 'Mail me@example.com'))
+            session.remove('section/second')
+            session.set_content('title-1', 'Edited')
+
+        doc = document.read(self.doc_file)
+
+        self.assertEqual('Edited', doc.title)
+        self.assertEqual(['Someone'], doc.authors)
+        self.assertEqual(['First', 'Third'],
+                         [section.content for section in doc.sections])
+        # Adjacent content runs read back as a single node
+        self.assertEqual('First section text.\n\nMail me@example.com',
+                         next(doc.root.find(document.D_SECTION, 'First'))
+                         .children[0].content)
+        self.assertIn('Notes after the halt.', self._source())
+
+    def test_inserted_ids_are_unique(self):
+        session = self._edit().__enter__()
+        text = session.node('section/first/content-1')
+        inserted = session.insert('section/first', 0, document.DocumentNode(
+            document.D_CONTENT, 'Before.'))
+
+        self.assertNotEqual(text.id, inserted.id)
+        self.assertIs(text, session.node(text.id))
+        self.assertIs(inserted, session.node(inserted.id))
+
+        session.set_content(inserted.id, 'Inserted.')
+
+        # A recovered session gives the inserted node the same id
+        with self._edit() as session:
+            self.assertEqual('Inserted.', session.node(inserted.id).content)
+            self.assertEqual('First section text.',
+                             session.node(text.id).content)
+
+    def test_successive_saves_keep_offsets(self):
+        with self._edit() as session:
+            session.set_content('section/first/content-1', 'A much longer '
+                                'replacement for the first section.')
+            session.save()
+            session.set_content('section/third/content-1', 'Third, again.')
+
+        doc = document.read(self.doc_file)
+        contents = [node.content for node in doc.root.find(document.D_CONTENT)]
+
+        self.assertEqual(['A much longer replacement for the first section.',
+                          'Third, again.'], contents)
+
+    def test_compaction_rewrites_and_clears_the_journal(self):
+        with self._edit() as session:
+            session.set_content('section/third/content-1', 'Changed.')
+            session.compact()
+
+        self.assertFalse(os.path.exists(self.journal_file) and any(
+            entry['op'] == journal.OP_SET
+            for entry in journal.Journal(self.journal_file).entries()))
+        self.assertEqual('Changed.', next(document.read(
+            self.doc_file).root.find(document.D_CONTENT, 'Changed.')).content)
+
+    def test_compaction_keeps_the_file_mode(self):
+        os.chmod(self.doc_file, 0o644)
+
+        with self._edit() as session:
+            session.set_content('section/third/content-1', 'Changed.')
+            session.compact()
+
+        self.assertEqual(0o644, stat.S_IMODE(os.stat(self.doc_file).st_mode))
+
+        # A new document gets the mode any other new file would
+        plain_file = os.path.join(self.work_dir, 'plain')
+        open(plain_file, 'w').close()
+
+        new_file = os.path.join(self.work_dir, 'new.nd')
+        document.write(document.read(self.doc_file), new_file)
+        self.assertEqual(stat.S_IMODE(os.stat(plain_file).st_mode),
+                         stat.S_IMODE(os.stat(new_file).st_mode))
+
+    def test_unsaved_sessions_are_recovered(self):
+        session = self._edit().__enter__()
+        session.set_content('section/first/content-1', 'Recovered.')
+
+        with self._edit() as session:
+            pass
+
+        self.assertIn('Recovered.', self._source())
+
+    def test_failed_sessions_are_not_saved(self):
+        try:
+            with self._edit() as session:
+                session.set_content('section/first/content-1', 'Lost.')
+                raise ValueError()
+        except ValueError:
+            pass
+
+        with self._edit() as session:
+            pass
+
+        self.assertEqual(_DOC, self._source())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+import unittest
+
+import nurpg.document as document
+
+import nurpg.tools.handout as handout
+import nurpg.tools.pipeline as pipeline
+
+
+_DOC = """@title Handout Test
+@section Mechanics
+@feature Proficiency
+@mechanic Dodge Proficiency
+@cost 2
+@mechanic Climb Proficiency
+@cost 3
+@feature Unused
+@mechanic Unused Proficiency
+@cost 9
+@section Abilities
+@ability Dodge
+@difficulty 10
+@grants mechanic Dodge Proficiency, 2
+@ability Climb
+@difficulty 15
+@section Rangers
+@aspect Nimble
+@grants ability Dodge
+@ref ability Climb
+@section Lore
+@aspect Unrelated
+@grants ability Climb
+"""
+
+
+def _kinds(doc, kind):
+    return [node.content for node in document.find(doc.root, kind)]
+
+
+class TestHandout(unittest.TestCase):
+
+    def test_dependencies(self):
+        doc = document.parse(_DOC, lazy=True)
+        sections = dict((section.content, section)
+                        for section in doc.sections)
+
+        result = handout.build(doc, ['ranger*'])
+
+        self.assertEqual(['Mechanics', 'Abilities', 'Rangers'],
+                         _kinds(result, document.D_SECTION))
+        self.assertEqual(['Dodge', 'Climb'],
+                         _kinds(result, document.D_ABILITY))
+
+        # Needed elements come whole, with their own mechanics and costs
+        self.assertEqual(['Dodge Proficiency', 'Climb Proficiency'],
+                         _kinds(result, document.D_MECHANIC))
+
+        # Nothing else in the document was built along the way
+        for section in sections.values():
+            self.assertIsNotNone(section._loader)
+
+    def test_costs_match_the_whole_document(self):
+        whole = document.parse(_DOC)
+        result = handout.build(document.parse(_DOC, lazy=True), ['Rangers'])
+
+        nimble = list(document.find(whole.root, document.D_ASPECT))[0]
+        handout_nimble = list(document.find(result.root,
+                                            document.D_ASPECT))[0]
+
+        self.assertEqual(pipeline.Resolver(whole).cost(nimble),
+                         pipeline.Resolver(result).cost(handout_nimble))
+
+        rendered = dict(pipeline.render(result, [pipeline.HTML]))
+        self.assertIn('href="#{}"'.format(
+            list(document.find(result.root, document.D_ABILITY))[1].id),
+            rendered[pipeline.HTML])
+
+    def test_scan_directives(self):
+        doc = document.parse(_DOC + '@section Escaped\nme\\@ability Fake\n',
+                             lazy=True)
+        sections = list(doc.sections)
+
+        self.assertEqual(['Dodge', 'Climb'], document.scan_directives(
+            sections[1], document.D_ABILITY))
+        self.assertEqual([], document.scan_directives(
+            sections[-1], document.D_ABILITY))
+
+    def test_no_match(self):
+        with self.assertRaises(handout.HandoutError):
+            handout.build(document.parse(_DOC, lazy=True), ['Wizards'])
+
+
+if __name__ == '__main__':
+    unittest.main()
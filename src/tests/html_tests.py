@@ -36,6 +36,36 @@ class TestHtmlGeneration(unittest.TestCase):
 
         self.assertEqual('value', match_partial.complete())
 
+    def test_minified(self):
+        def render():
+            return html.div(
+                {'id': 'root', 'style': 'font-size: 10pt; color: red;'},
+                html.span({'title': 'two words'}, 'Some   spaced\n text'),
+                html.pre('  kept\n  as is'))()
+
+        self.assertIn(
+            '<span title="two words">Some   spaced\n text</span>'
+            '<pre>  kept\n  as is</pre></div>', render())
+
+        with html.minified():
+            self.assertEqual(
+                '<div id=root style=font-size:10pt;color:red>'
+                '<span title="two words">Some spaced text</span>'
+                '<pre>  kept\n  as is</pre></div>', render())
+
+    def test_minified_within_raw_tags(self):
+        def render():
+            return html.div(
+                html.pre(html.span('  a  '), html.b(html.i(' b\n c'))),
+                html.textarea(html.span('  d  ')),
+                html.span('  e  '))()
+
+        with html.minified():
+            self.assertEqual(
+                '<div><pre><span>  a  </span><b><i> b\n c</i></b></pre>'
+                '<textarea><span>  d  </span></textarea>'
+                '<span> e </span></div>', render())
+
 
 if __name__ == '__main__':
     unittest.main()
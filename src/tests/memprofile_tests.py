@@ -0,0 +1,118 @@
+import shutil
+import tempfile
+import unittest
+
+import nurpg.document as document
+import nurpg.memprofile as memprofile
+
+import nurpg.tools.publish as publish
+import nurpg.tools.pipeline as pipeline
+import nurpg.tools.validate as validate
+
+
+_CONTENT = """@title Profiled
+@section Abilities
+@ability Bite
+@difficulty 10
+"""
+
+
+class TestMemoryProfile(unittest.TestCase):
+
+    def test_phases_recorded(self):
+        profile = memprofile.MemoryProfile()
+
+        with memprofile.profiling(profile):
+            with memprofile.phase(memprofile.RENDER):
+                with memprofile.phase(memprofile.WRITE):
+                    [0] * 100000
+
+            with memprofile.phase(memprofile.RENDER):
+                pass
+
+        self.assertFalse(memprofile.active())
+        self.assertEqual([memprofile.RENDER, memprofile.WRITE], profile.order)
+        self.assertEqual(2, profile.phases[memprofile.RENDER].runs)
+
+        # A phase's peak covers the phases nested within it
+        self.assertGreaterEqual(profile.phases[memprofile.RENDER].peak,
+                                profile.phases[memprofile.WRITE].peak)
+        self.assertEqual(2 + len(profile.order), len(profile.report()))
+
+    def test_budget(self):
+        profile = memprofile.MemoryProfile(budget=1)
+
+        with memprofile.profiling(profile):
+            with self.assertRaises(memprofile.MemoryBudgetError):
+                with memprofile.phase(memprofile.COSTS):
+                    held = [0] * 1000000
+
+        self.assertEqual(1, profile.phases[memprofile.COSTS].runs)
+        self.assertGreater(profile.phases[memprofile.COSTS].used, 0)
+
+    def test_budget_covers_only_the_phase(self):
+        # Whatever the process already holds is more than this
+        profile = memprofile.MemoryProfile(budget=document.MB_IN_BYTES)
+
+        with memprofile.profiling(profile):
+            document.parse(_CONTENT)
+
+        self.assertLessEqual(profile.phases[memprofile.BUILD].used,
+                             document.MB_IN_BYTES)
+
+    def test_resident_size(self):
+        # What's measured without tracemalloc, which is always the case on
+        # 2.7.x
+        profile = memprofile.MemoryProfile()
+        profile.tracing = False
+
+        with memprofile.profiling(profile):
+            with memprofile.phase(memprofile.BUILD):
+                held = ' ' * (32 * document.MB_IN_BYTES)
+
+        stats = profile.phases[memprofile.BUILD]
+        self.assertGreaterEqual(stats.used, 16 * document.MB_IN_BYTES)
+        self.assertGreaterEqual(stats.peak, stats.used)
+        self.assertEqual([], stats.top())
+        self.assertIn('resident size', profile.report()[0])
+
+    def test_streamed_writes(self):
+        # Files written by their own threads are still measured as writes
+        out_dir = tempfile.mkdtemp()
+        profile = memprofile.MemoryProfile(top=0)
+
+        try:
+            with memprofile.profiling(profile):
+                pipeline.stream(document.parse(_CONTENT), ['html', 'md'],
+                                publish.Publisher(out_dir))
+        finally:
+            shutil.rmtree(out_dir)
+
+        self.assertIn(memprofile.WRITE, profile.order)
+        self.assertEqual(2, profile.phases[memprofile.WRITE].runs)
+
+    def test_unprofiled(self):
+        with memprofile.phase(memprofile.BUILD) as stats:
+            self.assertIsNone(stats)
+
+    def test_parse_phases(self):
+        profile = memprofile.MemoryProfile(top=0)
+
+        with memprofile.profiling(profile):
+            doc = document.parse(_CONTENT)
+
+        self.assertEqual('Profiled', doc.title)
+        self.assertEqual([memprofile.TOKENIZE, memprofile.BUILD], profile.order)
+
+    def test_validate_phases(self):
+        profile = memprofile.MemoryProfile(top=0)
+
+        with memprofile.profiling(profile):
+            report = validate.validate(_CONTENT)
+
+        self.assertTrue(report.valid)
+        self.assertEqual([memprofile.VALIDATE], profile.order)
+
+
+if __name__ == '__main__':
+    unittest.main()
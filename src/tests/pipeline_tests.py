@@ -0,0 +1,115 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import nurpg.html as html
+import nurpg.document as document
+
+import nurpg.tools.export as export
+import nurpg.tools.publish as publish
+import nurpg.tools.pipeline as pipeline
+
+
+_DOC = """@title Pipeline Test
+@section Mechanics
+Mechanics cost *points*.
+@feature Proficiency
+@mechanic Dodge Proficiency
+@cost 2
+@section Abilities
+@ability Dodge
+@difficulty 10
+@grants mechanic Dodge Proficiency, 2
+@section Aspects
+@aspect Nimble
+@grants ability Dodge
+@effect Blur
+@mechanic Harder to hit
+@cost 1
+"""
+
+
+def _render_doc(doc):
+    return html.html(
+        html.head(html.title(doc.title)),
+        html.body(html.div(export.render_doc(doc))))()
+
+
+class TestPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.doc = document.parse(_DOC)
+
+    def test_html_matches_export(self):
+        rendered = dict(pipeline.render(self.doc, [pipeline.HTML]))
+        self.assertEqual(_render_doc(self.doc), rendered[pipeline.HTML])
+
+        with html.minified():
+            expected = _render_doc(self.doc)
+
+        rendered = dict(pipeline.render(self.doc, [pipeline.HTML], True))
+        self.assertEqual(expected, rendered[pipeline.HTML])
+
+    def test_formats(self):
+        rendered = pipeline.render(self.doc, pipeline.FORMATS)
+        self.assertEqual(list(pipeline.FORMATS), [fmt for fmt, _ in rendered])
+
+        rendered = dict(rendered)
+        markdown = rendered[pipeline.MARKDOWN]
+        text = rendered[pipeline.TEXT]
+
+        self.assertIn('<a id="section/ability/dodge"></a>\n\n### Dodge\n',
+                      markdown)
+        self.assertIn('Mechanics cost \\*points\\*.', markdown)
+        self.assertIn('**Grants Mechanic:** [Dodge Proficiency x 2]'
+                      '(#section/feature/mechanic/dodge-proficiency)', markdown)
+
+        # Resolved costs are shared between the formats
+        self.assertIn('**Aspect Point Cost:** 5', markdown)
+        self.assertIn('Dodge\n  Aspect Point Cost: 5\n  Difficulty: 10\n',
+                      text)
+        self.assertIn('  Feature Mechanic: Dodge Proficiency\n'
+                      '    Aspect Point Cost: 2\n', text)
+
+    def test_references_match_parse_grant(self):
+        resolver = pipeline.Resolver(self.doc)
+
+        for grant in document.find(self.doc.root, document.D_GRANTS):
+            self.assertEqual(export.parse_grant(self.doc, grant),
+                             resolver.reference(grant))
+
+        ability = next(self.doc.root.find(document.D_ABILITY, 'Dodge'))
+        ability.append(document.DocumentNode(
+            document.D_GRANTS, 'mechanic Missing'))
+
+        with self.assertRaises(export.ExportError):
+            pipeline.render(self.doc, [pipeline.TEXT])
+
+    def test_streamed_matches_render(self):
+        out_dir = tempfile.mkdtemp()
+
+        try:
+            publisher = publish.Publisher(out_dir, manifest=False)
+            changed, timings = pipeline.stream(
+                self.doc, pipeline.FORMATS, publisher)
+
+            self.assertEqual([(fmt, True) for fmt in pipeline.FORMATS], changed)
+
+            for fmt, content in pipeline.render(self.doc, pipeline.FORMATS):
+                path = os.path.join(out_dir, 'Pipeline Test.' + fmt)
+
+                with open(path, 'rb') as fin:
+                    self.assertEqual(content, fin.read())
+
+            self.assertEqual(len(pipeline.FORMATS), timings.chunks)
+        finally:
+            shutil.rmtree(out_dir)
+
+    def test_unknown_format(self):
+        with self.assertRaises(pipeline.PipelineError):
+            pipeline.render(self.doc, ['pdf'])
+
+
+if __name__ == '__main__':
+    unittest.main()
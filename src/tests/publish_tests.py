@@ -0,0 +1,141 @@
+import os
+import gzip
+import json
+import shutil
+import tempfile
+import unittest
+
+import nurpg.compat as compat
+
+import nurpg.tools.publish as publish
+
+
+_CONTENT = '<p>Published content.</p>' * 5000
+
+
+def _read_gzip(path):
+    with gzip.open(path, 'rb') as fin:
+        return fin.read()
+
+
+class TestPublishing(unittest.TestCase):
+
+    def setUp(self):
+        self.out_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.out_dir, 'page.html')
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir)
+
+    def test_compressed_siblings(self):
+        changed, entry = publish.write_file(
+            self.path, _CONTENT, [publish.GZIP])
+
+        self.assertTrue(changed)
+        self.assertEqual(_CONTENT, _read_gzip(self.path + '.gz'))
+        self.assertEqual(len(_CONTENT), entry['size'])
+        self.assertEqual(os.path.getsize(self.path + '.gz'),
+                         entry['gz']['size'])
+
+        # Compressed output doesn't depend on when it was written
+        with open(self.path + '.gz', 'rb') as fin:
+            first = fin.read()
+
+        os.remove(self.path)
+        publish.write_file(self.path, _CONTENT, [publish.GZIP])
+
+        with open(self.path + '.gz', 'rb') as fin:
+            self.assertEqual(first, fin.read())
+
+    def test_unchanged_files_are_kept(self):
+        publish.write_file(self.path, _CONTENT, [publish.GZIP])
+        os.utime(self.path, (0, 0))
+
+        changed, entry = publish.write_file(
+            self.path, _CONTENT, [publish.GZIP])
+
+        self.assertFalse(changed)
+        self.assertEqual(0, os.path.getmtime(self.path))
+        self.assertIn('gz', entry)
+
+        # Changed content without compression drops the stale sibling
+        publish.write_file(self.path, 'Changed.')
+        self.assertFalse(os.path.exists(self.path + '.gz'))
+
+    def test_manifest(self):
+        publisher = publish.Publisher(self.out_dir, [publish.GZIP])
+        publisher.write('a.html', 'A')
+        publisher.write('b.html', 'B')
+        publisher.close()
+
+        publisher = publish.Publisher(self.out_dir)
+        publisher.remove('b.html')
+        self.assertTrue(publisher.close())
+
+        with open(os.path.join(self.out_dir, publish.MANIFEST_FILE)) as fin:
+            manifest = json.load(fin)
+
+        self.assertEqual(['a.html'], list(manifest))
+        self.assertEqual(1, manifest['a.html']['size'])
+        self.assertEqual(['a.html', 'a.html.gz', publish.MANIFEST_FILE],
+                         sorted(os.listdir(self.out_dir)))
+
+    def test_streamed_file(self):
+        publish.write_file(self.path, _CONTENT, [publish.GZIP])
+        os.utime(self.path, (0, 0))
+
+        # A single chunk in flight has rendering wait on every write
+        streamed = publish.StreamedFile(self.path, [publish.GZIP],
+                                        queue_chunks=1)
+
+        for offset in range(0, len(_CONTENT), 1000):
+            streamed.write(_CONTENT[offset:offset + 1000])
+
+        changed, entry = streamed.close()
+
+        self.assertFalse(changed)
+        self.assertEqual(0, os.path.getmtime(self.path))
+        self.assertEqual(publish.write_file(self.path, _CONTENT)[1]['sha1'],
+                         entry['sha1'])
+        self.assertGreater(streamed.timings.chunks, 1)
+
+        streamed = publish.StreamedFile(self.path, [publish.GZIP])
+        streamed.write('Changed.')
+
+        self.assertTrue(streamed.close()[0])
+        self.assertEqual('Changed.', _read_gzip(self.path + '.gz'))
+        self.assertEqual(['page.html', 'page.html.gz'],
+                         sorted(os.listdir(self.out_dir)))
+
+    def test_streamed_failures(self):
+        # Writer failures come out of the producer's next write or close
+        streamed = publish.StreamedFile(self.path, queue_chunks=1)
+        streamed._outputs.files[0][3].close()
+
+        with self.assertRaises(ValueError):
+            for _ in range(100):
+                streamed.write(_CONTENT)
+
+            streamed.close()
+
+        # As does abandoning a file, leaving nothing behind either way
+        streamed = publish.StreamedFile(self.path, [publish.GZIP])
+        streamed.write(_CONTENT)
+        streamed.abort()
+
+        self.assertEqual([], os.listdir(self.out_dir))
+
+    @unittest.skipIf(compat.lzma is None, 'lzma is not available.')
+    def test_xz(self):
+        publish.write_file(self.path, _CONTENT, [publish.GZIP, publish.XZ])
+
+        with open(self.path + '.xz', 'rb') as fin:
+            self.assertEqual(_CONTENT, compat.lzma.decompress(fin.read()))
+
+    def test_unknown_formats(self):
+        self.assertRaises(publish.PublishError,
+                          publish.Publisher, self.out_dir, ['zip'])
+
+
+if __name__ == '__main__':
+    unittest.main()
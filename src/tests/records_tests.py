@@ -0,0 +1,66 @@
+import json
+import unittest
+
+import nurpg.compat as compat
+import nurpg.document as document
+
+import nurpg.tools.records as records
+
+
+_DOC = """@title Record Test
+@author Someone
+@section Mechanics
+@feature Proficiency
+@mechanic Dodge Proficiency
+@cost 2
+@section Abilities
+@ability Dodge
+@difficulty 10
+@grants mechanic Dodge Proficiency, 2
+"""
+
+
+class TestRecords(unittest.TestCase):
+
+    def setUp(self):
+        self.doc = document.parse(_DOC)
+
+    def test_records(self):
+        by_id = dict((record['id'], record)
+                     for record in records.records(self.doc))
+
+        self.assertEqual(
+            {'id': 'section/feature/mechanic/dodge-proficiency',
+             'kind': 'mechanic', 'content': 'Dodge Proficiency',
+             'parent': 'section/feature/proficiency', 'depth': 2},
+            by_id['section/feature/mechanic/dodge-proficiency'])
+
+        dodge = by_id['section/ability/dodge']
+        self.assertEqual('section/abilities', dodge['parent'])
+        self.assertEqual(1 + 2 * 2, dodge['cost'])
+        self.assertEqual(
+            [{'id': 'section/feature/mechanic/dodge-proficiency',
+              'multiplier': 2}], dodge['grants'])
+
+        self.assertIsNone(by_id['section/mechanics']['parent'])
+
+    def test_layouts(self):
+        expected = list(records.records(self.doc))
+
+        stream = compat.StringIO()
+        records.dump(self.doc, stream, records.NDJSON)
+        lines = stream.getvalue().splitlines()
+
+        self.assertEqual(expected, [json.loads(line) for line in lines])
+
+        stream = compat.StringIO()
+        records.dump(self.doc, stream, records.JSON)
+        whole = json.loads(stream.getvalue())
+
+        self.assertEqual('Record Test', whole['title'])
+        self.assertEqual(['Someone'], whole['authors'])
+        self.assertEqual(expected, whole['nodes'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import unittest
+
+import nurpg.document as document
+
+import tests.synthetic as synthetic
+
+
+def _round_trip(doc):
+    return document.parse(document.dumps(doc))
+
+
+class TestSerialize(unittest.TestCase):
+
+    def test_escapes_only_tokenizer_characters(self):
+        node = document.DocumentNode(document.D_CONTENT, 'a@b\\c|d')
+
+        self.assertEqual('a\\@b\\\\c|d\n\n', str(node))
+        self.assertEqual('@cost 2\n', str(
+            document.DocumentNode(document.D_COST, '2')))
+        self.assertEqual('@note\n', str(
+            document.DocumentNode(document.D_NOTE)))
+
+    def test_round_trips_header(self):
+        doc = document.parse('@title Some @ title\n@author A\n@author B\n'
+                             '@section S\n@note\n@ref \n')
+        parsed = _round_trip(doc)
+
+        self.assertEqual('Some @ title', parsed.title)
+        self.assertEqual(['A', 'B'], parsed.authors)
+        self.assertEqual(doc.root.hash, parsed.root.hash)
+
+    def test_round_trips_late_header(self):
+        doc = document.parse('@section S\ntext\n@title Late\n@author A\n')
+        parsed = _round_trip(doc)
+
+        self.assertEqual('Late', parsed.title)
+        self.assertEqual(['A'], parsed.authors)
+        self.assertEqual(doc.root.hash, parsed.root.hash)
+
+    def test_writes_title_without_nodes(self):
+        doc = document.Document()
+        doc.title = 'Built'
+        doc.authors = ['Someone']
+        doc.root.append(document.DocumentNode(document.D_SECTION, 'S'))
+
+        parsed = _round_trip(doc)
+
+        self.assertEqual('Built', parsed.title)
+        self.assertEqual(['Someone'], parsed.authors)
+
+    def test_round_trips_synthetic_documents(self):
+        for seed in range(3):
+            doc = document.parse(synthetic.document_source(100, seed))
+            serialized = document.dumps(doc)
+            parsed = document.parse(serialized)
+
+            self.assertEqual(doc.title, parsed.title)
+            self.assertEqual(doc.authors, parsed.authors)
+            self.assertEqual(doc.root.hash, parsed.root.hash)
+            self.assertEqual(serialized, document.dumps(parsed))
+
+    def test_source_map_spans_sections(self):
+        doc = document.parse(synthetic.document_source(20))
+        stream = document.compat.StringIO()
+        source_map = document.dump(doc, stream)
+        serialized = stream.getvalue()
+
+        for section in doc.sections:
+            start, end = source_map.sections[section]
+            self.assertEqual(document.source(section), serialized[start:end])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,244 @@
+import io
+import json
+import random
+import unittest
+
+import nurpg.document as document
+
+import nurpg.tools.costs as costs
+import nurpg.tools.server as server
+import nurpg.tools.validate as validate
+
+
+_DOC = """@title Server Test
+@section Mechanics
+@feature Proficiency
+@mechanic Dodge Proficiency
+@cost 2
+@section Abilities
+@ability Dodge
+@difficulty 20
+@grants mechanic Dodge Proficiency, 2
+@ability Roll
+@difficulty 15
+@grants ability Dodge
+@section Aspects
+@aspect Nimble
+@grants ability Roll
+"""
+
+# Lines edits are made from, some of them break the document
+_LINES = [
+    '@section Extra\n', '@ability Jump\n', '@difficulty 10\n', '@cost 4\n',
+    '@grants ability Jump\n', '@grants ability Nimble\n', '@halt\n',
+    '@grants mechanic Dodge Proficiency, 3\n', '@mechanic Leap\n',
+    '@grants ability Dodge\n', 'Some text.\n', '@cost x\n', '@title Again\n',
+    '@ability Nimble\n', '@section'
+]
+
+
+def _problems(buf):
+    return [(diagnostic.line, diagnostic.msg)
+            for diagnostic in buf.diagnostics()]
+
+
+def _expected(text):
+    return [(problem.line - 1, problem.msg)
+            for problem in validate.validate(text).problems]
+
+
+def _costs(buf):
+    # The AP cost hovering over each line shows
+    costs = list()
+
+    for line in range(buf.text().count('\n') + 1):
+        hover = buf.hover(line, 0)
+        costs.append(hover.text if hover is not None else None)
+
+    return costs
+
+
+def _expected_costs(text):
+    try:
+        doc = document.parse(text)
+        graph = costs.build(doc)
+    except (document.DocumentError, costs.CostGraphError):
+        return None
+
+    lines = text.split('\n')
+    found = list()
+
+    # Nothing after a halt has a cost
+    if '@halt' in lines:
+        lines[lines.index('@halt'):] = [None] * (len(lines) -
+                                                 lines.index('@halt'))
+
+    # Elements come in the same order as their directives
+    nodes = [node for node in document._walk(doc.root)
+             if node.kind in costs.INDEXED_KINDS]
+
+    for line in lines:
+        kind = (line or '')[1:].partition(' ')[0]
+
+        if line is not None and line.startswith('@') and (
+                kind in costs.INDEXED_KINDS):
+            node = nodes.pop(0)
+            found.append('{} {}: {} AP'.format(kind, node.content,
+                                               graph.cost(node)))
+        else:
+            found.append(None)
+
+    return found
+
+
+class TestBuffer(unittest.TestCase):
+
+    def test_matches_full_validation(self):
+        rng = random.Random(0)
+        buf = server.Buffer(_DOC)
+        buf.hover(0, 0)
+        valid = 0
+
+        for count in range(300):
+            lines = buf.text().count('\n')
+            start = rng.randint(0, lines)
+            end = min(start + rng.randint(0, 2), lines)
+
+            buf.edit(rng.choice(_LINES), (start, 0), (end, 0))
+            text = buf.text()
+
+            self.assertEqual(_expected(text), _problems(buf), text)
+            self.assertEqual(server.Buffer(text).starts, buf.starts)
+
+            # Costs are kept up to date rather than worked out again
+            if len(_expected(text)) == 0:
+                self.assertEqual(_expected_costs(text), _costs(buf), text)
+                valid += 1
+
+        self.assertGreater(valid, 10)
+
+    def test_costs_follow_edits(self):
+        buf = server.Buffer(_DOC)
+
+        self.assertEqual(_expected_costs(_DOC), _costs(buf))
+        self.assertEqual('aspect Nimble: 3 AP', buf.hover(13, 3).text)
+
+        # Within a line, across sections and of the whole buffer
+        buf.edit('5', (4, 6), (4, 7))
+        buf.edit('', (5, 0), (6, 0))
+        buf.edit(_DOC + '@ability Jump\n@grants ability Roll\n')
+
+        for edit in range(3):
+            self.assertEqual(_expected_costs(buf.text()), _costs(buf))
+            buf.edit('@difficulty 5\n', (7, 0), (8, 0))
+
+        # Not while there's a cycle, again once it's gone
+        buf.edit('@grants ability Roll\n', (9, 0), (9, 0))
+        self.assertIsNone(buf.hover(6, 0))
+
+        buf.edit('', (9, 0), (10, 0))
+        self.assertEqual(_expected_costs(buf.text()), _costs(buf))
+
+    def test_only_edited_sections_are_scanned(self):
+        buf = server.Buffer(_DOC)
+
+        scanned = list()
+        scan = validate.scan
+
+        def counting(content):
+            scanned.append(content)
+            return scan(content)
+
+        validate.scan = counting
+
+        try:
+            buf.edit('25', (7, 12), (7, 14))
+        finally:
+            validate.scan = scan
+
+        self.assertEqual(1, len(scanned))
+        self.assertTrue(scanned[0].startswith('@section Abilities\n'))
+
+    def test_positions_count_characters(self):
+        buf = server.Buffer('@title T\n@section \xc3\xa9p\xc3\xa9e\n@bogus\n')
+        buf.edit('x', (1, 13), (1, 13))
+
+        self.assertEqual('@title T\n@section \xc3\xa9p\xc3\xa9ex\n@bogus\n',
+                         buf.text())
+        self.assertEqual([(2, 0, 6)], [
+            (diagnostic.line, diagnostic.character, diagnostic.end)
+            for diagnostic in buf.diagnostics()])
+
+
+def _message(payload):
+    body = json.dumps(payload)
+    return 'Content-Length: {}\r\n\r\n{}'.format(len(body), body)
+
+
+def _messages(output):
+    found = list()
+
+    while len(output) > 0:
+        header, separator, output = output.partition('\r\n\r\n')
+        length = int(header.split(':')[1])
+
+        found.append(json.loads(output[:length]))
+        output = output[length:]
+
+    return found
+
+
+class TestServer(unittest.TestCase):
+
+    def _serve(self, payloads):
+        fin = io.BytesIO(''.join(_message(payload)
+                                 for payload in payloads).encode('utf-8'))
+        fout = io.BytesIO()
+
+        shutdown = server.Server(fin, fout).run()
+        return shutdown, _messages(fout.getvalue().decode('utf-8'))
+
+    def test_session(self):
+        uri = 'file:///book.nd'
+
+        shutdown, replies = self._serve([
+            {'jsonrpc': '2.0', 'id': 1, 'method': 'initialize', 'params': {}},
+            {'jsonrpc': '2.0', 'method': 'textDocument/didOpen', 'params': {
+                'textDocument': {'uri': uri, 'version': 1, 'text': _DOC}}},
+            {'jsonrpc': '2.0', 'method': 'textDocument/didChange', 'params': {
+                'textDocument': {'uri': uri, 'version': 2},
+                'contentChanges': [{'range': {
+                    'start': {'line': 11, 'character': 16},
+                    'end': {'line': 11, 'character': 21}}, 'text': 'Jump'}]}},
+            {'jsonrpc': '2.0', 'id': 2, 'method': 'textDocument/hover',
+             'params': {'textDocument': {'uri': uri},
+                        'position': {'line': 6, 'character': 2}}},
+            {'jsonrpc': '2.0', 'id': 3, 'method': 'textDocument/rename',
+             'params': {}},
+            {'jsonrpc': '2.0', 'id': 4, 'method': 'shutdown'},
+            {'jsonrpc': '2.0', 'method': 'exit'}
+        ])
+
+        self.assertTrue(shutdown)
+        self.assertEqual(server._SYNC_INCREMENTAL, replies[0]['result'][
+            'capabilities']['textDocumentSync']['change'])
+
+        self.assertEqual([], replies[1]['params']['diagnostics'])
+        self.assertEqual(2, replies[2]['params']['version'])
+        self.assertEqual([(11, 'Dangling @grants: ability Jump not found.')], [
+            (diagnostic['range']['start']['line'], diagnostic['message'])
+            for diagnostic in replies[2]['params']['diagnostics']])
+
+        self.assertEqual('ability Dodge: 3 AP',
+                         replies[3]['result']['contents']['value'])
+        self.assertEqual(server.METHOD_NOT_FOUND, replies[4]['error']['code'])
+        self.assertEqual({'jsonrpc': '2.0', 'id': 4, 'result': None},
+                         replies[5])
+
+    def test_exit_without_shutdown(self):
+        self.assertFalse(self._serve([
+            {'jsonrpc': '2.0', 'method': 'exit'}])[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
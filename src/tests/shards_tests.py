@@ -0,0 +1,127 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import nurpg.document as document
+
+import nurpg.tools.shards as shards
+
+
+_DOC = """@title Shard Test
+@section Mechanics
+@feature Proficiency
+@mechanic Dodge Proficiency
+@cost 2
+@section Abilities
+@ability Dodge
+@difficulty 10
+@grants mechanic Dodge Proficiency
+@ability Tumble
+@difficulty 15
+@grants ability Dodge
+"""
+
+
+def _listdir(out_dir):
+    # Everything but the record of the shards written
+    return sorted(filename for filename in os.listdir(out_dir)
+                  if filename != shards.SHARDS_FILE)
+
+
+def _read(out_dir, filename):
+    with open(os.path.join(out_dir, filename)) as fin:
+        return fin.read()
+
+
+class TestShardedExport(unittest.TestCase):
+
+    def setUp(self):
+        self.out_dir = tempfile.mkdtemp()
+        self.doc = document.parse(_DOC)
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir)
+
+    def test_layout(self):
+        written = shards.export_shards(self.doc, self.out_dir)
+
+        self.assertEqual(
+            ['index.html', 'section-abilities.html', 'section-mechanics.html'],
+            sorted(written))
+
+        index = _read(self.out_dir, 'index.html')
+        self.assertIn('href="section-mechanics.html#section/mechanics"', index)
+        self.assertIn('data-shard="section-abilities.html"', index)
+
+        # Links are rewritten only when they lead into another shard
+        abilities = _read(self.out_dir, 'section-abilities.html')
+        self.assertIn('href="section-mechanics.html#section/feature/mechanic/'
+                      'dodge-proficiency"', abilities)
+        self.assertIn('href="#section/ability/dodge"', abilities)
+
+    def test_only_changes_are_written(self):
+        shards.export_shards(self.doc, self.out_dir)
+        mechanics = os.path.join(self.out_dir, 'section-mechanics.html')
+        os.utime(mechanics, (0, 0))
+
+        self.assertEqual([], shards.export_shards(self.doc, self.out_dir))
+
+        ability = next(self.doc.root.find(document.D_ABILITY, 'Tumble'))
+        ability.append(document.DocumentNode(document.D_CONTENT, 'Rolls.'))
+
+        self.assertEqual(['section-abilities.html'],
+                         shards.export_shards(self.doc, self.out_dir))
+        self.assertEqual(0, os.path.getmtime(mechanics))
+
+    def test_removed_sections(self):
+        shards.export_shards(self.doc, self.out_dir)
+        self.doc.root.remove(list(self.doc.sections)[1])
+
+        shards.export_shards(self.doc, self.out_dir)
+
+        self.assertEqual(['index.html', 'section-mechanics.html'],
+                         _listdir(self.out_dir))
+
+    def test_only_written_shards_are_removed(self):
+        # Files that look like shards but weren't written by an export stay
+        for filename in ('section-notes.html', 'section-notes.html.gz'):
+            with open(os.path.join(self.out_dir, filename), 'w') as fout:
+                fout.write('Mine.')
+
+        shards.export_shards(self.doc, self.out_dir)
+        self.doc.root.remove(list(self.doc.sections)[1])
+        shards.export_shards(self.doc, self.out_dir)
+
+        self.assertEqual(['index.html', 'section-mechanics.html',
+                          'section-notes.html', 'section-notes.html.gz'],
+                         _listdir(self.out_dir))
+
+    def test_manifest_shards_are_removed(self):
+        # Shards listed by an earlier export's manifest are removed even
+        # without the record of what it wrote
+        shards.export_shards(self.doc, self.out_dir, manifest=True)
+        os.remove(os.path.join(self.out_dir, shards.SHARDS_FILE))
+
+        self.doc.root.remove(list(self.doc.sections)[1])
+        shards.export_shards(self.doc, self.out_dir, manifest=True)
+
+        self.assertEqual(['index.html', 'manifest.json',
+                          'section-mechanics.html'], _listdir(self.out_dir))
+
+    def test_parallel_matches_serial(self):
+        parallel_dir = tempfile.mkdtemp()
+
+        try:
+            shards.export_shards(self.doc, self.out_dir)
+            shards.export_shards(self.doc, parallel_dir, jobs=2)
+
+            for filename in os.listdir(self.out_dir):
+                self.assertEqual(_read(self.out_dir, filename),
+                                 _read(parallel_dir, filename))
+        finally:
+            shutil.rmtree(parallel_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
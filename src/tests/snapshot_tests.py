@@ -0,0 +1,125 @@
+import threading
+import unittest
+
+import nurpg.document as document
+import nurpg.snapshot as snapshot
+
+import nurpg.tools.diff as diff
+
+import tests.synthetic as synthetic
+
+
+_DOC = """@title Snapshots
+@author Someone
+@section Abilities
+@ability Dodge
+@difficulty 10
+@section Mechanics
+@feature Proficiency
+@mechanic Dodge Proficiency
+@cost 2
+"""
+
+
+class TestSnapshots(unittest.TestCase):
+
+    def setUp(self):
+        self.doc = document.parse(_DOC)
+        self.snap = snapshot.freeze(self.doc)
+
+    def test_freeze_keeps_ids_and_hashes(self):
+        self.assertEqual(self.doc.root.hash, self.snap.root.hash)
+        self.assertEqual('Snapshots', self.snap.title)
+        self.assertEqual(('Someone',), self.snap.authors)
+        self.assertEqual('2', self.snap.node(
+            'section/feature/mechanic/dodge-proficiency/cost-1').content)
+
+    def test_nodes_are_read_only(self):
+        with self.assertRaises(snapshot.SnapshotError):
+            self.snap.root.content = 'changed'
+
+        with self.assertRaises(snapshot.SnapshotError):
+            self.snap.title = 'changed'
+
+    def test_edits_share_unchanged_subtrees(self):
+        edited = self.snap.set_content('section/ability/dodge/difficulty-1',
+                                       '15')
+        old_children = self.snap.root.children
+        new_children = edited.root.children
+
+        self.assertEqual(1, edited.version)
+        self.assertIs(old_children[3], new_children[3])
+        self.assertIsNot(old_children[2], new_children[2])
+        self.assertEqual('10', self.snap.node(
+            'section/ability/dodge/difficulty-1').content)
+        self.assertEqual('15', edited.node(
+            'section/ability/dodge/difficulty-1').content)
+
+        changes = diff.diff(self.snap, edited)
+        self.assertEqual(['section/ability/dodge/difficulty-1'],
+                         [change.node.id for change in changes])
+
+    def test_insert_and_remove(self):
+        ability = document.DocumentNode(document.D_ABILITY, 'Tumble')
+        ability.append(document.DocumentNode(document.D_DIFFICULTY, '15'))
+
+        edited = self.snap.append('section/abilities', ability)
+        edited = edited.remove('section/ability/dodge')
+        edited = edited.set_content('title-1', 'Edited')
+
+        self.assertEqual('15', edited.node(
+            'section/ability/tumble/difficulty-1').content)
+        self.assertIsNone(edited.node('section/ability/dodge'))
+        self.assertEqual('Edited', edited.title)
+
+        doc = document.parse(document.dumps(snapshot.thaw(edited)))
+        self.assertEqual(edited.root.hash, doc.root.hash)
+
+    def test_inserted_ids_are_unique(self):
+        edited = self.snap.insert('section/ability/dodge', 0,
+                                  document.DocumentNode(
+                                      document.D_DIFFICULTY, '5'))
+        edited = edited.insert('section/abilities', 0, document.DocumentNode(
+            document.D_ABILITY, 'Dodge'))
+
+        dodges = list(edited.root.children[2].children)
+        ids = [node.id for node in dodges] + [
+            node.id for node in dodges[1].children]
+
+        self.assertEqual(len(ids), len(set(ids)))
+        self.assertEqual(['5', '10'], [edited.node(node_id).content
+                                       for node_id in ids[2:]])
+        self.assertIs(dodges[0], edited.node(dodges[0].id))
+
+    def test_readers_see_consistent_versions(self):
+        head = snapshot.Head(snapshot.freeze(document.parse(
+            synthetic.document_source(20))))
+        cost_id = next(head.current.root.find(document.D_COST)).id
+        failures = list()
+
+        def read():
+            for attempt in range(200):
+                current = head.current
+
+                # A snapshot's content must never change underneath a reader
+                if current.node(cost_id).content != str(current.version):
+                    if current.version > 0:
+                        failures.append(current.version)
+
+        readers = [threading.Thread(target=read) for reader in range(4)]
+
+        for reader in readers:
+            reader.start()
+
+        for version in range(1, 50):
+            head.update(lambda snap: snap.set_content(cost_id, str(version)))
+
+        for reader in readers:
+            reader.join()
+
+        self.assertEqual([], failures)
+        self.assertEqual(49, head.current.version)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import shutil
+import tempfile
+import unittest
+
+import nurpg.stash as stash
+
+
+_BASE = ''.join('line {}\n'.format(idx) for idx in range(200)).encode('ascii')
+
+
+class TestObjectStore(unittest.TestCase):
+
+    def setUp(self):
+        self.stash_dir = tempfile.mkdtemp()
+        self.store = stash.ObjectStore(self.stash_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.stash_dir)
+
+    def test_identical_snapshots_are_stored_once(self):
+        first = self.store.put(_BASE)
+        second = self.store.put(_BASE)
+
+        self.assertEqual(first, second)
+        self.assertEqual([first], self.store.ids())
+
+    def test_deltas_restore_exactly(self):
+        base_id = self.store.put(_BASE)
+        edited = _BASE.replace(b'line 50\n', b'line fifty\nline 50.5\n')
+        edited = edited.replace(b'line 199\n', b'')
+
+        edited_id = self.store.put(edited, base_id)
+
+        self.assertEqual(base_id, self.store.base_of(edited_id))
+        self.assertEqual(edited, self.store.get(edited_id))
+        self.assertTrue(
+            self.store.size(edited_id) < self.store.size(base_id))
+
+    def test_rebase(self):
+        base_id = self.store.put(_BASE)
+        edited = _BASE + b'tail\n'
+        edited_id = self.store.put(edited, base_id)
+
+        self.store.rebase(edited_id)
+        self.store.rebase(base_id, edited_id)
+
+        self.assertEqual(edited_id, self.store.base_of(base_id))
+        self.assertEqual(_BASE, self.store.get(base_id))
+
+
+class TestDeltas(unittest.TestCase):
+
+    def test_round_trip(self):
+        base = [b'a\n', b'b\n', b'\n', b'c\n', b'\n', b'd']
+        lines = [b'x\n', b'b\n', b'\n', b'c\n', b'a\n', b'd', b'e']
+        delta = stash.make_delta(base, lines)
+
+        self.assertEqual(b''.join(lines), stash.apply_delta(base, delta))
+
+
+if __name__ == '__main__':
+    unittest.main()
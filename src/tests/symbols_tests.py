@@ -0,0 +1,147 @@
+import io
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import unittest
+
+import nurpg.config as config
+import nurpg.document as document
+
+import nurpg.tools.cli as cli
+import nurpg.tools.symbols as symbols
+import nurpg.tools.pipeline as pipeline
+import nurpg.tools.validate as validate
+
+
+_CORE = """@title Core Rules
+@section Abilities
+@ability Bite Back
+@difficulty 15
+@grants ability Bite
+@ref aspect Feral
+"""
+
+_BESTIARY = """@title Bestiary
+@section Abilities
+@ability Bite
+@difficulty 10
+"""
+
+_CAMPAIGN = """@title Campaign
+@section Aspects
+@aspect Feral
+"""
+
+
+def _write(filename, content):
+    with open(filename, 'w') as fout:
+        fout.write(content)
+
+
+class TestSymbolIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.work_dir = tempfile.mkdtemp()
+
+        os.chdir(self.work_dir)
+        config.init_config('core.nd')
+
+        os.mkdir('addons')
+        _write('core.nd', _CORE)
+        _write('bestiary.nd', _BESTIARY)
+        _write(os.path.join('addons', 'campaign.nd'), _CAMPAIGN)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.work_dir)
+
+    def test_incremental_refresh(self):
+        index = symbols.SymbolIndex()
+        paths = symbols.workspace_documents()
+
+        self.assertEqual(paths, sorted(index.refresh(paths)))
+        self.assertEqual([], index.refresh(paths))
+
+        _write('bestiary.nd', _BESTIARY + '@ability Claw\n')
+        self.assertEqual(['bestiary.nd'], index.refresh(paths))
+        self.assertIn((document.D_ABILITY, 'Claw'), index)
+
+        index.refresh(['bestiary.nd'])
+        self.assertIsNone(index.lookup(document.D_ASPECT, 'Feral'))
+
+    def test_cached_index(self):
+        cfg = config.read_config()
+        index = symbols.workspace_index(cfg)
+
+        # The configured document resolves its own names
+        self.assertEqual([os.path.join('addons', 'campaign.nd'), 'bestiary.nd'],
+                         sorted(index.documents))
+
+        cached = symbols.read_index()
+        self.assertEqual([], cached.refresh(sorted(index.documents)))
+
+        symbol = cached.lookup(document.D_ABILITY, 'Bite')
+        self.assertEqual('Bestiary', symbol.title)
+        self.assertEqual('Bestiary.html#section/ability/bite',
+                         symbol.href(pipeline.HTML))
+
+    def test_cross_document_references(self):
+        index = symbols.workspace_index(config.read_config())
+        doc = document.read('core.nd')
+
+        rendered = dict(pipeline.render(
+            doc, [pipeline.HTML, pipeline.TEXT], symbols=index))
+
+        self.assertIn('href="Bestiary.html#section/ability/bite"',
+                      rendered[pipeline.HTML])
+        self.assertIn('See Aspect: Feral (Campaign)', rendered[pipeline.TEXT])
+
+        self.assertFalse(validate.check('core.nd').valid)
+        self.assertTrue(validate.check('core.nd', index).valid)
+
+    def test_broken_documents(self):
+        _write('broken.nd', '@title Broken\n@title Again\n@ability Bite\n')
+
+        index = symbols.workspace_index(config.read_config())
+        self.assertEqual('Bestiary',
+                         index.lookup(document.D_ABILITY, 'Bite').title)
+        self.assertTrue(validate.check('core.nd', index).valid)
+
+        # Kept as defining nothing until it changes
+        self.assertEqual([], index.documents['broken.nd']['symbols'])
+        self.assertEqual([], symbols.read_index().refresh(
+            sorted(index.documents)))
+
+    def test_included_files(self):
+        # Parts carry on inside whatever scope includes them
+        os.mkdir('parts')
+        _write('main.nd', '@title Main\n@section Rules\n@include parts/a.nd\n')
+        _write(os.path.join('parts', 'a.nd'),
+               '@include c.nd\n@ability Dodge\n@difficulty 10\n')
+        _write(os.path.join('parts', 'c.nd'),
+               '@feature Dodge Proficiency\n@cost 2\n')
+
+        config.write_config(config.Configuration('main.nd'))
+        stdout = sys.stdout
+        sys.stdout = io.BytesIO()
+
+        try:
+            cli.status_tool(argparse.Namespace())
+            cli.export_tool(argparse.Namespace(format='txt', output=None))
+            printed = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+        self.assertIn('Document is valid!', printed)
+        self.assertTrue(os.path.isfile('Main.txt'))
+
+        self.assertEqual([os.path.join('addons', 'campaign.nd'),
+                          'bestiary.nd', 'core.nd'],
+                         sorted(symbols.read_index().documents))
+
+
+if __name__ == '__main__':
+    unittest.main()
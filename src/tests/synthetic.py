@@ -0,0 +1,66 @@
+import random
+
+
+# Words to build names and text from
+_WORDS = [
+    'arcane', 'blade', 'climb', 'dodge', 'ember', 'feint', 'guard', 'haste',
+    'iron', 'jump', 'keen', 'lore', 'mend', 'nimble', 'omen', 'parry',
+    'quick', 'rally', 'stealth', 'tumble', 'ward'
+]
+
+# Directive arguments are never unescaped so they may hold anything
+_NAME_WORDS = _WORDS + ['me@example.com', 'C:\\games', '\\@']
+
+# Escaped source for content with the characters the tokenizer treats
+# specially
+_TEXT_WORDS = _WORDS + ['me\\@example.com', 'C:\\\\games', '\\\\\\@',
+                        '\\x']
+
+
+def document_source(sections, seed=0):
+    # Source text for a synthetic document that exercises every element
+    # kind, escapes and text after a halt
+    rng = random.Random(seed)
+    lines = ['@title {}'.format(_words(rng, 3))]
+
+    for author in range(rng.randint(1, 3)):
+        lines.append('@author {}'.format(_words(rng, 2)))
+
+    lines.append(_text(rng))
+
+    for section in range(sections):
+        lines.append('@section {} {}'.format(_words(rng, 2), section))
+        lines.append(_text(rng))
+
+        lines.append('@feature {} {}'.format(_words(rng, 2), section))
+        lines.append(_text(rng))
+
+        for mechanic in range(rng.randint(1, 4)):
+            lines.append('@mechanic {} {}'.format(_words(rng, 2), mechanic))
+            lines.append('@cost {}'.format(rng.randint(0, 5)))
+            lines.append(_text(rng))
+
+        lines.append('@ability {} {}'.format(_words(rng, 2), section))
+        lines.append('@difficulty {}'.format(rng.choice([10, 15, 20, 25])))
+        lines.append('@grants mechanic {}, {}'.format(
+            _words(rng, 2), rng.randint(1, 3)))
+        lines.append(_text(rng))
+
+        lines.append('@aspect {} {}'.format(_words(rng, 2), section))
+        lines.append('@requires ability {}'.format(_words(rng, 2)))
+        lines.append(_text(rng))
+
+        lines.append('@note')
+
+    lines.append('@halt')
+    lines.append(_text(rng))
+    return '\n'.join(lines) + '\n'
+
+
+def _words(rng, count, words=_NAME_WORDS):
+    return ' '.join(rng.choice(words) for word in range(count))
+
+
+def _text(rng):
+    return '\n'.join(_words(rng, rng.randint(4, 16), _TEXT_WORDS)
+                     for line in range(rng.randint(1, 4))) + '\n'
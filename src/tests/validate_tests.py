@@ -0,0 +1,109 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import nurpg.document as document
+
+import nurpg.tools.validate as validate
+
+
+_BROKEN_DOC = """@title Broken
+@ability Orphan
+@section Abilities
+@ability Tumble
+@difficulty ten
+@grants ability Dodge
+@ability Dodge
+@grants ability Tumble
+@grants mechanic Missing
+@cost 1
+@bogus directive
+@title Again
+"""
+
+
+class TestValidation(unittest.TestCase):
+
+    def test_valid_document(self):
+        report = validate.validate('@title Fine\n@section One\nSome text.\n'
+                                   '@feature Thing\n@mechanic Part\n@cost 2\n')
+
+        self.assertTrue(report.valid)
+        self.assertEqual('Fine', report.title)
+        self.assertEqual(6, report.node_count)
+
+    def test_collects_every_problem(self):
+        report = validate.validate(_BROKEN_DOC)
+        problems = [(problem.line, problem.msg) for problem in report.problems]
+
+        self.assertEqual([
+            (2, '@ability must be inside a @section.'),
+            (4, 'Grant cycle detected: Tumble -> Dodge -> Tumble'),
+            (5, '@difficulty requires an integer value, not "ten".'),
+            (9, 'Dangling @grants: mechanic Missing not found.'),
+            (10, '@cost may not be placed inside @ability.'),
+            (11, 'Unknown directive: bogus'),
+            (12, 'Document has two title nodes.')
+        ], problems)
+
+    def test_composed_documents(self):
+        work_dir = tempfile.mkdtemp()
+
+        try:
+            files = {
+                'book.nd': '@title Book\n@section Abilities\n'
+                           '@include dodge.nd\n@ability Climb\n@cost x\n',
+                'dodge.nd': '@ability Dodge\n@grants ability Climb\n'
+                            '@grants ability Jump\n'
+            }
+
+            for filename, content in files.items():
+                with open(os.path.join(work_dir, filename), 'w') as fout:
+                    fout.write(content)
+
+            report = validate.check(os.path.join(work_dir, 'book.nd'))
+        finally:
+            shutil.rmtree(work_dir)
+
+        # The included file carries on inside the section and problems are
+        # given by the file they're in
+        self.assertEqual([
+            ('dodge.nd', 3, 'Dangling @grants: ability Jump not found.'),
+            ('book.nd', 5, '@cost may not be placed inside @ability.'),
+            ('book.nd', 5, '@cost requires an integer value, not "x".')
+        ], [(os.path.basename(problem.filename), problem.line, problem.msg)
+            for problem in report.problems])
+
+    def test_house_rule_placement(self):
+        document.register_directive('spell', exits_to=document.D_SECTION,
+                                    opens=True, accepts=[document.D_COST])
+
+        try:
+            report = validate.validate('@section Spells\n@spell Fireball\n'
+                                       '@cost 2\n@difficulty 10\n'
+                                       '@ability Dodge\n@difficulty 10\n')
+        finally:
+            document.D_WORDS.remove('spell')
+            document.GRAMMAR.pop('spell')
+            document._compile_grammar()
+
+        self.assertEqual([(4, '@difficulty may not be placed inside @spell.')],
+                         [(problem.line, problem.msg)
+                          for problem in report.problems])
+
+    def test_escaped_directives(self):
+        report = validate.validate('@section One\nmail\\@example.com\n'
+                                   '\\\\@bogus\n')
+        problems = [(problem.line, problem.msg) for problem in report.problems]
+
+        self.assertEqual([(3, 'Unknown directive: bogus')], problems)
+
+    def test_missing_line_end(self):
+        report = validate.validate('@section One\n@cost 1')
+
+        self.assertEqual(2, report.problems[0].line)
+
+
+if __name__ == '__main__':
+    unittest.main()